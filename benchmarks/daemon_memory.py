@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+"""
+Runs the whole daemon against the fake Icinga 2 API server (see
+``fakeapi.py``) at the given scales and measures its real memory:
+the proportional set size (PSS) summed over the daemon process and
+its children, so the pages shared between them (i. e. the host
+index) are counted once. The instance has an ApiUser for each Host
+but a tenth, so the first comparison makes some changes. Prints
+a JSON report with the peak and the steady PSS and the per-process
+figures after the first comparison has finished.
+"""
+
+import sys
+import os
+import json
+import time
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from typing import Any, Dict, List
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from icinga2_usersyncd.status import query_status
+from icinga2_usersyncd.constants import ENGINES, STATUS_SOCKET
+
+import fakeapi
+
+def children(pid: int) -> List[int]:
+    """
+    Returns the PIDs of all the descendants of the given process.
+    """
+
+    parents: Dict[int, int] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        parents[int(entry)] = int(stat[stat.rindex(")") + 2:].split()[1])
+
+    found: List[int] = []
+    queue = [pid]
+    while queue:
+        parent = queue.pop()
+        for child, ppid in parents.items():
+            if ppid == parent:
+                found.append(child)
+                queue.append(child)
+    return found
+
+def memory(pid: int) -> Dict[str, int]:
+    """
+    Returns the PSS, the RSS and the peak RSS of the given process
+    in kilobytes.
+    """
+
+    result = { "pss_kb": 0, "rss_kb": 0, "peak_rss_kb": 0 }
+    try:
+        with open("/proc/%d/smaps_rollup" % pid) as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    result["pss_kb"] = int(line.split()[1])
+                elif line.startswith("Rss:"):
+                    result["rss_kb"] = int(line.split()[1])
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    result["peak_rss_kb"] = int(line.split()[1])
+    except OSError:
+        pass
+    return result
+
+def tree(pid: int) -> Dict[str, Any]:
+    """
+    Returns the memory figures of the daemon process tree.
+    """
+
+    procs = dict((p, memory(p)) for p in [pid] + children(pid))
+    return {
+        "pss_kb": sum(m["pss_kb"] for m in procs.values()),
+        "rss_kb": sum(m["rss_kb"] for m in procs.values()),
+        "processes": list(procs.values()),
+    }
+
+def run(url: str, count: int, engine: str, args: Any) -> Dict[str, Any]:
+    """
+    Runs the daemon until the first comparison has finished,
+    sampling the memory of its process tree.
+    """
+
+    hosts = ["agent-%06d.example.org" % i for i in range(count)]
+    requests.post("%s/bench/reset" % url, json = {
+        "hosts": hosts,
+        "users": ["host-" + h for h in hosts[count // 10:]],
+    }).raise_for_status()
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        daemon = subprocess.Popen(
+            [sys.executable, "-c",
+             "from icinga2_usersyncd.cli import main; main()",
+             "--no-config", "-L", url, "-u", "bench", "-p", "bench",
+             "--state-dir", state_dir, "--interval", "0",
+             "--engine", engine],
+            cwd = os.path.join(os.path.dirname(__file__), ".."),
+            stderr = subprocess.DEVNULL
+        )
+        try:
+            peak = 0
+            started = time.monotonic()
+            status = os.path.join(state_dir, STATUS_SOCKET)
+            while True:
+                if daemon.poll() is not None:
+                    raise RuntimeError("The daemon has exited with %d" % daemon.returncode)
+                if time.monotonic() - started > args.timeout:
+                    raise RuntimeError("The comparison hasn't finished in %.0f s" % args.timeout)
+                peak = max(peak, tree(daemon.pid)["pss_kb"])
+                try:
+                    if query_status(status)["comparison"]:
+                        break
+                except (OSError, ValueError):
+                    pass
+                time.sleep(args.sample)
+            elapsed = time.monotonic() - started
+
+            # Let the finished Comparator exit and the memory settle:
+            time.sleep(args.settle)
+            steady = tree(daemon.pid)
+        finally:
+            daemon.kill()
+            for pid in children(daemon.pid):
+                try:
+                    os.kill(pid, 9)
+                except OSError:
+                    pass
+            daemon.wait()
+
+    return {
+        "engine": engine,
+        "hosts": count,
+        "comparison_s": elapsed,
+        "peak_pss_kb": max(peak, steady["pss_kb"]),
+        "steady": steady,
+    }
+
+def main() -> None:
+    parser = ArgumentParser(description = __doc__)
+    parser.add_argument("--hosts", type = int, nargs = "+",
+                        default = [1000, 10000, 100000])
+    parser.add_argument("--engines", nargs = "+", choices = ENGINES,
+                        default = ENGINES)
+    parser.add_argument("--sample", type = float, default = 0.05,
+                        help = "the memory sampling interval in seconds")
+    parser.add_argument("--settle", type = float, default = 1.0,
+                        help = "seconds to wait after the comparison")
+    parser.add_argument("--timeout", type = float, default = 600.0)
+    args = parser.parse_args()
+
+    ready: Queue = Queue()
+    server = Process(target = fakeapi.serve, args = (0, ready),
+                     name = "FakeApi", daemon = True)
+    server.start()
+    url = "http://127.0.0.1:%d" % ready.get()
+
+    report = []
+    for count in args.hosts:
+        for engine in args.engines:
+            report.append(run(url, count, engine, args))
+
+    server.terminate()
+    json.dump({ "benchmark": "daemon_memory",
+                "parameters": vars(args),
+                "results": report },
+              sys.stdout, indent = 2)
+    print()
+
+if __name__ == "__main__":
+    main()
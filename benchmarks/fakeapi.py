@@ -0,0 +1,485 @@
+#!/usr/bin/python3
+
+"""
+A local stand-in for the Icinga 2 REST API used by the benchmarks.
+Implements the parts the daemon uses: object listing (streamed),
+ApiUser creation and deletion (by name and by filter), the config
+package API and the ``/v1/events`` stream, with configurable latency
+and error injection. The filters are evaluated with the daemon's own
+filter compiler.
+
+The ``/bench/*`` endpoints control the server: ``/bench/reset`` sets
+the initial objects and the injection parameters, ``/bench/hosts``
+creates and deletes Hosts emitting the events, ``/bench/stats``
+returns the request counters and latencies.
+"""
+
+import sys
+import os
+import re
+import json
+import time
+import random
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue, Empty
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from icinga2_usersyncd.filter import compile_filter, FilterError
+
+TYPES = { "hosts": "Host", "apiusers": "ApiUser", "zones": "Zone" }
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """
+    Returns the count, the average and the 50, 95 and 99 percentiles
+    of the given values.
+    """
+
+    if not values:
+        return { "count": 0 }
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return {
+        "count": len(values),
+        "avg": sum(values) / len(values),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": values[-1],
+    }
+
+def substitute(text: str, filter_vars: Optional[Dict[str, Any]]) -> str:
+    """
+    Replaces the filter variables with their JSON literals and folds
+    the string concatenations, so the filter can be compiled.
+    """
+
+    for name, value in (filter_vars or {}).items():
+        text = re.sub(r"(?<![\w.\"])%s(?![\w\"])" % re.escape(name),
+                      lambda m: json.dumps(value), text)
+    return re.sub(r'"((?:[^"\\]|\\.)*)"\s*\+\s*"((?:[^"\\]|\\.)*)"',
+                  r'"\1\2"', text)
+
+class State():
+    """
+    The objects of the fake instance and the benchmark counters.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset({})
+
+    def reset(self, params: Dict[str, Any]) -> None:
+        with self.lock:
+            self.latency = float(params.get("latency", 0.0))
+            self.jitter = float(params.get("jitter", 0.0))
+            self.error_rate = float(params.get("error_rate", 0.0))
+            self.stage_delay = float(params.get("stage_delay", 0.0))
+            self.hosts: Dict[str, Dict[str, Any]] = {}
+            self.users: Dict[str, Dict[str, Any]] = {}
+            self.packages: Dict[str, List[str]] = {}
+            self.active: Dict[str, str] = {}
+            self.stages: Dict[Tuple[str, str], Dict[str, str]] = {}
+            self.requests: Dict[str, int] = {}
+            self.errors: Dict[str, int] = {}
+            self.latencies: Dict[str, List[float]] = {}
+            self.emitted: Dict[Tuple[str, str], float] = {}
+            self.lags: List[float] = []
+            zones = params.get("zones") or ["master"]
+            for i, name in enumerate(params.get("hosts", [])):
+                self.hosts[name] = self.host(name, zones[i % len(zones)])
+            prefix = params.get("prefix", "host-")
+            for name in params.get("users", []):
+                self.users[name] = { "name": name, "package": "_api",
+                                     "client_cn": name[len(prefix):] \
+                                     if name.startswith(prefix) else name }
+            self.subscribers: List[Queue] = getattr(self, "subscribers", [])
+
+    def host(self, name: str, zone: str) -> Dict[str, Any]:
+        return { "name": name, "zone": zone, "version": time.time(),
+                 "vars": {} }
+
+    def objects(self, type_path: str) -> Dict[str, Dict[str, Any]]:
+        if type_path == "hosts":
+            return self.hosts
+        if type_path == "apiusers":
+            return self.users
+        if type_path == "zones":
+            zones = set(h["zone"] for h in self.hosts.values())
+            return dict((z, { "name": z }) for z in zones)
+        return {}
+
+    def select(self, type_path: str, filters: Optional[str],
+               filter_vars: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Returns the objects of the given type matching the filter.
+        """
+
+        objects = list(self.objects(type_path).values())
+        if not filters:
+            return objects
+
+        # The name lookups are made directly, so the server cost
+        # doesn't grow with the number of objects:
+        m = re.fullmatch(r"\s*\w+\.name in (\w+)\s*", filters)
+        if m and isinstance((filter_vars or {}).get(m.group(1)), list):
+            index = self.objects(type_path)
+            return [index[n] for n in filter_vars[m.group(1)] if n in index]
+
+        text = substitute(filters, filter_vars)
+        var = "obj" if re.search(r"\bobj\.", text) else \
+            TYPES.get(type_path, "obj").lower()
+        predicate = compile_filter(text, var)
+        return [o for o in objects if predicate is None or predicate(o)]
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        """
+        Sends the event to the subscribers, remembering the time
+        to measure the lag to the corresponding ApiUser change.
+        """
+
+        with self.lock:
+            self.emitted[(event["type"], event["object_name"])] = event["timestamp"]
+        line = json.dumps(event)
+        for q in list(self.subscribers):
+            q.put(line)
+
+    def done(self, event_type: str, host: Optional[str]) -> None:
+        emitted = self.emitted.pop((event_type, host), None)
+        if emitted:
+            self.lags.append(time.time() - emitted)
+
+    def record(self, op: str, elapsed: float, error: bool = False) -> None:
+        with self.lock:
+            self.requests[op] = self.requests.get(op, 0) + 1
+            self.latencies.setdefault(op, []).append(elapsed)
+            if error:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "latency": dict((op, percentiles(v)) \
+                                for op, v in self.latencies.items()),
+                "event_lag": percentiles(self.lags),
+                "hosts": len(self.hosts),
+                "apiusers": len(self.users),
+            }
+
+STATE = State()
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Handles the Icinga 2 API and the benchmark control requests.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def reply(self, code: int, body: Any) -> None:
+        text = isinstance(body, str)
+        data = (body if text else json.dumps(body)).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type",
+                         "text/plain" if text else "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def payload(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else b""
+        return json.loads(data) if data else {}
+
+    def do_GET(self) -> None:
+        self.dispatch("GET")
+
+    def do_POST(self) -> None:
+        self.dispatch(self.headers.get("X-HTTP-Method-Override", "POST"))
+
+    def do_PUT(self) -> None:
+        self.dispatch("PUT")
+
+    def do_DELETE(self) -> None:
+        self.dispatch("DELETE")
+
+    def dispatch(self, method: str) -> None:
+        path = self.path.split("?")[0].strip("/").split("/")
+        payload = self.payload()
+
+        if path[0] == "bench":
+            return self.control(path[1], payload)
+        if path[:2] == ["v1", "events"]:
+            return self.events(payload)
+
+        op = "%s %s" % (method, "/".join(path[1:3]))
+        started = time.monotonic()
+        if STATE.latency or STATE.jitter:
+            time.sleep(STATE.latency + random.uniform(0, STATE.jitter))
+
+        if method in ("PUT", "DELETE", "POST") and STATE.error_rate and \
+           random.random() < STATE.error_rate:
+            STATE.record(op, time.monotonic() - started, error = True)
+            return self.reply(503, { "error": 503, "status": "Service Unavailable (injected)." })
+
+        try:
+            if path[:2] == ["v1", "objects"]:
+                code, body = self.objects(method, path[2:], payload)
+            elif path[:2] == ["v1", "config"]:
+                code, body = self.config(method, path[2:], payload)
+            else:
+                code, body = 404, { "error": 404, "status": "Not found." }
+        except FilterError as ex:
+            code, body = 400, { "error": 400, "status": "Invalid filter: %s" % str(ex) }
+
+        STATE.record(op, time.monotonic() - started, error = code >= 300)
+        if isinstance(body, list):
+            return self.stream(body)
+        self.reply(code, body)
+
+    def stream(self, results: List[Dict[str, Any]]) -> None:
+        """
+        Sends a listing response in chunks, like Icinga 2 does.
+        """
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        parts = ['{"results":[']
+        for i, obj in enumerate(results):
+            parts.append(("," if i else "") + json.dumps(obj))
+            if len(parts) >= 1000:
+                self.chunk("".join(parts))
+                parts = []
+        parts.append("]}")
+        self.chunk("".join(parts))
+        self.chunk("")
+
+    def chunk(self, text: str) -> None:
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def objects(self, method: str, path: List[str],
+                payload: Dict[str, Any]) -> Tuple[int, Any]:
+        type_path, name = path[0], (path[1] if len(path) > 1 else None)
+        objects = STATE.objects(type_path)
+        type_name = TYPES.get(type_path, type_path)
+
+        if method == "GET":
+            with STATE.lock:
+                if name:
+                    selected = [objects[name]] if name in objects else []
+                else:
+                    selected = STATE.select(type_path, payload.get("filter"),
+                                            payload.get("filter_vars"))
+            attrs = payload.get("attrs")
+            return 200, [
+                { "name": o["name"], "type": type_name,
+                  "attrs": dict((k, v) for k, v in o.items() \
+                                if not attrs or k in attrs) }
+                for o in selected
+            ]
+
+        if method == "PUT" and type_path == "apiusers":
+            with STATE.lock:
+                if name in STATE.users:
+                    return 500, { "results": [{
+                        "code": 500,
+                        "errors": ["Object '%s' already exists." % name],
+                        "status": "Object could not be created."
+                    }] }
+                attrs = payload.get("attrs", {})
+                STATE.users[name] = { "name": name, "package": "_api",
+                                      "client_cn": attrs.get("client_cn") }
+                STATE.done("ObjectCreated", attrs.get("client_cn"))
+            return 200, { "results": [{ "code": 200, "status": "Object was created." }] }
+
+        if method == "DELETE" and type_path == "apiusers":
+            with STATE.lock:
+                if name:
+                    names = [name] if name in STATE.users else []
+                else:
+                    names = [o["name"] for o in STATE.select(
+                        type_path, payload.get("filter"),
+                        payload.get("filter_vars")
+                    )]
+                if not names:
+                    return 404, { "error": 404, "status": "No objects found." }
+                results = []
+                for n in names:
+                    if STATE.users[n].get("package") != "_api":
+                        results.append({ "code": 500, "name": n, "type": "ApiUser", "status": "Object cannot be deleted because it was not created using the API." })
+                        continue
+                    STATE.done("ObjectDeleted", STATE.users.pop(n)["client_cn"])
+                    results.append({ "code": 200, "name": n, "type": "ApiUser", "status": "Object was deleted." })
+            failed = [r for r in results if r["code"] != 200]
+            return (500 if failed else 200), { "results": results }
+
+        return 400, { "error": 400, "status": "Unsupported request." }
+
+    def config(self, method: str, path: List[str],
+               payload: Dict[str, Any]) -> Tuple[int, Any]:
+        if path[0] == "packages" and len(path) == 1:
+            with STATE.lock:
+                return 200, { "results": [
+                    { "name": p, "stages": [], "active-stage": STATE.active.get(p, "") }
+                    for p in STATE.packages
+                ] }
+        if path[0] == "packages":
+            with STATE.lock:
+                STATE.packages.setdefault(path[1], [])
+            return 200, { "results": [{ "code": 200, "package": path[1] }] }
+        if path[0] == "stages":
+            package = path[1]
+            conf = "".join(payload.get("files", {}).values())
+            objs = re.findall(r'object ApiUser "([^"]+)" \{[^}]*?client_cn = "([^"]*)"', conf)
+            stage = "bench-%d" % int(time.time() * 1000)
+            if STATE.stage_delay:
+                Thread(target = self.activate, args = (package, stage, objs),
+                       daemon = True).start()
+            else:
+                self.activate(package, stage, objs)
+            return 200, { "results": [{ "code": 200, "package": package, "stage": stage,
+                                        "status": "Created stage. Reload triggered." }] }
+        if path[0] == "files" and len(path) >= 4:
+            with STATE.lock:
+                result = STATE.stages.get((path[1], path[2]))
+            if result and path[3] in result:
+                return 200, result[path[3]]
+        return 404, { "error": 404, "status": "Not found." }
+
+    def activate(self, package: str, stage: str,
+                 objs: List[Tuple[str, str]]) -> None:
+        """
+        Validates the stage after ``stage_delay`` seconds like Icinga 2
+        does: an ApiUser defined elsewhere fails the validation, and
+        the previous active stage is kept. Writes the ``status`` and
+        ``startup.log`` files of the stage.
+        """
+
+        time.sleep(STATE.stage_delay)
+        with STATE.lock:
+            old = set(STATE.packages.get(package, []))
+            new = set(n for n, cn in objs)
+            dups = [n for n in new if n in STATE.users and n not in old]
+            if dups:
+                STATE.stages[(package, stage)] = {
+                    "status": "1",
+                    "startup.log": "".join(
+                        "critical/config: Error: Object '%s' of type 'ApiUser' re-defined.\n" % n
+                        for n in sorted(dups)[:10]
+                    ) + "critical/cli: Config validation failed. Re-run with 'icinga2 daemon -C' after fixing the config.\n",
+                }
+                return
+            for n in old:
+                user = STATE.users.pop(n, None)
+                if user and n not in new:
+                    STATE.done("ObjectDeleted", user["client_cn"])
+            for n, cn in objs:
+                STATE.users[n] = { "name": n, "package": package,
+                                   "client_cn": cn }
+                if n not in old:
+                    STATE.done("ObjectCreated", cn)
+            STATE.packages[package] = [n for n, cn in objs]
+            STATE.active[package] = stage
+            STATE.stages[(package, stage)] = {
+                "status": "0",
+                "startup.log": "information/cli: Finished validating the configuration file(s).\n",
+            }
+
+    def events(self, payload: Dict[str, Any]) -> None:
+        """
+        Streams the events until the client disconnects or the
+        stream is closed with ``/bench/hosts {"close": true}``.
+        """
+
+        q: Queue = Queue()
+        STATE.subscribers.append(q)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    line = q.get(timeout = 1.0)
+                except Empty:
+                    continue
+                if line is None:
+                    break
+                lines = [line]
+                while len(lines) < 1000:
+                    try:
+                        line = q.get_nowait()
+                    except Empty:
+                        break
+                    if line is None:
+                        q.put(None)
+                        break
+                    lines.append(line)
+                self.chunk("".join(l + "\n" for l in lines))
+            self.chunk("")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            STATE.subscribers.remove(q)
+
+    def control(self, command: str, payload: Dict[str, Any]) -> None:
+        if command == "reset":
+            STATE.reset(payload)
+            return self.reply(200, { "hosts": len(STATE.hosts),
+                                     "apiusers": len(STATE.users) })
+        if command == "hosts":
+            now = time.time()
+            for name in payload.get("create", []):
+                with STATE.lock:
+                    STATE.hosts[name] = STATE.host(name, payload.get("zone", "master"))
+                STATE.emit({ "type": "ObjectCreated", "object_type": "Host",
+                             "object_name": name, "timestamp": now })
+            for name in payload.get("delete", []):
+                with STATE.lock:
+                    STATE.hosts.pop(name, None)
+                STATE.emit({ "type": "ObjectDeleted", "object_type": "Host",
+                             "object_name": name, "timestamp": now })
+            if payload.get("close"):
+                for q in list(STATE.subscribers):
+                    q.put(None)
+            return self.reply(200, { "subscribers": len(STATE.subscribers) })
+        if command == "stats":
+            return self.reply(200, STATE.stats())
+        self.reply(404, { "error": 404 })
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def serve(port: int = 0, ready: Optional[Any] = None) -> None:
+    """
+    Runs the server. Puts the port into the ``ready`` queue once
+    it's listening.
+    """
+
+    server = Server(("127.0.0.1", port), Handler)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "A fake Icinga 2 API server.")
+    parser.add_argument("--port", type = int, default = 5665)
+    args = parser.parse_args()
+    print("Listening on http://127.0.0.1:%d/" % args.port)
+    serve(args.port)
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+"""
+Compares the memory used by the set of known host names with the
+HostIndex. Prints a JSON report.
+"""
+
+import sys
+import os
+import gc
+import json
+import time
+import tracemalloc
+import random
+import mmap
+from argparse import ArgumentParser
+from typing import Callable, Iterator, List, Dict, Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from icinga2_usersyncd.hostindex import HostIndex
+
+def iter_names(count: int) -> Iterator[str]:
+    """
+    Generates new host name objects each time, as they are when
+    parsed from an API response.
+    """
+
+    rnd = random.Random(count)
+    for i in range(count):
+        yield "agent-%06d.%s.dc%d.example.org" % (
+            i, rnd.choice(["web", "db", "cache", "queue", "storage"]),
+            rnd.randrange(10)
+        )
+
+def measure(build: Callable[[], Any], names: List[str]) -> Dict[str, Any]:
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    index = build()
+    build_time = time.perf_counter() - started
+    heap, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # The shared map isn't allocated on the Python heap, and only
+    # the pages in use are (the header and the base):
+    mapped = mmap.PAGESIZE + len(index) * 8 \
+        if isinstance(index, HostIndex) else 0
+
+    probes = names[::max(1, len(names) // 10000)]
+    started = time.perf_counter()
+    for n in probes:
+        assert n in index
+    lookup_time = time.perf_counter() - started
+
+    return {
+        "bytes": heap + mapped,
+        "bytes_per_host": (heap + mapped) / len(names),
+        "peak_heap_bytes": peak,
+        "build_s": build_time,
+        "lookup_us": lookup_time / len(probes) * 1e6,
+    }
+
+def main() -> None:
+    parser = ArgumentParser(description = __doc__)
+    parser.add_argument("--hosts", type = int, nargs = "+",
+                        default = [1000, 10000, 100000])
+    args = parser.parse_args()
+
+    report = []
+    for count in args.hosts:
+        names = list(iter_names(count))
+        report.append({
+            "hosts": count,
+            "set": measure(lambda: set(iter_names(count)), names),
+            "hostindex": measure(lambda: HostIndex(iter_names(count)), names),
+        })
+
+    json.dump({ "benchmark": "hostindex_memory", "results": report },
+              sys.stdout, indent = 2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+"""
+Replays a recorded event stream (see ``icinga2-usersyncd --record``)
+against the fake Icinga 2 API server for each combination of the
+given batching and concurrency settings. Prints a JSON report with
+the processing rate and the ApiUser request latencies of each run.
+
+The fake instance is preloaded with the Hosts (and their ApiUsers)
+that are deleted before being created in the file, as they existed
+before the recording. The Host filter, if any, should refer to the
+Host names only: the created Hosts aren't known to the fake instance.
+Without a file, a synthetic storm is generated: a deploy of new Hosts
+or a decommission of existing ones.
+"""
+
+import sys
+import os
+import io
+import json
+import gzip
+import time
+import logging
+import tempfile
+import itertools
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from typing import Any, Dict, List, Tuple
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from icinga2_usersyncd.daemon import Daemon
+from icinga2_usersyncd.logging import logger
+
+import fakeapi
+
+def generate(path: str, kind: str, count: int, rate: float) -> None:
+    """
+    Writes a synthetic storm of ``count`` Host events emitted at
+    ``rate`` events per second.
+    """
+
+    started = time.time()
+    event_type = "ObjectCreated" if kind == "deploy" else "ObjectDeleted"
+    with gzip.open(path, "wt", encoding = "utf-8") as f:
+        for i in range(count):
+            f.write(json.dumps({
+                "type": event_type,
+                "object_type": "Host",
+                "object_name": "%s-%06d.example.org" % (kind, i),
+                "timestamp": started + i / rate,
+            }) + "\n")
+
+def preload(path: str, prefix: str) -> Tuple[List[str], List[str]]:
+    """
+    Returns the Hosts and the ApiUsers the fake instance should
+    have before the replay.
+    """
+
+    first: Dict[str, str] = {}
+    with gzip.open(path, "rt", encoding = "utf-8") as f:
+        for line in f:
+            if line.strip():
+                e = json.loads(line)
+                first.setdefault(e["object_name"], e["type"])
+    hosts = [n for n, t in first.items() if t == "ObjectDeleted"]
+    return hosts, [prefix + n for n in hosts]
+
+def run(url: str, path: str, settings: Dict[str, Any], speed: float,
+        out: Queue) -> None:
+    logger.setLevel(logging.ERROR)
+    hosts, users = preload(path, "host-")
+    requests.post(url + "/bench/reset",
+                  json = { "hosts": hosts, "users": users }).raise_for_status()
+    daemon = Daemon(url = url, username = "bench", password = "bench",
+                    state_dir = "", **settings)
+    report = daemon.replay(path, speed, out = io.StringIO())
+    report["server"] = requests.post(url + "/bench/stats").json()
+    out.put(report)
+
+def main() -> None:
+    parser = ArgumentParser(description = __doc__)
+    parser.add_argument("file", nargs = "?",
+                        help = "a recorded event stream")
+    parser.add_argument("--generate", choices = ["deploy", "decommission"],
+                        default = "deploy",
+                        help = "a synthetic storm to replay without a file")
+    parser.add_argument("--events", type = int, default = 10000)
+    parser.add_argument("--rate", type = float, default = 1000.0,
+                        help = "a number of synthetic events per second")
+    parser.add_argument("--speed", type = float, default = 1.0,
+                        help = "0 replays as fast as possible")
+    parser.add_argument("--workers", type = int, nargs = "+", default = [4])
+    parser.add_argument("--event-window", type = float, nargs = "+",
+                        default = [0.5])
+    parser.add_argument("--event-batch", type = int, nargs = "+",
+                        default = [100])
+    parser.add_argument("--write-concurrency", type = int, nargs = "+",
+                        default = [8])
+    parser.add_argument("--timeout", type = float, default = 600.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if not path:
+            path = os.path.join(tmp, "events.jsonl.gz")
+            generate(path, args.generate, args.events, args.rate)
+
+        ready: Queue = Queue()
+        server = Process(target = fakeapi.serve, args = (0, ready),
+                         name = "FakeApi", daemon = True)
+        server.start()
+        url = "http://127.0.0.1:%d" % ready.get()
+
+        results = []
+        for workers, window, batch, concurrency in itertools.product(
+            args.workers, args.event_window, args.event_batch,
+            args.write_concurrency
+        ):
+            settings = {
+                "workers": workers,
+                "event_window": window,
+                "event_batch": batch,
+                "write_concurrency": concurrency,
+            }
+            out: Queue = Queue()
+            p = Process(target = run,
+                        args = (url, path, settings, args.speed, out))
+            p.start()
+            report = out.get(timeout = args.timeout)
+            p.join()
+            results.append({ "settings": settings, **report })
+
+        server.terminate()
+
+    json.dump({ "benchmark": "replay",
+                "source": args.file or args.generate,
+                "results": results },
+              sys.stdout, indent = 2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+"""
+Runs the ApiUserManager, the Comparator and the EventListener
+against the fake Icinga 2 API server (see ``fakeapi.py``) at the
+given scales. Prints a JSON report with the throughput, the
+per-operation latency percentiles (measured by the daemon side and
+by the server) and the peak memory of each scenario.
+
+Each scenario runs in a separate process, so the peak RSS reflects
+that scenario only.
+"""
+
+import sys
+import os
+import json
+import time
+import resource
+import logging
+import tempfile
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from multiprocessing import Process, Queue
+from threading import Thread, Lock
+from typing import Any, Callable, Dict, List
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from icinga2_usersyncd.daemon import Daemon
+from icinga2_usersyncd.logging import logger
+
+import fakeapi
+
+SCENARIOS = ["apiuser", "comparator", "events"]
+
+class Bench():
+    """
+    Drives the daemon components against the fake server and
+    collects the client-side latencies.
+    """
+
+    def __init__(self, url: str, args: Any):
+        self.url = url
+        self.args = args
+        self.samples: Dict[str, List[float]] = {}
+        self.lock = Lock()
+
+    def control(self, command: str, **payload: Any) -> Dict[str, Any]:
+        r = requests.post("%s/bench/%s" % (self.url, command), json = payload)
+        r.raise_for_status()
+        return r.json()
+
+    def daemon(self, state_dir: str) -> Daemon:
+        daemon = Daemon(url = self.url,
+                        username = "bench",
+                        password = "bench",
+                        workers = self.args.workers,
+                        state_dir = state_dir,
+                        interval = 0,
+                        event_window = self.args.event_window,
+                        write_concurrency = self.args.write_concurrency)
+        daemon.open_state()
+        self.timed(daemon.userManager, "add_api_user")
+        self.timed(daemon.userManager, "del_api_user")
+        self.timed(daemon.userManager, "del_api_users")
+        return daemon
+
+    def timed(self, obj: Any, method: str) -> None:
+        """
+        Replaces the given method of the object with a wrapper that
+        records the call durations.
+        """
+
+        proc = getattr(obj, method)
+        samples = self.samples.setdefault(method, [])
+
+        @wraps(proc)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return proc(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    samples.append(elapsed)
+
+        setattr(obj, method, wrapper)
+
+    def wait(self, predicate: Callable[[Dict[str, Any]], bool],
+             timeout: float) -> Dict[str, Any]:
+        deadline = time.monotonic() + timeout
+        while True:
+            stats = self.control("stats")
+            if predicate(stats) or time.monotonic() >= deadline:
+                return stats
+            time.sleep(0.05)
+
+    def apiuser(self, hosts: List[str], state_dir: str) -> Dict[str, Any]:
+        """
+        Creates an ApiUser for each host with parallel requests, then
+        deletes them all in batches.
+        """
+
+        self.control("reset", hosts = hosts, **self.injection())
+        manager = self.daemon(state_dir).userManager
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = self.args.workers) as pool:
+            list(pool.map(manager.add_api_user, hosts))
+        created = time.perf_counter() - started
+
+        started = time.perf_counter()
+        manager.del_api_users(hosts)
+        deleted = time.perf_counter() - started
+
+        return {
+            "create_ops_per_s": len(hosts) / created,
+            "delete_ops_per_s": len(hosts) / deleted,
+            "elapsed_s": created + deleted,
+        }
+
+    def comparator(self, hosts: List[str], state_dir: str) -> Dict[str, Any]:
+        """
+        Runs the initial comparison with no ApiUsers at all, then a
+        comparison after a tenth of the hosts were replaced.
+        """
+
+        self.control("reset", hosts = hosts, **self.injection())
+        daemon = self.daemon(state_dir)
+
+        report = {}
+        for phase, changed in (("initial", len(hosts)), ("drift", 0)):
+            if phase == "drift":
+                churn = max(1, len(hosts) // 10)
+                self.control("hosts",
+                             delete = hosts[:churn],
+                             create = ["new-" + h for h in hosts[:churn]])
+                changed = 2 * churn
+            comparator = daemon.make_comparator()
+            self.timed(comparator, "list_names")
+            started = time.perf_counter()
+            comparator.run()
+            elapsed = time.perf_counter() - started
+            report[phase] = {
+                "changes": changed,
+                "elapsed_s": elapsed,
+                "changes_per_s": changed / elapsed,
+                "hosts_per_s": len(hosts) / elapsed,
+            }
+        return report
+
+    def events(self, hosts: List[str], state_dir: str) -> Dict[str, Any]:
+        """
+        Connects the EventListener to an instance with ApiUsers for
+        all hosts and emits an event storm: a burst of created hosts
+        and a burst of deleted ones.
+        """
+
+        users = ["host-" + h for h in hosts]
+        self.control("reset", hosts = hosts, users = users, **self.injection())
+        daemon = self.daemon(state_dir)
+        listener = daemon.make_listener()
+        listener.connect()
+        thread = Thread(target = listener.run, name = "EventListener",
+                        daemon = True)
+        thread.start()
+        self.wait(lambda s: s["requests"], 5.0)
+
+        storm = max(1, int(len(hosts) * self.args.storm))
+        created = ["storm-" + h for h in hosts[:storm]]
+        deleted = hosts[:storm]
+        expected = len(users)
+
+        started = time.perf_counter()
+        for i in range(0, storm, 1000):
+            self.control("hosts", create = created[i:i + 1000],
+                         delete = deleted[i:i + 1000])
+        stats = self.wait(lambda s: s["event_lag"]["count"] >= 2 * storm,
+                          self.args.timeout)
+        elapsed = time.perf_counter() - started
+
+        self.control("hosts", close = True)
+        thread.join(self.args.timeout)
+
+        return {
+            "events": 2 * storm,
+            "elapsed_s": elapsed,
+            "events_per_s": 2 * storm / elapsed,
+            "converged": stats["event_lag"]["count"] >= 2 * storm and \
+                stats["apiusers"] == expected,
+            "event_lag": stats["event_lag"],
+        }
+
+    def injection(self) -> Dict[str, Any]:
+        return {
+            "latency": self.args.latency,
+            "jitter": self.args.jitter,
+            "error_rate": self.args.error_rate,
+        }
+
+def iter_hosts(count: int) -> List[str]:
+    return ["agent-%06d.example.org" % i for i in range(count)]
+
+def scenario(name: str, count: int, url: str, args: Any, out: Queue) -> None:
+    """
+    Runs a single scenario and puts its report into the queue.
+    """
+
+    logger.setLevel(logging.ERROR)
+    bench = Bench(url, args)
+    with tempfile.TemporaryDirectory() as state_dir:
+        result = getattr(bench, name)(iter_hosts(count), state_dir)
+    result["latency"] = dict((op, fakeapi.percentiles(v)) \
+                             for op, v in bench.samples.items() if v)
+    result["server"] = bench.control("stats")
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    out.put(result)
+
+def main() -> None:
+    parser = ArgumentParser(description = __doc__)
+    parser.add_argument("--hosts", type = int, nargs = "+",
+                        default = [1000, 10000, 100000])
+    parser.add_argument("--scenarios", nargs = "+", choices = SCENARIOS,
+                        default = SCENARIOS)
+    parser.add_argument("--workers", type = int, default = 4)
+    parser.add_argument("--write-concurrency", type = int, default = 8)
+    parser.add_argument("--event-window", type = float, default = 0.5)
+    parser.add_argument("--storm", type = float, default = 0.1,
+                        help = "a fraction of hosts to create and delete in the event storm")
+    parser.add_argument("--latency", type = float, default = 0.0,
+                        help = "injected server latency in seconds")
+    parser.add_argument("--jitter", type = float, default = 0.0,
+                        help = "injected random latency in seconds")
+    parser.add_argument("--error-rate", type = float, default = 0.0,
+                        help = "a fraction of write requests failing with 503")
+    parser.add_argument("--timeout", type = float, default = 600.0)
+    args = parser.parse_args()
+
+    ready: Queue = Queue()
+    server = Process(target = fakeapi.serve, args = (0, ready),
+                     name = "FakeApi", daemon = True)
+    server.start()
+    url = "http://127.0.0.1:%d" % ready.get()
+
+    report = []
+    for count in args.hosts:
+        for name in args.scenarios:
+            out: Queue = Queue()
+            p = Process(target = scenario, args = (name, count, url, args, out))
+            p.start()
+            result = out.get(timeout = args.timeout)
+            p.join()
+            report.append({ "scenario": name, "hosts": count, **result })
+
+    server.terminate()
+    json.dump({ "benchmark": "sync",
+                "parameters": vars(args),
+                "results": report },
+              sys.stdout, indent = 2)
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -58,6 +58,8 @@ mkdir -p %buildroot%_unitdir
 mv -v %buildroot%python3_sitelibdir_noarch/%oname/%name.service \
       %buildroot%_unitdir/%name.service
 
+mkdir -p %buildroot%_localstatedir/%name
+
 # Create empty files for %%ghost:
 mkdir -p %buildroot%_localstatedir/icinga2/certs
 touch %buildroot%_localstatedir/icinga2/certs/icinga2-usersyncd.key
@@ -74,6 +76,7 @@ touch %buildroot%_localstatedir/icinga2/certs/icinga2-usersyncd.crt
 %config(noreplace) %_sysconfdir/sysconfig/%name
 %_man1dir/%name.1.*
 %_unitdir/%name.service
+%dir %_localstatedir/%name
 %ghost /var/lib/icinga2/certs/icinga2-usersyncd.key
 %ghost /var/lib/icinga2/certs/icinga2-usersyncd.req
 %ghost /var/lib/icinga2/certs/icinga2-usersyncd.crt
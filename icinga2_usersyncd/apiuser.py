@@ -23,10 +23,25 @@ Host agents on an Icinga 2 instance. This module defines functions
 to manage ApiUser objects on the Icinga 2.
 """
 
-from typing import Sequence, Optional
+from typing import Sequence, Optional, Iterable, Dict, List, ContextManager
 from icinga2apic.client import Client # type: ignore
+from icinga2apic.exceptions import Icinga2ApiRequestException # type: ignore
 from .logging import logger
-from .constants import DEFAULT_PREFIX, DEFAULT_TEMPLATES
+from .ratelimit import AdaptiveLimiter, already_exists
+from .registry import OpRegistry
+from .metrics import Metrics
+from .diff import ADD, DELETE
+from contextlib import nullcontext
+from .constants import DEFAULT_PREFIX, DEFAULT_TEMPLATES, DEFAULT_BATCH_SIZE
+
+def not_found(ex: Icinga2ApiRequestException) -> bool:
+    """
+    Tells whether the request has failed because the object
+    doesn't exist: Icinga 2 responds with the 404 error then.
+    """
+
+    response = ex.response if isinstance(ex.response, dict) else {}
+    return response.get("error") == 404
 
 class ApiUserManager():
     """
@@ -36,7 +51,11 @@ class ApiUserManager():
 
     def __init__(self, client:Client,
                  prefix: Optional[str] = None,
-                 templates: Optional[Sequence[str]] = None):
+                 templates: Optional[Sequence[str]] = None,
+                 batch_size: Optional[int] = None,
+                 limiter: Optional[AdaptiveLimiter] = None,
+                 registry: Optional[OpRegistry] = None,
+                 metrics: Optional[Metrics] = None):
         """
         Configures the manager to use the given client,
         given user name prefix and a set of user permissions.
@@ -49,35 +68,101 @@ class ApiUserManager():
         :param templates: A set of custom templates the created
             ApiUser object should import. The  default value is
             "usersync".
+
+        :param batch_size: A maximum number of ApiUser objects
+            to delete with a single request. The default is 500.
+
+        :param limiter: An optional rate and concurrency limiter
+            for the requests.
+
+        :param registry: An optional registry of the in-flight and
+            recent operations to skip the duplicate ones.
+
+        :param metrics: Optional metrics to count the created and
+            deleted users in.
         """
 
         self.client = client
         self.prefix = prefix or DEFAULT_PREFIX
         self.templates = templates or DEFAULT_TEMPLATES
+        self.batch_size = max(1, batch_size or DEFAULT_BATCH_SIZE)
+        self.limiter = limiter
+        self.registry = registry
+        self.metrics = metrics
+
+    def request(self) -> ContextManager:
+        """
+        Returns a context to make a single request in: a limited
+        one if the limiter is set.
+        """
+
+        return self.limiter.request() if self.limiter else nullcontext()
+
+    def claim(self, op: str, hostname: str) -> bool:
+        """
+        Registers the operation in the registry, if any. Returns
+        False if it's a duplicate to skip.
+        """
+
+        if self.registry and not self.registry.claim(op, hostname):
+            logger.debug(f"[ApiUser] Skipping %s request for API user '%s': already made." % (op, self.prefix + hostname))
+            return False
+        return True
+
+    def finish(self, op: str, hostname: str) -> None:
+        """
+        Unregisters the finished operation from the registry, if
+        any.
+        """
+
+        if self.registry:
+            self.registry.finish(op, hostname)
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Increments the given counter of the metrics, if any.
+        """
+
+        if self.metrics and value:
+            self.metrics.inc(name, value)
 
     def add_api_user(self, hostname: str) -> None:
         """
         Sends request to Icinga 2 to add ApiUser for the
-        host with the given name.
+        host with the given name. An existing ApiUser isn't an
+        error. Does nothing if the same request is in flight.
 
         :param hostname: The name of the host to add an ApiUser
             to create the ApiUser object for.
         """
 
+        if not self.claim(ADD, hostname):
+            return
+
         logger.debug(f"[ApiUser] Sending create request for API user '%s' for host '%s'..." % ((self.prefix + hostname), hostname))
 
-        resp = self.client.objects.create(
-            "ApiUser", self.prefix + hostname,
-            templates = self.templates,
-            attrs = {
-                "client_cn": hostname
-            }
-        )
+        try:
+            with self.request():
+                resp = self.client.objects.create(
+                    "ApiUser", self.prefix + hostname,
+                    templates = self.templates,
+                    attrs = {
+                        "client_cn": hostname
+                    }
+                )
+            self.count("apiusers_created_total")
+        except Icinga2ApiRequestException as ex:
+            if not already_exists(ex, self.prefix + hostname):
+                raise
+            logger.debug(f"[ApiUser] API user '%s' already exists." % (self.prefix + hostname))
+        finally:
+            self.finish(ADD, hostname)
 
     def del_api_user(self, hostname: str) -> None:
         """
         Sends request to Icinga 2 to delete ApiUser for host
-        with the given name.
+        with the given name. A missing ApiUser isn't an error.
+        Does nothing if the same request is in flight.
 
         :param client: An Icinga 2 client object.
 
@@ -85,8 +170,124 @@ class ApiUserManager():
             object for.
         """
 
+        if not self.claim(DELETE, hostname):
+            return
+
+        self._del_api_user(hostname)
+
+    def _del_api_user(self, hostname: str) -> None:
+        """
+        Deletes the ApiUser for the host with the given name, which
+        delete operation is already claimed.
+        """
+
         logger.debug(f"[ApiUser] Sending delete request for API user '%s'..." % (self.prefix + hostname))
 
-        resp = self.client.objects.delete(
-            "ApiUser", self.prefix + hostname
-        )
+        try:
+            with self.request():
+                resp = self.client.objects.delete(
+                    "ApiUser", self.prefix + hostname
+                )
+            self.count("apiusers_deleted_total")
+        except Icinga2ApiRequestException as ex:
+            if not not_found(ex):
+                raise
+            logger.debug(f"[ApiUser] API user '%s' doesn't exist." % (self.prefix + hostname))
+        finally:
+            self.finish(DELETE, hostname)
+
+    def del_api_users(self, hostnames: Iterable[str]) -> Dict[str, Exception]:
+        """
+        Deletes ApiUser objects for the hosts with the given names.
+        The names are split into batches of ``batch_size`` and each
+        batch is deleted with a single filtered request. The users
+        a batch fails to delete are then deleted one by one.
+
+        :param hostnames: The names of the hosts to delete the
+            ApiUser objects for.
+
+        :return: A dictionary of errors for the hosts which ApiUser
+            objects could not be deleted. Empty on success.
+        """
+
+        errors: Dict[str, Exception] = {}
+        batch: List[str] = []
+
+        for hostname in hostnames:
+            if not self.claim(DELETE, hostname):
+                continue
+            batch.append(hostname)
+            if len(batch) >= self.batch_size:
+                errors.update(self._del_api_user_batch(batch))
+                batch = []
+
+        if batch:
+            errors.update(self._del_api_user_batch(batch))
+
+        return errors
+
+    def _del_api_user_batch(self, hostnames: List[str]) -> Dict[str, Exception]:
+        """
+        Deletes ApiUser objects for a single batch of hosts, which
+        delete operations are already claimed, making per-object
+        retries for the users the batch request has failed to delete.
+        """
+
+        if len(hostnames) == 1:
+            try:
+                self._del_api_user(hostnames[0])
+                return {}
+            except Exception as ex:
+                return { hostnames[0]: ex }
+
+        logger.debug(f"[ApiUser] Sending delete request for %d API users..." % len(hostnames))
+
+        retry: Sequence[str]
+        deleted = 0
+        try:
+            with self.request():
+                self.client.objects.delete(
+                    "ApiUser",
+                    filters = "obj.name in names",
+                    filter_vars = {
+                        "names": [self.prefix + h for h in hostnames]
+                    }
+                )
+            for hostname in hostnames:
+                self.finish(DELETE, hostname)
+            self.count("apiusers_deleted_total", len(hostnames))
+            return {}
+        except Icinga2ApiRequestException as ex:
+            response = ex.response if isinstance(ex.response, dict) else {}
+            results = response.get("results")
+            if results:
+                failed = set([r.get("name") for r in results \
+                              if not 200 <= int(r.get("code", 500)) <= 299])
+                retry = [h for h in hostnames if (self.prefix + h) in failed]
+                deleted = len(results) - len(failed)
+            elif response.get("error") == 404:
+                # None of the users exist: nothing to delete.
+                for hostname in hostnames:
+                    self.finish(DELETE, hostname)
+                return {}
+            else:
+                retry = hostnames
+            logger.warning(f"[ApiUser] Batch delete partly failed: %s. Retrying %d API users one by one..." % (str(ex), len(retry)))
+        except Exception as ex:
+            retry = hostnames
+            logger.warning(f"[ApiUser] Batch delete failed: %s. Retrying %d API users one by one..." % (str(ex), len(retry)))
+
+        retried = set(retry)
+        for hostname in hostnames:
+            if hostname not in retried:
+                self.finish(DELETE, hostname)
+        self.count("apiusers_deleted_total", deleted)
+
+        errors: Dict[str, Exception] = {}
+        for hostname in retry:
+            try:
+                self._del_api_user(hostname)
+            except Exception as ex:
+                errors[hostname] = ex
+
+        return errors
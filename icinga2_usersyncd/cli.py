@@ -26,7 +26,7 @@ command-line interface to the daemon and provides the entry-point
 
 from .daemon import Daemon
 from .logging import logger, logging
-from .constants import VERSION_INFO, CONFIG, DEFAULT_QUEUE, DEFAULT_PREFIX, DEFAULT_TEMPLATES, DEFAULT_DELAY, SETUP_SCRIPT
+from .constants import VERSION_INFO, CONFIG, DEFAULT_QUEUE, DEFAULT_PREFIX, DEFAULT_TEMPLATES, DEFAULT_DELAY, DEFAULT_WORKERS, DEFAULT_BATCH_SIZE, BULK_MODES, DEFAULT_BULK_MODE, DEFAULT_EVENT_WINDOW, DEFAULT_EVENT_BATCH, DEFAULT_BACKLOG, ENGINES, DEFAULT_ENGINE, DEFAULT_POOL_SIZE, DEFAULT_STATE_DIR, DEFAULT_INTERVAL, DEFAULT_WRITE_CONCURRENCY, DEFAULT_REPLAY_SPEED, SETUP_SCRIPT
 import sys
 import signal
 from argparse import ArgumentParser
@@ -138,6 +138,105 @@ Written by Paul Wolneykien.
                         action = 'store',
                         help = f"a number of seconds to wait between connection attempts (the default is either from the config or %d if omitted)" % DEFAULT_DELAY)
 
+    parser.add_argument('-j', '--workers', dest = 'workers',
+                        action = 'store', type = int,
+                        help = f"a number of ApiUser requests to run in parallel (the default is either from the config or %d if omitted)" % DEFAULT_WORKERS)
+
+    parser.add_argument('-b', '--batch-size', dest = 'batch_size',
+                        action = 'store', type = int,
+                        help = f"a maximum number of ApiUser objects to delete with a single request (the default is either from the config or %d if omitted)" % DEFAULT_BATCH_SIZE)
+
+    parser.add_argument('--bulk-mode', dest = 'bulk_mode',
+                        action = 'store', choices = BULK_MODES,
+                        help = f"create missing ApiUsers one by one ('object') or deploy them as a config package ('package') while synchronizing (the default is either from the config or '%s' if omitted)" % DEFAULT_BULK_MODE)
+
+    parser.add_argument('--partitions', dest = 'partitions',
+                        action = 'store',
+                        help = "list Hosts in concurrent partitions: 'zone', 'prefix:N' or a Host filter string (the default is either from the config or no partitioning if omitted)")
+
+    parser.add_argument('-w', '--event-window', dest = 'event_window',
+                        action = 'store', type = float,
+                        help = f"a number of seconds to collect Host events for before processing them as a batch (the default is either from the config or %s if omitted)" % DEFAULT_EVENT_WINDOW)
+
+    parser.add_argument('-B', '--event-batch', dest = 'event_batch',
+                        action = 'store', type = int,
+                        help = f"a maximum number of Host events to process as a batch (the default is either from the config or %d if omitted)" % DEFAULT_EVENT_BATCH)
+
+    parser.add_argument('--backlog', dest = 'backlog',
+                        action = 'store', type = int,
+                        help = f"a maximum number of Host events and ApiUser requests waiting to be processed before reading of the event stream is paused until a half of the events are processed (the default is either from the config or %d if omitted)" % DEFAULT_BACKLOG)
+
+    parser.add_argument('--engine', dest = 'engine',
+                        action = 'store', choices = ENGINES,
+                        help = f"run the event listener and the comparator in forked processes ('process') or in threads of a single process ('thread') (the default is either from the config or '%s' if omitted)" % DEFAULT_ENGINE)
+
+    parser.add_argument('--pool-size', dest = 'pool_size',
+                        action = 'store', type = int,
+                        help = f"a maximum number of persistent connections to the Icinga 2 API shared by all requests (the default is either from the config or %d if omitted)" % DEFAULT_POOL_SIZE)
+
+    parser.add_argument('--state-dir', dest = 'state_dir',
+                        action = 'store',
+                        help = f"a directory to keep the snapshot of the known Hosts and ApiUsers in; an empty value disables the snapshot (the default is either from the config or '%s' if omitted)" % DEFAULT_STATE_DIR)
+
+    parser.add_argument('-i', '--interval', dest = 'interval',
+                        action = 'store', type = float,
+                        help = f"a number of seconds between periodic comparisons of Hosts and ApiUsers; 0 disables them (the default is either from the config or %d if omitted)" % DEFAULT_INTERVAL)
+
+    parser.add_argument('--max-rps', dest = 'max_rps',
+                        action = 'store', type = float,
+                        help = "a maximum number of Icinga 2 API requests per second made by the comparator (the default is either from the config or no limit if omitted)")
+
+    parser.add_argument('--max-writes', dest = 'max_writes',
+                        action = 'store', type = int,
+                        help = "a maximum number of ApiUsers to add or delete in a single comparison, the rest is left to the next one (the default is either from the config or no limit if omitted)")
+
+    parser.add_argument('--write-rate', dest = 'write_rate',
+                        action = 'store', type = float,
+                        help = "a maximum number of ApiUser requests per second made by the comparator and the event listener together (the default is either from the config or no limit if omitted)")
+
+    parser.add_argument('--write-concurrency', dest = 'write_concurrency',
+                        action = 'store', type = int,
+                        help = f"a maximum number of ApiUser requests in flight; the limit is lowered automatically while Icinga 2 responds slowly or with overload errors (the default is either from the config or %d if omitted)" % DEFAULT_WRITE_CONCURRENCY)
+
+    parser.add_argument('--metrics-port', dest = 'metrics_port',
+                        action = 'store', type = int,
+                        help = "a local port to serve the metrics in the Prometheus text format on (the default is either from the config or no metrics endpoint if omitted)")
+
+    parser.add_argument('--shard-index', dest = 'shard_index',
+                        action = 'store', type = int,
+                        help = "the zero-based index of the Hosts shard handled by this instance (the default is either from the config or 0 if omitted)")
+
+    parser.add_argument('--shard-count', dest = 'shard_count',
+                        action = 'store', type = int,
+                        help = "a number of daemon instances sharing the Hosts by the consistent hash of the Host name; each instance still receives the whole event stream and lists all the Hosts and ApiUsers (the default is either from the config or 1 if omitted)")
+
+    parser.add_argument('--record', dest = 'record',
+                        action = 'store', metavar = 'FILE',
+                        help = "append the raw Host events received to the given gzip-compressed JSON lines file for a later replay")
+
+    parser.add_argument('--replay', dest = 'replay',
+                        action = 'store', metavar = 'FILE',
+                        help = "feed the events recorded with --record into the event listener, print the processing rate and the ApiUser request latencies as JSON and exit")
+
+    parser.add_argument('--speed', dest = 'speed',
+                        action = 'store', type = float,
+                        help = f"the replay speed relative to the recorded pace; 0 replays as fast as possible (the default is %s)" % DEFAULT_REPLAY_SPEED)
+
+    parser.add_argument('--plan',
+                        dest = 'do_plan',
+                        action = 'store_true',
+                        help = 'print the ApiUsers to add and delete along with the timings and exit without making any changes')
+
+    parser.add_argument('--retry-queue',
+                        dest = 'do_retries',
+                        action = 'store_true',
+                        help = 'print the pending and dead-lettered ApiUser operations of the retry queue and exit')
+
+    parser.add_argument('--status',
+                        dest = 'do_status',
+                        action = 'store_true',
+                        help = 'print the sync lag, the high-water mark of the processed Host events, the queue depth and the last comparison result of the running daemon and exit')
+
     parser.add_argument('--setup',
                         dest = 'do_setup',
                         action = 'store_true',
@@ -151,17 +250,47 @@ Written by Paul Wolneykien.
         sys.exit(os.system(SETUP_SCRIPT))
 
     try:
-        Daemon(config_file = args.config,
-               url = args.url,
-               username = args.username,
-               password = args.password,
-               certificate = args.cert,
-               key = args.key,
-               ca_certificate = args.ca_cert,
-               queue = args.queue,
-               prefix = args.prefix,
-               templates = args.templates,
-               filter = args.filter,
-               delay = args.delay).run()
+        daemon = Daemon(config_file = args.config,
+                        url = args.url,
+                        username = args.username,
+                        password = args.password,
+                        certificate = args.cert,
+                        key = args.key,
+                        ca_certificate = args.ca_cert,
+                        queue = args.queue,
+                        prefix = args.prefix,
+                        templates = args.templates,
+                        filter = args.filter,
+                        delay = args.delay,
+                        workers = args.workers,
+                        batch_size = args.batch_size,
+                        bulk_mode = args.bulk_mode,
+                        partitions = [args.partitions] if args.partitions else None,
+                        event_window = args.event_window,
+                        event_batch = args.event_batch,
+                        backlog = args.backlog,
+                        engine = args.engine,
+                        pool_size = args.pool_size,
+                        state_dir = args.state_dir,
+                        interval = args.interval,
+                        max_rps = args.max_rps,
+                        max_writes = args.max_writes,
+                        write_rate = args.write_rate,
+                        write_concurrency = args.write_concurrency,
+                        record = args.record,
+                        metrics_port = args.metrics_port,
+                        shard_index = args.shard_index,
+                        shard_count = args.shard_count)
+        if args.do_plan:
+            daemon.plan()
+        elif args.do_retries:
+            daemon.show_retries()
+        elif args.do_status:
+            if not daemon.status():
+                sys.exit(1)
+        elif args.replay:
+            daemon.replay(args.replay, args.speed)
+        else:
+            daemon.run()
     except KeyboardInterrupt:
         pass
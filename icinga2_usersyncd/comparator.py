@@ -24,23 +24,75 @@ Comparator that synchronizes ApiUser records with all Host objects,
 that are configured on the Icinga 2 server.
 """
 
-from typing import Optional, Generator
+from typing import Optional, Generator, Iterable, Iterator, Tuple, List, Dict, Set, Sequence, TextIO, Any
 from icinga2apic.client import Client # type: ignore
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from .logging import logger
 from .apiuser import ApiUserManager
+from .package import ApiUserPackage, package_name
+from .listing import ObjectStream, partition_filters
+from .diff import ADD, DELETE, merge_diff, strip_prefix
+from .snapshot import Snapshot
+from .ratelimit import TokenBucket
+from .retry import RetryQueue
+from .metrics import Metrics
+from .hostindex import HostIndex, sorted_fingerprints, in_sorted
+from .registry import fingerprint
+from .shard import Shard
+from .constants import DEFAULT_WORKERS, DEFAULT_BULK_MODE, DEFAULT_PARTITION_TIMEOUT, DEFAULT_PARTITION_RETRIES, DEFAULT_JITTER
+from heapq import merge
+from itertools import chain
+from array import array
+import time
+import sys
+import random
+
+class Listing():
+    """
+    The result of the Host and ApiUser listings reduced to what the
+    comparison needs: the sorted fingerprints of the names instead
+    of the names themselves, except for the Hosts that have no
+    ApiUser and the ApiUsers defined by the configuration package.
+    """
+
+    def __init__(self):
+        self.hosts = array("Q")
+        self.users = array("Q")
+        self.adds: List[str] = []
+        self.packaged: Dict[int, str] = {}
+        self.other_users: Set[str] = set()
+        self.moved: Set[str] = set()
+        self.other_hosts = 0
 
 class Comparator():
     """
     The Comparator requests configured Hosts and ApiUser
     objects and synchronize them by creating new ApiUser objects
     when there's no one for an existing Host, and deleting existing
-    ones that have no corresponding Host objects.
+    ones that have no corresponding Host objects. The listings are
+    streamed, but the comparison isn't constant in memory: it keeps
+    8 bytes per listed object (see ``Listing``).
     """
 
     def __init__(self,
                  client: Client,
                  userManager: ApiUserManager,
-                 filter: Optional[str] = None):
+                 filter: Optional[str] = None,
+                 workers: Optional[int] = None,
+                 bulk_mode: Optional[str] = None,
+                 partitions: Optional[Sequence[str]] = None,
+                 partition_timeout: Optional[float] = None,
+                 partition_retries: Optional[int] = None,
+                 snapshot: Optional[Snapshot] = None,
+                 interval: Optional[float] = None,
+                 jitter: Optional[float] = None,
+                 max_rps: Optional[float] = None,
+                 max_writes: Optional[int] = None,
+                 retries: Optional[RetryQueue] = None,
+                 metrics: Optional[Metrics] = None,
+                 shard: Optional[Shard] = None,
+                 package_lock: Optional[Any] = None,
+                 host_names: Optional[HostIndex] = None):
         """
         :param client: An Icinga 2 REST API client object.
 
@@ -48,61 +100,558 @@ class Comparator():
 
         :param filter: An optional Host filter string (i. e.
             ``host.zone == "master"``).
+
+        :param workers: A number of ApiUser requests to run in
+            parallel. The default is 4.
+
+        :param bulk_mode: How the missing ApiUsers are created:
+            ``object`` (the default) creates them one by one via
+            the object API, ``package`` deploys them all at once
+            as an Icinga 2 configuration package.
+
+        :param partitions: An optional Host listing partition
+            specification: ``zone``, ``prefix:N`` or a list of
+            Host filter strings. If specified, the Hosts are listed
+            by partitions concurrently.
+
+        :param partition_timeout: A number of seconds a single
+            partition listing may take. The default is 60.
+
+        :param partition_retries: A number of retries for a failed
+            partition listing. The default is 2.
+
+        :param snapshot: An optional snapshot to replace with the
+            listed Hosts.
+
+        :param interval: An optional number of seconds between
+            periodic comparisons (see ``next_delay()``).
+
+        :param jitter: A fraction of the interval to randomly shift
+            each periodic comparison by, so they don't run in step
+            with other periodic jobs. The default is 0.1.
+
+        :param max_rps: An optional maximum number of Icinga 2 API
+            requests per second the Comparator makes.
+
+        :param max_writes: An optional maximum number of ApiUsers to
+            add or delete in a single comparison. The rest is left
+            to the next one.
+
+        :param retries: An optional queue to put the failed ApiUser
+            operations to.
+
+        :param metrics: Optional metrics to observe the comparison
+            duration and the object set sizes in.
+
+        :param shard: An optional shard to restrict the comparison
+            to: the Hosts and the ApiUsers of the other shards are
+            left to the other daemon instances. Note, that all of
+            them are still listed and then dropped locally, since
+            the shard can't be expressed with an API filter. The
+            configuration package of the ``package`` bulk mode is
+            per shard too.
+
+        :param package_lock: An optional lock shared with the
+            EventListener to serialize the package deployments.
+
+        :param host_names: An optional index of known host names
+            shared with the EventListener to replace with the listed
+            ones.
         """
 
         self.client = client
         self.filter = filter
         self.userManager = userManager
+        self.workers = max(1, workers or DEFAULT_WORKERS)
+        self.bulk_mode = bulk_mode or DEFAULT_BULK_MODE
+        self.partitions = partitions
+        self.partition_timeout = partition_timeout or DEFAULT_PARTITION_TIMEOUT
+        self.partition_retries = DEFAULT_PARTITION_RETRIES \
+            if partition_retries is None else partition_retries
+        self.snapshot = snapshot
+        self.host_names = host_names
+        self.interval = interval or 0.0
+        self.jitter = DEFAULT_JITTER if jitter is None else jitter
+        self.bucket = TokenBucket(max_rps)
+        self.max_writes = max_writes or 0
+        self.retries = retries
+        self.metrics = metrics
+        self.shard = shard
+        self.package = package_name(shard)
+        self.package_lock = package_lock
 
     def run(self) -> None:
         """
         Runs the user synchronization proc by comparing Host and
-        ApiUser lists.
+        ApiUser lists (see ``list_names()``). If ``host_names`` is
+        set to the shared index of known host names, it's replaced
+        with the listed ones; the changes made to it by the listener
+        while listing are kept. The snapshot, if any, is replaced
+        with the listed Hosts.
+        """
+
+        started = time.monotonic()
+        if self.host_names is not None:
+            self.host_names.track()
+        try:
+            listing = self.list_names()
+        except Exception as ex:
+            if self.host_names is not None:
+                self.host_names.untrack()
+            if self.metrics:
+                self.metrics.error(ex)
+                self.metrics.set("comparison_last_timestamp", time.time())
+                self.metrics.set("comparison_last_seconds", time.monotonic() - started)
+                self.metrics.set("comparison_last_success", 0)
+            raise
+
+        if self.metrics:
+            self.metrics.set("comparison_objects", len(listing.hosts), "hosts")
+            self.metrics.set("comparison_objects", len(listing.users), "apiusers")
+
+        if self.host_names is not None and \
+           not self.host_names.replace(listing.hosts):
+            logger.warning("[Comparator] Too many Hosts changed while listing: the known hosts are left as is.")
+
+        if self.bulk_mode == "package":
+            self.deploy_package(listing)
+        else:
+            self.reconcile(self.diff(listing))
+
+        if self.snapshot:
+            self.save_snapshot(listing.hosts)
+
+        if self.metrics:
+            self.metrics.observe("comparison_seconds", time.monotonic() - started)
+            self.metrics.set("comparison_last_timestamp", time.time())
+            self.metrics.set("comparison_last_seconds", time.monotonic() - started)
+            self.metrics.set("comparison_last_success", 1)
+
+    def next_delay(self) -> float:
+        """
+        Returns the number of seconds to wait before the next
+        periodic comparison: the interval randomly shifted by up to
+        ``jitter`` of it, or zero if there's no interval.
+        """
+
+        if not self.interval:
+            return 0.0
+
+        return max(0.0, self.interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def save_snapshot(self, hosts: array) -> None:
+        """
+        Replaces the snapshot with the listed Hosts.
+
+        :param hosts: The sorted fingerprints of the listed Hosts.
+        """
+
+        try:
+            self.snapshot.replace(hosts)
+            logger.debug("[Comparator] Snapshot saved: %d Hosts." % len(hosts))
+        except Exception as ex:
+            logger.warning("[Comparator] Unable to save the snapshot: %s." % str(ex))
+
+    def plan(self, out: TextIO = sys.stdout) -> None:
+        """
+        Computes the difference between Host and ApiUser lists
+        the same way ``run()`` does in the configured bulk mode
+        and prints it along with the timings without making
+        any changes.
+
+        :param out: The stream to print to.
+        """
+
+        listing = self.list_names()
+
+        started = time.monotonic()
+        if self.bulk_mode == "package":
+            to_add, removed, kept = self.package_changes(listing)
+            ops: Iterable[Tuple[str, str]] = chain(
+                ((ADD, name) for name in sorted(to_add)),
+                ((DELETE, name) for name in sorted(removed)),
+                ((DELETE, name) for name in self.list_deletes(listing))
+            )
+        else:
+            ops = self.diff(listing)
+
+        counts = { ADD: 0, DELETE: 0 }
+        for op, name in ops:
+            counts[op] += 1
+            print("%s %s" % ("+" if op == ADD else "-", name), file = out)
+        diff_time = time.monotonic() - started
+
+        print("# %d Hosts listed in %.2f s, %d ApiUsers listed in %.2f s." % (len(listing.hosts), self.timings["hosts"], len(listing.users), self.timings["users"]), file = out)
+        print("# %d ApiUsers to add, %d to delete, computed in %.3f s." % (counts[ADD], counts[DELETE], diff_time), file = out)
+        if self.bulk_mode == "package":
+            if to_add or removed:
+                print("# The config package would be deployed with %d ApiUsers (%d new, %d removed), %d ApiUsers would be deleted with the object API." % (len(kept), len(to_add), len(removed), counts[DELETE] - len(removed)), file = out)
+            else:
+                print("# The config package is up to date, %d ApiUsers would be deleted with the object API." % counts[DELETE], file = out)
+
+    def list_names(self) -> Listing:
+        """
+        Lists the managed ApiUsers and then the Hosts, so each Host
+        is looked up among the ApiUsers as it's received: only the
+        names of the Hosts that have no ApiUser are kept, the rest
+        of both listings is reduced to the sorted fingerprints of
+        the names. Saves the listing timings in ``timings``.
+        """
+
+        self.timings: Dict[str, float] = {}
+        listing = Listing()
+
+        started = time.monotonic()
+        self.list_users(listing)
+        self.timings["users"] = time.monotonic() - started
+
+        started = time.monotonic()
+        self.list_hosts(listing)
+        self.timings["hosts"] = time.monotonic() - started
+
+        return listing
+
+    def list_hosts(self, listing: Listing) -> None:
+        """
+        Lists the Hosts matching the filter into the listing (see
+        ``scan()``). If the partitions are configured, lists each
+        partition in parallel with its own timeout and retries and
+        merges the results. The Hosts of the other shards, if any,
+        are dropped as they are received.
+
+        :param listing: The listing with the ApiUsers listed.
         """
 
         logger.debug("[Comparator] Requesting list of Hosts...")
-        hosts = self.client.objects.list("Host", filters = self.filter)
+
+        if not self.partitions:
+            self.bucket.acquire()
+            listing.hosts, adds = self.scan(ObjectStream(self.client).names(
+                "Host", filters = self.filter
+            ), listing)
+            listing.adds.extend(adds)
+        else:
+            filters = partition_filters(ObjectStream(self.client),
+                                        self.partitions, self.filter)
+            logger.debug("[Comparator] Listing Hosts in %d partitions..." % len(filters))
+
+            with ThreadPoolExecutor(max_workers = min(len(filters), self.workers),
+                                    thread_name_prefix = "Partition") as executor:
+                parts = list(executor.map(
+                    lambda f: self.list_partition(f, listing), filters
+                ))
+            listing.hosts = sorted_fingerprints(merge(*(fps for fps, _ in parts)))
+            for _, adds in parts:
+                listing.adds.extend(adds)
+
+        if self.shard:
+            logger.debug("[Comparator] %d of %d Hosts belong to shard %s." % (len(listing.hosts), len(listing.hosts) + listing.other_hosts, self.shard))
+
+    def list_partition(self, filters: str,
+                       listing: Listing) -> Tuple[array, List[str]]:
+        """
+        Lists the Hosts in a single partition (see ``scan()``)
+        making up to ``partition_retries`` retries on error.
+
+        :param filters: The partition Host filter string.
+
+        :param listing: The listing with the ApiUsers listed.
+        """
+
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            started = time.monotonic()
+            try:
+                fps, adds = self.scan(ObjectStream(
+                    self.client, timeout = self.partition_timeout
+                ).names("Host", filters = filters), listing)
+                logger.debug("[Comparator] Listed %d Hosts matching '%s' in %.2f s." % (len(fps), filters, time.monotonic() - started))
+                return fps, adds
+            except Exception as ex:
+                if attempt >= self.partition_retries:
+                    raise
+                attempt += 1
+                logger.warning("[Comparator] Error while listing Hosts matching '%s': %s. Making a retry (%d of %d)..." % (filters, str(ex), attempt, self.partition_retries))
+
+    def scan(self, names: Iterable[str],
+             listing: Listing) -> Tuple[array, List[str]]:
+        """
+        Returns the sorted fingerprints of the given Host names and
+        the names of the ones that have no ApiUser. The Hosts of the
+        other shards, if any, are counted and dropped: the ones
+        whose ApiUsers are defined by the package are collected into
+        ``moved`` of the listing.
+
+        :param names: The Host names as they are received.
+
+        :param listing: The listing with the ApiUsers listed.
+        """
+
+        adds: List[str] = []
+
+        def fps() -> Generator[int, None, None]:
+            for name in names:
+                if self.shard and name not in self.shard:
+                    listing.other_hosts += 1
+                    if name in listing.other_users:
+                        listing.moved.add(name)
+                    continue
+                fp = fingerprint(name)
+                if not in_sorted(listing.users, fp):
+                    adds.append(name)
+                yield fp
+
+        return sorted_fingerprints(fps()), adds
+
+    def list_users(self, listing: Listing) -> None:
+        """
+        Lists the managed ApiUsers into the listing: the sorted
+        fingerprints of their names with the prefix removed and the
+        names of the ones that are defined by the configuration
+        package. All the managed users are listed, the ones of the
+        other shards, if any, are dropped locally: the users of the
+        package among them are collected into ``other_users``.
+
+        :param listing: The listing to fill.
+        """
 
         logger.debug("[Comparator] Requesting list of ApiUsers...")
-        apiusers = self.client.objects.list(
-            "ApiUser", filters = "match(prefix + \"*\", obj.name)",
-            filter_vars = {"prefix": self.userManager.prefix}
-        )
 
-        u_names = set([u["name"].lstrip(self.userManager.prefix) \
-                       for u in apiusers])
-        h_names = set([h["name"] for h in hosts])
+        def fps() -> Generator[int, None, None]:
+            for u in ObjectStream(self.client).list(
+                    "ApiUser", attrs = ["name", "package"],
+                    filters = "match(prefix + \"*\", obj.name)",
+                    filter_vars = {"prefix": self.userManager.prefix}
+            ):
+                name = strip_prefix(u["name"], self.userManager.prefix)
+                packaged = u.get("attrs", {}).get("package") == self.package
+                if self.shard and name not in self.shard:
+                    if packaged:
+                        listing.other_users.add(name)
+                    continue
+                fp = fingerprint(name)
+                if packaged:
+                    listing.packaged[fp] = name
+                yield fp
+
+        self.bucket.acquire()
+        listing.users = sorted_fingerprints(fps())
+
+    def list_deletes(self, listing: Listing) -> List[str]:
+        """
+        Returns the names of the listed ApiUsers (with the prefix
+        removed) that have no Host and aren't defined by the
+        configuration package. The fingerprints of the listings are
+        compared with a merge-join; if there are ApiUsers to
+        delete, the ApiUsers are listed once again to get their
+        names.
+
+        :param listing: The listing to compare.
+        """
+
+        fps = set(fp for op, fp in merge_diff(listing.hosts, listing.users) \
+                  if op == DELETE and fp not in listing.packaged)
+        if not fps:
+            return []
+
+        logger.debug("[Comparator] Requesting names of %d ApiUsers to delete..." % len(fps))
+        self.bucket.acquire()
+        names = (strip_prefix(n, self.userManager.prefix) \
+                 for n in ObjectStream(self.client).names(
+                         "ApiUser",
+                         filters = "match(prefix + \"*\", obj.name)",
+                         filter_vars = {"prefix": self.userManager.prefix}
+                 ))
+        return [n for n in names if fingerprint(n) in fps]
+
+    def diff(self, listing: Listing) -> Iterator[Tuple[str, str]]:
+        """
+        Returns the sequence of ``(operation, hostname)`` pairs
+        that synchronizes the ApiUsers with the listed Hosts.
+
+        :param listing: The listing to compare.
+        """
+
+        return chain(((ADD, name) for name in listing.adds),
+                     ((DELETE, name) for name in self.list_deletes(listing)))
+
+    def package_changes(self, listing: Listing) \
+        -> Tuple[Set[str], Set[str], Set[str]]:
+        """
+        Returns the names of the ApiUsers to add to the configuration
+        package, to remove from it and all the ones to deploy with
+        it in the ``package`` bulk mode (see ``deploy_package()``).
+
+        :param listing: The listing to compare.
+        """
+
+        to_add = set(listing.adds)
+        moved = listing.moved
+        removed = set(name for fp, name in listing.packaged.items() \
+                      if not in_sorted(listing.hosts, fp)) | \
+            (listing.other_users - moved)
+        kept = set(name for fp, name in listing.packaged.items() \
+                   if in_sorted(listing.hosts, fp)) | moved | to_add
+        return to_add, removed, kept
 
-        for name in (h_names - u_names):
+    def deploy_package(self, listing: Listing) -> Dict[str, str]:
+        """
+        Synchronizes ApiUsers in the ``package`` bulk mode: all
+        missing users together with the already package-managed
+        ones are deployed as a single configuration package stage.
+        Package-managed users of the deleted hosts are removed by
+        omitting them from the stage, other stale users are deleted
+        via the object API. If the stage fails the validation (i. e.
+        a user was created with the object API meanwhile), the
+        previous stage stays active and the changes it was to make
+        are queued for retries. Returns the failed operations.
+
+        With a shard, the users of the package whose Hosts were moved
+        to another shard (i. e. after an instance was added) are kept
+        while the Hosts exist, as the other instance sees them as
+        existing ApiUsers and doesn't add them to its own package.
+
+        :param listing: The listing to compare.
+        """
+
+        package = ApiUserPackage(self.userManager, package = self.package,
+                                 lock = self.package_lock)
+
+        to_add, removed, kept = self.package_changes(listing)
+        failed: Dict[str, str] = {}
+        started = time.monotonic()
+        if to_add or removed:
             try:
-                self.userManager.add_api_user(name)
+                package.deploy(kept)
+                logger.info("[Comparator] Deployed %d ApiUsers (%d new, %d removed) with a config package in %.2f s." % (len(kept), len(to_add), len(removed), time.monotonic() - started))
             except Exception as ex:
-                logger.error(f"[Comparator] Error while trying to add ApiUser for host \"%s\": %s." % (name, str(ex)))
+                logger.error("[Comparator] Error while deploying %d ApiUsers (%d new, %d removed) with a config package: %s." % (len(kept), len(to_add), len(removed), str(ex)))
+                if self.metrics:
+                    self.metrics.error(ex)
+                failed.update((name, ADD) for name in to_add)
+                failed.update((name, DELETE) for name in removed)
+                if self.retries:
+                    try:
+                        for name, op in failed.items():
+                            self.retries.push(op, name, str(ex))
+                    except Exception as ex:
+                        logger.warning("[Comparator] Unable to update the retry queue: %s." % str(ex))
+                to_add, removed = set(), set()
+
+        if self.metrics:
+            self.metrics.inc("apiusers_created_total", len(to_add))
+            self.metrics.inc("apiusers_deleted_total", len(removed))
 
-        for name in (u_names - h_names):
+        return self.reconcile(
+            ((DELETE, name) for name in self.list_deletes(listing)),
+            applied = { ADD: len(to_add), DELETE: len(removed) },
+            failures = failed
+        )
+
+    def reconcile(self, ops: Iterable[Tuple[str, str]],
+                  applied: Optional[Dict[str, int]] = None,
+                  failures: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """
+        Applies the given sequence of ``(operation, hostname)``
+        pairs running up to ``workers`` ApiUser requests in
+        parallel. Deletions are grouped into batches of the
+        ``userManager.batch_size``. An error is logged and counted
+        for each failed operation, but doesn't stop the others.
+        The requests are limited to ``max_rps`` per second, and no
+        more than ``max_writes`` operations are applied: the rest
+        is deferred to the next comparison. Logs a summary at the
+        end. Returns the failed (or deferred) operation for each
+        host name that wasn't synchronized.
+
+        :param ops: A sequence of ``(ADD, hostname)`` and
+            ``(DELETE, hostname)`` pairs.
+
+        :param applied: The numbers of the ApiUsers already added and
+            deleted otherwise (i. e. with a configuration package)
+            to include into the summary and the metrics.
+
+        :param failures: The operations that already failed otherwise
+            to include into the summary, the metrics and the result.
+        """
+
+        counts = { ADD: 0, DELETE: 0, **(applied or {}) }
+        failed: Dict[str, str] = dict(failures or {})
+        deferred: Dict[str, str] = {}
+        started = time.monotonic()
+
+        def apply(op: str, names: List[str]) -> Dict[str, Exception]:
+            self.bucket.acquire()
+            if op == DELETE:
+                return self.userManager.del_api_users(names)
             try:
-                self.userManager.del_api_user(name)
+                self.userManager.add_api_user(names[0])
+                return {}
             except Exception as ex:
-                logger.error(f"[Comparator] Error while trying to delete ApiUser for host \"%s\": %s." % (name, str(ex)))
+                return { names[0]: ex }
 
-        logger.info("[Comparator] ApiUsers synchronized.")
+        def collect(done: Iterable[Future]) -> None:
+            for f in done:
+                op, names = pending.pop(f)
+                try:
+                    errors = f.result()
+                except Exception as ex:
+                    errors = dict([(name, ex) for name in names])
+                for name, ex in errors.items():
+                    logger.error("[Comparator] Error while trying to %s ApiUser for host \"%s\": %s." % (op, name, str(ex)))
+                    failed[name] = op
+                    if self.metrics:
+                        self.metrics.error(ex)
+                counts[op] += len(names) - len(errors)
+                if self.retries:
+                    try:
+                        self.retries.discard([n for n in names if n not in errors])
+                        for name, ex in errors.items():
+                            self.retries.push(op, name, str(ex))
+                    except Exception as ex:
+                        logger.warning("[Comparator] Unable to update the retry queue: %s." % str(ex))
 
+        pending: Dict[Future, Tuple[str, List[str]]] = {}
+        deletes: List[str] = []
+        with ThreadPoolExecutor(max_workers = self.workers,
+                                thread_name_prefix = "Comparator") as executor:
+            def submit(op: str, names: List[str]) -> None:
+                if len(pending) >= 2 * self.workers:
+                    done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                    collect(done)
+                pending[executor.submit(apply, op, names)] = (op, names)
 
-# client.objects.list('Host',
-#                     filters='host.zone == zone',
-#                     filter_vars={'zone': zone})
-#
-# types = ['ObjectCreated', 'ObjectDeleted']
-# queue = queue
-# filter = 'event.object_type == "Host"'
-#
-# for event in client.events.subscribe(types, queue, filter):
-#     print(event)
-#
-#{"object_name":"test1","object_type":"Host","timestamp":1711707986.404245,"type":"ObjectCreated"}
+            writes = 0
+            for op, name in ops:
+                if self.max_writes and writes >= self.max_writes:
+                    deferred[name] = op
+                    continue
+                writes += 1
+                if op == DELETE:
+                    deletes.append(name)
+                    if len(deletes) >= self.userManager.batch_size:
+                        submit(DELETE, deletes)
+                        deletes = []
+                else:
+                    submit(ADD, [name])
+            if deletes:
+                submit(DELETE, deletes)
+
+            while pending:
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                collect(done)
+
+        if deferred:
+            logger.info("[Comparator] The limit of %d writes is reached: %d ApiUser changes are deferred to the next comparison." % (self.max_writes, len(deferred)))
 
-## curl -k -sS -i -u 'root:bcf6ca38a4d66d17' -H 'Accept: application/json' -X POST 'https://localhost:5665/v1/events' -d '{ "queue": "abc", "types": ["ObjectCreated", "ObjectDeleted"], "filter": "event.object_type == \"Host\"" }'
+        if self.metrics:
+            self.metrics.set("comparison_objects", counts[ADD], "added")
+            self.metrics.set("comparison_objects", counts[DELETE], "deleted")
+            self.metrics.set("comparison_objects", len(failed), "failed")
+            self.metrics.set("comparison_objects", len(deferred), "deferred")
 
-#{"object_name":"test4","object_type":"Host","timestamp":1711708483.735119,"type":"ObjectCreated"}
+        elapsed = time.monotonic() - started
+        total = counts[ADD] + counts[DELETE] + len(failed)
+        logger.info("[Comparator] ApiUsers synchronized: %d added, %d deleted, %d failed in %.2f s (%.1f users/s, %d workers)." % (counts[ADD], counts[DELETE], len(failed), elapsed, (total / elapsed) if elapsed > 0 else 0.0, self.workers))
 
-#{"object_name":"test4","object_type":"Host","timestamp":1711708571.37147,"type":"ObjectDeleted"}
+        return { **deferred, **failed }
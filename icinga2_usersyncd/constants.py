@@ -34,4 +34,52 @@ DEFAULT_PREFIX = "host-"
 DEFAULT_TEMPLATES = [ "usersync" ]
 DEFAULT_QUEUE = "icinga2-usersyncd"
 DEFAULT_DELAY = 1
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 500
+BULK_MODES = [ "object", "package" ]
+DEFAULT_BULK_MODE = "object"
+DEFAULT_PACKAGE = "icinga2-usersyncd"
+DEFAULT_PARTITION_TIMEOUT = 60
+DEFAULT_PARTITION_RETRIES = 2
+DEFAULT_EVENT_WINDOW = 0.5
+DEFAULT_EVENT_BATCH = 100
+DEFAULT_BACKLOG = 10000
+STATS_INTERVAL = 10
+ENGINES = [ "process", "thread" ]
+DEFAULT_ENGINE = "process"
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_TIMEOUT = 60
+DEFAULT_STATE_DIR = "/var/lib/icinga2-usersyncd"
+SNAPSHOT_FILE = "snapshot.db"
+DEFAULT_INTERVAL = 3600
+DEFAULT_JITTER = 0.1
+DEFAULT_WRITE_CONCURRENCY = 8
+DEFAULT_WRITE_LATENCY = 1.0
+RETRY_FILE = "retry.db"
+DEFAULT_RETRY_ATTEMPTS = 10
+DEFAULT_RETRY_DELAY = 5
+RETRY_MAX_DELAY = 3600
+RETRY_LEASE = 300
+REGISTRY_SLOTS = 65536
+REGISTRY_PROBES = 32
+HOSTINDEX_CAPACITY = 1 << 24
+HOSTINDEX_OVERLAY = 4096
+HOSTINDEX_JOURNAL = 65536
+SORT_CHUNK = 65536
+RECORD_FLUSH = 1.0
+DEFAULT_REPLAY_SPEED = 1.0
+METRICS_PREFIX = "icinga2_usersyncd_"
+DEFAULT_METRICS_ADDRESS = "127.0.0.1"
+LAG_WINDOW = 300
+LAG_SAMPLES = 100000
+STATUS_SOCKET = "status.sock"
+STATUS_TIMEOUT = 5
+STATUS_INTERVAL = 1
+PROFILE_DIR = "profiles"
+PROFILE_INTERVAL = 0.01
+PROFILE_KEEP = 5
+HEAP_TOP = 25
+STAGE_TIMEOUT = 120
+STAGE_POLL = 0.5
 SETUP_SCRIPT = "/usr/sbin/icinga2 pki new-cert --cn icinga2-usersyncd --key /var/lib/icinga2/certs/icinga2-usersyncd.key --csr /var/lib/icinga2/certs/icinga2-usersyncd.req && /usr/sbin/icinga2 pki sign-csr --csr /var/lib/icinga2/certs/icinga2-usersyncd.req --cert /var/lib/icinga2/certs/icinga2-usersyncd.crt"
@@ -23,17 +23,34 @@ Host agents on an Icinga 2 instance. This module defines the main
 class that encapsulates all functions.
 """
 
-from typing import Optional, Sequence
+from typing import Optional, Sequence, TextIO, Dict, Any
 from icinga2apic.client import Client # type: ignore
 from .event_listener import EventListener
 from .comparator import Comparator
+from .engine import ThreadEngine
+from .pool import ConnectionPool
+from .snapshot import Snapshot, open_snapshot
+from .retry import RetryQueue, open_retry_queue
+from .diff import ADD
+from .hostindex import HostIndex
 from .logging import logger
 from .apiuser import ApiUserManager
-from .constants import CONFIG_SECTION, DEFAULT_DELAY
-from multiprocessing import Process
+from .ratelimit import AdaptiveLimiter
+from .registry import OpRegistry
+from .replay import Replay
+from .metrics import Metrics, serve_metrics
+from .status import serve_status, query_status
+from .profiling import Profiler
+from .shard import Shard
+from .package import ApiUserPackage, package_name
+from .constants import CONFIG_SECTION, DEFAULT_QUEUE, DEFAULT_DELAY, DEFAULT_WORKERS, DEFAULT_BATCH_SIZE, DEFAULT_BULK_MODE, DEFAULT_PARTITION_TIMEOUT, DEFAULT_PARTITION_RETRIES, DEFAULT_EVENT_WINDOW, DEFAULT_EVENT_BATCH, DEFAULT_BACKLOG, DEFAULT_ENGINE, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_TIMEOUT, DEFAULT_STATE_DIR, SNAPSHOT_FILE, DEFAULT_INTERVAL, DEFAULT_JITTER, DEFAULT_WRITE_CONCURRENCY, DEFAULT_WRITE_LATENCY, RETRY_FILE, DEFAULT_RETRY_ATTEMPTS, DEFAULT_RETRY_DELAY, DEFAULT_METRICS_ADDRESS, STATUS_SOCKET, LAG_WINDOW, PROFILE_DIR
+from multiprocessing import Process, Lock
 import time
+import json
 from configparser import ConfigParser, NoOptionError
 import warnings
+import os
+import sys
 import urllib3
 
 # from importlib.resources import files
@@ -56,7 +73,26 @@ class Daemon:
                  prefix: Optional[str] = None,
                  templates: Optional[Sequence[str]] = None,
                  filter: Optional[str] = None,
-                 delay: Optional[float] = None):
+                 delay: Optional[float] = None,
+                 workers: Optional[int] = None,
+                 batch_size: Optional[int] = None,
+                 bulk_mode: Optional[str] = None,
+                 partitions: Optional[Sequence[str]] = None,
+                 event_window: Optional[float] = None,
+                 event_batch: Optional[int] = None,
+                 backlog: Optional[int] = None,
+                 engine: Optional[str] = None,
+                 pool_size: Optional[int] = None,
+                 state_dir: Optional[str] = None,
+                 interval: Optional[float] = None,
+                 max_rps: Optional[float] = None,
+                 max_writes: Optional[int] = None,
+                 write_rate: Optional[float] = None,
+                 write_concurrency: Optional[int] = None,
+                 record: Optional[str] = None,
+                 metrics_port: Optional[int] = None,
+                 shard_index: Optional[int] = None,
+                 shard_count: Optional[int] = None):
         """
         :param config_file: A path to configuration file, usually
             ``/etc/sysconfig/icinga2-usersyncd`` with ``[api]`` and
@@ -119,6 +155,145 @@ class Daemon:
             attempts. The default is 1 second. If specified, overrides
             the value specified in the configuration file under the
             ``[daemon]`` section.
+
+        :param workers: A number of ApiUser requests the Comparator
+            and the EventListener run in parallel. The default is 4. If specified,
+            overrides the value specified in the configuration file
+            under the ``[daemon]`` section.
+
+        :param batch_size: A maximum number of ApiUser objects to
+            delete with a single request. The default is 500. If
+            specified, overrides the value specified in the
+            configuration file under the ``[daemon]`` section.
+
+        :param bulk_mode: How the Comparator creates missing
+            ApiUsers: ``object`` (the default) creates them one by
+            one, ``package`` deploys them as a single configuration
+            package stage. If specified, overrides the value
+            specified in the configuration file under the
+            ``[daemon]`` section.
+
+        :param partitions: An optional Host listing partition
+            specification for the Comparator: ``zone``,
+            ``prefix:N`` or a list of Host filter strings (one per
+            line in the configuration file). If specified, overrides
+            the value specified in the configuration file under the
+            ``[daemon]`` section. The per-partition timeout and
+            number of retries are read from the ``partition_timeout``
+            and ``partition_retries`` options.
+
+        :param event_window: A number of seconds the EventListener
+            collects events for before processing them as a batch.
+            The default is 0.5 seconds. If specified, overrides the
+            value specified in the configuration file under the
+            ``[daemon]`` section.
+
+        :param event_batch: A maximum number of events the
+            EventListener collects into a batch. The default is 100.
+            If specified, overrides the value specified in the
+            configuration file under the ``[daemon]`` section.
+
+        :param backlog: A maximum number of events waiting to be
+            processed and of ApiUser requests waiting to be made by
+            the EventListener before it pauses reading the event
+            stream until a half of the events are processed. The
+            default is 10000. If specified, overrides
+            the value specified in the configuration file under the
+            ``[daemon]`` section.
+
+        :param engine: The runtime mode: ``process`` (the default)
+            forks the EventListener and the Comparator on each
+            connection, ``thread`` runs them in threads of a single
+            process. If specified, overrides the value specified in
+            the configuration file under the ``[daemon]`` section.
+
+        :param pool_size: A maximum number of persistent connections
+            to the Icinga 2 API shared by all requests. The default
+            is 10. If specified, overrides the value specified in
+            the configuration file under the ``[daemon]`` section.
+            Whether to keep the connections open and the connect and
+            response timeouts are read from the ``keepalive``,
+            ``connect_timeout`` and ``timeout`` options.
+
+        :param state_dir: A directory to keep the snapshot of the
+            known Hosts and managed ApiUsers in, which allows to
+            start serving events without listing all Hosts first.
+            The failed ApiUser operations are queued for retries
+            there too. The default is ``/var/lib/icinga2-usersyncd``.
+            An empty value in the configuration file disables the
+            snapshot and the retry queue. The number of retries and
+            the delay before the first one are read from the
+            ``retry_attempts`` and ``retry_delay`` options.
+            If specified, overrides the value specified in the
+            configuration file under the ``[daemon]`` section.
+
+        :param interval: A number of seconds between periodic
+            comparisons. The default is 3600. Zero disables the
+            periodic comparison. If specified, overrides the value
+            specified in the configuration file under the
+            ``[daemon]`` section. The random shift of each comparison
+            (a fraction of the interval) is read from the ``jitter``
+            option.
+
+        :param max_rps: A maximum number of Icinga 2 API requests
+            per second the Comparator makes. No limit by default. If
+            specified, overrides the value specified in the
+            configuration file under the ``[daemon]`` section.
+
+        :param max_writes: A maximum number of ApiUsers to add or
+            delete in a single comparison. No limit by default. If
+            specified, overrides the value specified in the
+            configuration file under the ``[daemon]`` section.
+
+        :param write_rate: A maximum number of ApiUser requests per
+            second made by the Comparator and the EventListener
+            together. No limit by default. If specified, overrides
+            the value specified in the configuration file under the
+            ``[daemon]`` section.
+
+        :param write_concurrency: A maximum number of ApiUser
+            requests in flight. The actual limit is halved when the
+            requests fail with overload errors or their average
+            latency rises above the ``write_latency`` option (1
+            second by default) and recovers when they succeed. The
+            default is 8. If specified, overrides the value specified
+            in the configuration file under the ``[daemon]`` section.
+
+        :param record: An optional path to a gzip-compressed JSON
+            lines file to append the raw Host events received by the
+            EventListener to, for a later replay.
+
+        :param metrics_port: An optional port to serve the metrics
+            in the Prometheus text format on
+            (``http://127.0.0.1:PORT/metrics``). The metrics are
+            aggregated across the processes. The address to listen
+            on is read from the ``metrics_address`` option. If
+            specified, overrides the value specified in the
+            configuration file under the ``[daemon]`` section.
+
+        :param shard_index: The zero-based index of the Hosts shard
+            handled by this instance. The default is 0. If
+            specified, overrides the value specified in the
+            configuration file under the ``[daemon]`` section.
+
+        :param shard_count: A number of daemon instances sharing the
+            Hosts. Each instance handles the Hosts whose names map
+            to its ``shard_index`` by the jump consistent hash, so
+            adding an instance moves only 1/N of the Hosts. The
+            instances use their own event queues, configuration
+            packages (in the ``package`` bulk mode) and
+            subdirectories of the state directory (``shardN``).
+            The shard is applied locally: each instance still
+            receives the whole event stream and lists all the Hosts
+            and ApiUsers, i. e. N times the listing and the stream
+            load on the API in total. The default is 1 (no
+            sharding). If specified, overrides
+            the value specified in the configuration file under the
+            ``[daemon]`` section.
+
+        The ApiUser operations in flight are registered, so the same
+        change requested by both the Comparator and the EventListener
+        at the same time is made once.
         """
 
         if config_file:
@@ -139,6 +314,42 @@ class Daemon:
             warnings.simplefilter("ignore", category=urllib3.exceptions.InsecureRequestWarning)
 
         logger.debug("Initializing the daemon...")
+        self.queue = queue
+        self.prefix = prefix
+        self.templates = templates
+        self.filter = filter
+        self.delay = delay or DEFAULT_DELAY
+        self.workers = workers or DEFAULT_WORKERS
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.bulk_mode = bulk_mode or DEFAULT_BULK_MODE
+        self.partitions = partitions
+        self.partition_timeout = DEFAULT_PARTITION_TIMEOUT
+        self.partition_retries = DEFAULT_PARTITION_RETRIES
+        self.event_window = DEFAULT_EVENT_WINDOW \
+            if event_window is None else event_window
+        self.event_batch = event_batch or DEFAULT_EVENT_BATCH
+        self.backlog = backlog or DEFAULT_BACKLOG
+        self.engine = engine or DEFAULT_ENGINE
+        self.pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.keepalive = True
+        self.connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        self.timeout = DEFAULT_TIMEOUT
+        self.state_dir = DEFAULT_STATE_DIR if state_dir is None else state_dir
+        self.interval = DEFAULT_INTERVAL if interval is None else interval
+        self.jitter = DEFAULT_JITTER
+        self.max_rps = max_rps
+        self.max_writes = max_writes
+        self.write_rate = write_rate
+        self.write_concurrency = write_concurrency or DEFAULT_WRITE_CONCURRENCY
+        self.write_latency = DEFAULT_WRITE_LATENCY
+        self.retry_attempts = DEFAULT_RETRY_ATTEMPTS
+        self.retry_delay = DEFAULT_RETRY_DELAY
+        self.record = record
+        self.metrics_port = metrics_port
+        self.metrics_address = DEFAULT_METRICS_ADDRESS
+        self.shard_index = 0 if shard_index is None else shard_index
+        self.shard_count = shard_count or 1
+
         if config_file:
             config = ConfigParser()
             config.read(config_file)
@@ -166,26 +377,233 @@ class Daemon:
                     CONFIG_SECTION, "delay",
                     fallback = DEFAULT_DELAY
                 ))
+                self.workers = workers or int(config.get(
+                    CONFIG_SECTION, "workers",
+                    fallback = DEFAULT_WORKERS
+                ))
+                self.batch_size = batch_size or int(config.get(
+                    CONFIG_SECTION, "batch_size",
+                    fallback = DEFAULT_BATCH_SIZE
+                ))
+                self.bulk_mode = bulk_mode or config.get(
+                    CONFIG_SECTION, "bulk_mode",
+                    fallback = DEFAULT_BULK_MODE
+                )
+                self.partitions = partitions or [
+                    p.strip() for p in config.get(
+                        CONFIG_SECTION, "partitions",
+                        fallback = ""
+                    ).splitlines() if p.strip()
+                ] or None
+                self.partition_timeout = float(config.get(
+                    CONFIG_SECTION, "partition_timeout",
+                    fallback = DEFAULT_PARTITION_TIMEOUT
+                ))
+                self.partition_retries = int(config.get(
+                    CONFIG_SECTION, "partition_retries",
+                    fallback = DEFAULT_PARTITION_RETRIES
+                ))
+                self.event_window = float(config.get(
+                    CONFIG_SECTION, "event_window",
+                    fallback = self.event_window
+                )) if event_window is None else event_window
+                self.event_batch = event_batch or int(config.get(
+                    CONFIG_SECTION, "event_batch",
+                    fallback = DEFAULT_EVENT_BATCH
+                ))
+                self.backlog = backlog or int(config.get(
+                    CONFIG_SECTION, "backlog",
+                    fallback = DEFAULT_BACKLOG
+                ))
+                self.engine = engine or config.get(
+                    CONFIG_SECTION, "engine",
+                    fallback = DEFAULT_ENGINE
+                )
+                self.pool_size = pool_size or int(config.get(
+                    CONFIG_SECTION, "pool_size",
+                    fallback = DEFAULT_POOL_SIZE
+                ))
+                self.keepalive = config.getboolean(
+                    CONFIG_SECTION, "keepalive",
+                    fallback = True
+                )
+                self.connect_timeout = float(config.get(
+                    CONFIG_SECTION, "connect_timeout",
+                    fallback = DEFAULT_CONNECT_TIMEOUT
+                ))
+                self.timeout = float(config.get(
+                    CONFIG_SECTION, "timeout",
+                    fallback = DEFAULT_TIMEOUT
+                ))
+                self.state_dir = config.get(
+                    CONFIG_SECTION, "state_dir",
+                    fallback = DEFAULT_STATE_DIR
+                ) if state_dir is None else state_dir
+                self.interval = float(config.get(
+                    CONFIG_SECTION, "interval",
+                    fallback = DEFAULT_INTERVAL
+                )) if interval is None else interval
+                self.jitter = float(config.get(
+                    CONFIG_SECTION, "jitter",
+                    fallback = DEFAULT_JITTER
+                ))
+                self.max_rps = max_rps or float(config.get(
+                    CONFIG_SECTION, "max_rps",
+                    fallback = 0
+                )) or None
+                self.max_writes = max_writes or int(config.get(
+                    CONFIG_SECTION, "max_writes",
+                    fallback = 0
+                )) or None
+                self.write_rate = write_rate or float(config.get(
+                    CONFIG_SECTION, "write_rate",
+                    fallback = 0
+                )) or None
+                self.write_concurrency = write_concurrency or int(config.get(
+                    CONFIG_SECTION, "write_concurrency",
+                    fallback = DEFAULT_WRITE_CONCURRENCY
+                ))
+                self.write_latency = float(config.get(
+                    CONFIG_SECTION, "write_latency",
+                    fallback = DEFAULT_WRITE_LATENCY
+                ))
+                self.retry_attempts = int(config.get(
+                    CONFIG_SECTION, "retry_attempts",
+                    fallback = DEFAULT_RETRY_ATTEMPTS
+                ))
+                self.retry_delay = float(config.get(
+                    CONFIG_SECTION, "retry_delay",
+                    fallback = DEFAULT_RETRY_DELAY
+                ))
+                self.metrics_port = metrics_port or int(config.get(
+                    CONFIG_SECTION, "metrics_port",
+                    fallback = 0
+                )) or None
+                self.metrics_address = config.get(
+                    CONFIG_SECTION, "metrics_address",
+                    fallback = DEFAULT_METRICS_ADDRESS
+                )
+                self.shard_index = int(config.get(
+                    CONFIG_SECTION, "shard_index",
+                    fallback = 0
+                )) if shard_index is None else shard_index
+                self.shard_count = shard_count or int(config.get(
+                    CONFIG_SECTION, "shard_count",
+                    fallback = 1
+                ))
+
+        self.shard = Shard(self.shard_index, self.shard_count) \
+            if self.shard_count > 1 else None
+        if self.shard:
+            logger.debug("Handling the Hosts of shard %s." % self.shard)
+            self.queue = self.shard.suffix(self.queue or DEFAULT_QUEUE)
+            if self.state_dir:
+                self.state_dir = os.path.join(self.state_dir,
+                                              "shard%d" % self.shard.index)
+
+        self.metrics = Metrics()
+        self.package_lock = Lock()
+
+        self.pool = ConnectionPool(size = self.pool_size,
+                                   keepalive = self.keepalive,
+                                   connect_timeout = self.connect_timeout,
+                                   timeout = self.timeout,
+                                   metrics = self.metrics)
+        self.pool.attach(self.client)
+
+        self.limiter = AdaptiveLimiter(rate = self.write_rate,
+                                       concurrency = self.write_concurrency,
+                                       latency = self.write_latency)
+        logger.debug("ApiUser request limits: %s." % self.limiter.describe())
 
         self.userManager = ApiUserManager(self.client,
                                           prefix = self.prefix,
-                                          templates = self.templates)
+                                          templates = self.templates,
+                                          batch_size = self.batch_size,
+                                          limiter = self.limiter,
+                                          registry = OpRegistry(),
+                                          metrics = self.metrics)
+
+        self.snapshot: Optional[Snapshot] = None
+        self.retries: Optional[RetryQueue] = None
+
+    def state_path(self, name: str) -> Optional[str]:
+        """
+        Returns the path to the given file in the state directory or
+        None if there's no state directory.
+        """
+
+        return os.path.join(self.state_dir, name) if self.state_dir else None
+
+    def open_state(self) -> None:
+        """
+        Opens (and creates, if necessary) the snapshot and the retry
+        queue in the state directory. Only the running daemon does
+        that: the inspection commands (``plan()``, ``status()`` and
+        ``show_retries()``) don't change the state.
+        """
+
+        if self.shard and self.state_dir:
+            try:
+                os.makedirs(self.state_dir, mode = 0o700, exist_ok = True)
+            except OSError as ex:
+                logger.warning("Unable to create the shard state directory: %s." % str(ex))
+
+        self.snapshot = open_snapshot(
+            self.state_path(SNAPSHOT_FILE),
+            scope = "%s\n%s" % (self.userManager.prefix, self.filter or "") + \
+                ("\n%s" % self.shard if self.shard else "")
+        )
+        self.retries = open_retry_queue(
+            self.state_path(RETRY_FILE),
+            attempts = self.retry_attempts,
+            delay = self.retry_delay
+        )
 
     def run(self) -> None:
         """
-        Runs the icinga2-usersyncd daemon.
+        Runs the icinga2-usersyncd daemon. In the ``process`` engine
+        mode (the default) the EventListener and the Comparator are
+        run in separate processes forked on each connection. In the
+        ``thread`` mode they are run in threads of a single process.
+        The metrics endpoint, if configured, and the status socket
+        in the state directory (see ``status()``) are served by the
+        main process. With the state directory, ``SIGUSR1`` and
+        ``SIGUSR2`` make the profile and the heap dumps of all the
+        processes (see ``Profiler``). The snapshot and the retry queue
+        are opened first (see ``open_state()``).
         """
 
+        self.open_state()
+
+        profiler = None
+        if self.state_dir:
+            profiler = Profiler(os.path.join(self.state_dir, PROFILE_DIR))
+            profiler.install()
+
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.metrics_port,
+                          self.metrics_address)
+
+        if self.state_dir:
+            try:
+                serve_status(self.metrics,
+                             os.path.join(self.state_dir, STATUS_SOCKET))
+            except Exception as ex:
+                logger.warning("Unable to serve the status: %s." % str(ex))
+
+        if self.engine == "thread":
+            ThreadEngine(self.make_listener, self.make_comparator,
+                         self.delay, self.known_hosts()).run()
+            return
+
         logger.info("Trying to connect the listener...")
 
         while True:
-            listener = EventListener(self.client,
-                                     self.userManager,
-                                     queue = self.queue,
-                                     filter = self.filter)
+            listener = self.make_listener()
 
             try:
-                listener.connect()
+                listener.connect(host_names = self.known_hosts())
             except Exception as ex:
                 logger.error(f"Listener not connected: %s. Making a retry after a timeout..." % str(ex))
                 time.sleep(self.delay)
@@ -202,11 +620,15 @@ class Daemon:
 
             comparator_p = Process(
                 target = self.comparator_loop,
+                args = (listener.host_names,),
                 name = "ComparatorLoop",
                 daemon = True
             )
             comparator_p.start()
 
+            if profiler:
+                profiler.children = [listener_p, comparator_p]
+
             listener_p.join()
             logger.info("Listener finished. Making a retry after a timeout...")
 
@@ -215,24 +637,244 @@ class Daemon:
 
             time.sleep(self.delay)
 
-    def comparator_loop(self) -> None:
+    def comparator_loop(self, host_names: Optional[HostIndex] = None) -> None:
         """
-        Runs the Comparator. Makes a restart on error.
+        Runs the Comparator. Makes a restart on error. If the
+        comparison interval is set, runs it periodically.
+
+        :param host_names: The index of known host names shared
+            with the EventListener.
         """
 
         while True:
-            comparator = Comparator(self.client,
-                                    self.userManager,
-                                    filter = self.filter)
+            comparator = self.make_comparator(host_names)
             try:
                 comparator.run()
-                break
             except Exception as ex:
                 logger.error(f"Comparator exited with an error: %s. Making a retry after a timeout..." % str(ex))
                 time.sleep(self.delay)
+                continue
+
+            delay = comparator.next_delay()
+            if not delay:
+                break
+
+            logger.info("Next comparison in %.0f s." % delay)
+            time.sleep(delay)
 
         logger.info("Comparator finished.")
 
+    def known_hosts(self) -> Optional[HostIndex]:
+        """
+        Returns the index of the known host names from the snapshot
+        or None if there's no snapshot, so the initial host list is
+        requested. The index is to be made before forking, so it's
+        shared by the EventListener and the Comparator.
+        """
+
+        if not self.snapshot:
+            return None
+
+        try:
+            fps = self.snapshot.hosts()
+            if fps is None:
+                return None
+            hosts = HostIndex()
+            hosts.replace(fps)
+        except Exception as ex:
+            logger.warning("Unable to load the snapshot: %s." % str(ex))
+            return None
+
+        logger.info("Starting with %d known hosts from the snapshot." % len(hosts))
+        return hosts
+
+    def make_listener(self) -> EventListener:
+        """
+        Makes an EventListener configured with the daemon settings.
+        """
+
+        return EventListener(self.client,
+                             self.userManager,
+                             queue = self.queue,
+                             filter = self.filter,
+                             event_window = self.event_window,
+                             event_batch = self.event_batch,
+                             workers = self.workers,
+                             backlog = self.backlog,
+                             snapshot = self.snapshot,
+                             retries = self.retries,
+                             record = self.record,
+                             metrics = self.metrics,
+                             shard = self.shard,
+                             package = self.make_package())
+
+    def make_package(self) -> Optional[ApiUserPackage]:
+        """
+        Makes the configuration package of the ``package`` bulk
+        mode to remove the users of the deleted Hosts from. Returns
+        None in the ``object`` mode.
+        """
+
+        if self.bulk_mode != "package":
+            return None
+
+        return ApiUserPackage(self.userManager,
+                              package = package_name(self.shard),
+                              lock = self.package_lock)
+
+    def make_comparator(self, host_names: Optional[HostIndex] = None) -> Comparator:
+        """
+        Makes a Comparator configured with the daemon settings.
+
+        :param host_names: An optional index of known host names
+            shared with the EventListener.
+        """
+
+        return Comparator(self.client,
+                          self.userManager,
+                          filter = self.filter,
+                          workers = self.workers,
+                          bulk_mode = self.bulk_mode,
+                          partitions = self.partitions,
+                          partition_timeout = self.partition_timeout,
+                          partition_retries = self.partition_retries,
+                          snapshot = self.snapshot,
+                          interval = self.interval,
+                          jitter = self.jitter,
+                          max_rps = self.max_rps,
+                          max_writes = self.max_writes,
+                          retries = self.retries,
+                          metrics = self.metrics,
+                          shard = self.shard,
+                          package_lock = self.package_lock,
+                          host_names = host_names)
+
+    def plan(self) -> None:
+        """
+        Prints the ApiUsers the Comparator would add and delete
+        along with the timings. Doesn't make any changes.
+        """
+
+        self.make_comparator().plan()
+
+    def replay(self, path: str, speed: Optional[float] = None,
+               out: TextIO = sys.stdout) -> Dict[str, Any]:
+        """
+        Feeds the events recorded with the ``record`` option into
+        the EventListener and prints a JSON report with the
+        processing rate and the latency of the ApiUser requests made
+        for the events. The snapshot and the retry queue aren't used,
+        so the events can be replayed against a stand-in API to tune
+        the batching and concurrency settings.
+
+        :param path: The path to the recorded file.
+
+        :param speed: The replay speed: 1 is the original pace
+            (the default), 0 is the maximum speed.
+
+        :param out: The stream to print to.
+        """
+
+        replay = Replay(path, speed)
+        listener = EventListener(self.client,
+                                 self.userManager,
+                                 queue = self.queue,
+                                 filter = self.filter,
+                                 event_window = self.event_window,
+                                 event_batch = self.event_batch,
+                                 workers = self.workers,
+                                 backlog = self.backlog,
+                                 shard = self.shard,
+                                 package = self.make_package())
+        listener.connect(replay = replay)
+        listener.run()
+
+        report = replay.report()
+        json.dump(report, out, indent = 2)
+        print(file = out)
+        return report
+
+    def status(self, out: TextIO = sys.stdout) -> bool:
+        """
+        Queries the running daemon over the status socket in the
+        state directory and prints the rolling sync lag percentiles,
+        the high-water mark of the processed Host events, the queue
+        depth and the last comparison result. If the daemon isn't
+        running, prints the high-water mark stored in the snapshot,
+        which is opened for reading only. Returns whether the daemon
+        is running.
+
+        :param out: The stream to print to.
+        """
+
+        def ago(stamp: float) -> str:
+            return "%s (%.0f s ago)" % (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp)),
+                max(0.0, time.time() - stamp)
+            )
+
+        path = self.state_path(STATUS_SOCKET)
+        try:
+            if not path:
+                raise FileNotFoundError("no state directory")
+            report = query_status(path)
+        except (OSError, ValueError) as ex:
+            print("# The daemon isn't running or can't be reached: %s." % str(ex), file = out)
+            snapshot = open_snapshot(self.state_path(SNAPSHOT_FILE),
+                                     readonly = True)
+            watermark = snapshot.get("watermark") if snapshot else None
+            if watermark:
+                print("Host events processed up to %s." % ago(float(watermark)), file = out)
+            return False
+
+        lag = report["lag"]
+        if lag["writes"]:
+            print("Sync lag: p50 %.2f s, p99 %.2f s over %d ApiUser writes in the last %d s." % (lag["p50"], lag["p99"], lag["writes"], LAG_WINDOW), file = out)
+        else:
+            print("Sync lag: no ApiUser writes for Host events in the last %d s." % LAG_WINDOW, file = out)
+
+        if report["watermark"]:
+            print("Host events processed up to %s." % ago(report["watermark"]), file = out)
+
+        queue = report["queue"]
+        print("Queue depth: %d Host events, %d ApiUser requests." % (queue["events"], queue["requests"]), file = out)
+
+        c = report["comparison"]
+        if not c:
+            print("Last comparison: none finished yet.", file = out)
+        elif not c["success"]:
+            print("Last comparison: failed %s after %.2f s." % (ago(c["finished"]), c["seconds"]), file = out)
+        else:
+            print("Last comparison: finished %s in %.2f s: %d Hosts, %d ApiUsers, %d added, %d deleted, %d failed, %d deferred." % (ago(c["finished"]), c["seconds"], c["hosts"], c["apiusers"], c["added"], c["deleted"], c["failed"], c["deferred"]), file = out)
+
+        return True
+
+    def show_retries(self, out: TextIO = sys.stdout) -> None:
+        """
+        Prints the pending and dead-lettered ApiUser operations of
+        the retry queue, which is opened for reading only.
+
+        :param out: The stream to print to.
+        """
+
+        retries = open_retry_queue(self.state_path(RETRY_FILE),
+                                   readonly = True)
+        if not retries:
+            print("# No retry queue.", file = out)
+            return
+
+        now = time.time()
+        entries = retries.entries()
+        for e in entries:
+            if e.dead:
+                state = "dead after %d attempts" % e.attempts
+            else:
+                state = "attempt %d, next in %.0f s" % (e.attempts, max(0.0, e.next_at - now))
+            print("%s %s (%s): %s" % ("+" if e.op == ADD else "-", e.name, state, e.error), file = out)
+
+        dead = len([e for e in entries if e.dead])
+        print("# %d pending, %d dead-lettered ApiUser operations." % (len(entries) - dead, dead), file = out)
+
 # from icinga2apic.client import Client
 #
 # client = Client(config_file='/etc/sysconfig/icinga2-apiusers-sync')
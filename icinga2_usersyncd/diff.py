@@ -0,0 +1,92 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines a diff
+engine that compares sorted Host and ApiUser streams: of the names
+or of their fingerprints.
+"""
+
+from typing import Iterable, Iterator, Generator, Optional, Tuple, TypeVar
+
+ADD = "add"
+DELETE = "delete"
+
+T = TypeVar("T", str, int)
+
+def strip_prefix(name: str, prefix: str) -> str:
+    """
+    Removes the given prefix from the name if the name starts
+    with it. Unlike ``str.lstrip()`` removes the prefix as a
+    whole and only once.
+
+    :param name: An ApiUser name, i. e. ``host-hub``.
+
+    :param prefix: A user name prefix, i. e. ``host-``.
+    """
+
+    if prefix and name.startswith(prefix):
+        return name[len(prefix):]
+    return name
+
+def _advance(it: Iterator[T], current: Optional[T]) -> Optional[T]:
+    """
+    Returns the next value of a sorted stream skipping the
+    duplicates of the current one.
+    """
+
+    for value in it:
+        if current is not None and value < current:
+            raise ValueError("The stream isn't sorted: '%s' after '%s'" % (value, current))
+        if value != current:
+            return value
+    return None
+
+def merge_diff(hosts: Iterable[T], users: Iterable[T]) \
+    -> Generator[Tuple[str, T], None, None]:
+    """
+    Compares two sorted streams with a merge-join and yields
+    ``(ADD, name)`` for each host that has no user and
+    ``(DELETE, name)`` for each user that has no host. The streams
+    are consumed lazily and no extra copy of them is made.
+    Duplicate names are ignored. The streams may be of the name
+    fingerprints as well (see ``HostIndex``).
+
+    :param hosts: Sorted Host names.
+
+    :param users: Sorted ApiUser names with the prefix removed.
+    """
+
+    h_it = iter(hosts)
+    u_it = iter(users)
+    h = _advance(h_it, None)
+    u = _advance(u_it, None)
+
+    while h is not None or u is not None:
+        if u is None or (h is not None and h < u):
+            yield (ADD, h)
+            h = _advance(h_it, h)
+        elif h is None or u < h:
+            yield (DELETE, u)
+            u = _advance(u_it, u)
+        else:
+            h = _advance(h_it, h)
+            u = _advance(u_it, u)
@@ -0,0 +1,139 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines a
+single-process engine that runs the EventListener and the
+Comparator in threads.
+"""
+
+from typing import Callable, Optional
+from threading import Thread, Event
+from .logging import logger
+from .event_listener import EventListener
+from .comparator import Comparator
+from .hostindex import HostIndex
+import time
+
+class ThreadEngine():
+    """
+    Runs the EventListener and the Comparator in threads of a
+    single process sharing the API client, the connection pool and
+    the index of known host names. Both of them block on the API
+    requests, so the threads just let them wait in parallel. Unlike
+    the process mode, a reconnect of the event stream doesn't abort
+    a running reconciliation: a new one is started only if the
+    previous one has finished.
+    """
+
+    def __init__(self,
+                 make_listener: Callable[[], EventListener],
+                 make_comparator: Callable[[Optional[HostIndex]], Comparator],
+                 delay: float,
+                 host_names: Optional[HostIndex] = None):
+        """
+        :param make_listener: A factory of configured EventListener
+            objects.
+
+        :param make_comparator: A factory of configured Comparator
+            objects taking the index of known host names.
+
+        :param delay: A number of seconds to wait between connection
+            attempts and Comparator restarts.
+
+        :param host_names: An optional set of known host names
+            (i. e. loaded from the snapshot) to use instead of
+            requesting the initial host list.
+        """
+
+        self.make_listener = make_listener
+        self.make_comparator = make_comparator
+        self.delay = delay
+        self.host_names = host_names
+        self.comparator_thread: Optional[Thread] = None
+        self.wakeup = Event()
+
+    def run(self) -> None:
+        """
+        Connects the EventListener and keeps it connected, starting
+        the reconciliation after each (re)connection unless the
+        previous one is still running. Runs until the process is
+        terminated.
+        """
+
+        logger.info("Trying to connect the listener...")
+
+        while True:
+            listener = self.make_listener()
+
+            try:
+                listener.connect(host_names = self.host_names)
+            except Exception as ex:
+                logger.error(f"Listener not connected: %s. Making a retry after a timeout..." % str(ex))
+                time.sleep(self.delay)
+                continue
+
+            logger.info("Listener connected.")
+            self.host_names = listener.host_names
+
+            if self.comparator_thread is None or \
+               not self.comparator_thread.is_alive():
+                self.comparator_thread = Thread(target = self.comparator_loop,
+                                                name = "ComparatorLoop",
+                                                daemon = True)
+                self.comparator_thread.start()
+            else:
+                logger.info("Comparator is still running: scheduling the next comparison.")
+                self.wakeup.set()
+
+            try:
+                listener.run()
+            except Exception as ex:
+                logger.error(f"Listener exited with an error: %s." % str(ex))
+
+            logger.info("Listener finished. Making a retry after a timeout...")
+            time.sleep(self.delay)
+
+    def comparator_loop(self) -> None:
+        """
+        Runs the Comparator refreshing the shared set of known host
+        names. Makes a restart on error. If the comparison interval
+        is set, runs it periodically, or right after the current one
+        if the listener reconnects meanwhile.
+        """
+
+        while True:
+            comparator = self.make_comparator(self.host_names)
+            self.wakeup.clear()
+            try:
+                comparator.run()
+            except Exception as ex:
+                logger.error(f"Comparator exited with an error: %s. Making a retry after a timeout..." % str(ex))
+                time.sleep(self.delay)
+                continue
+
+            delay = comparator.next_delay()
+            if not delay and not self.wakeup.is_set():
+                break
+
+            logger.info("Next comparison in %.0f s." % delay)
+            self.wakeup.wait(delay or None)
+
+        logger.info("Comparator finished.")
@@ -25,13 +25,30 @@ events and translates them into corresponding ApiUser add and
 remove calls.
 """
 
-from typing import Optional, Generator
+from typing import Optional, Generator, Iterator, List, Dict, Any, Tuple, Set
 from icinga2apic.client import Client # type: ignore
-from threading import Lock
+from threading import Lock, Thread, Semaphore
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
 from .logging import logger
 from .apiuser import ApiUserManager
-from .constants import DEFAULT_QUEUE
+from .listing import ObjectStream
+from .filter import compile_filter, FilterError
+from .diff import ADD, DELETE
+from .snapshot import Snapshot
+from .retry import RetryQueue
+from .hostindex import HostIndex
+from .replay import Replay, record
+from .metrics import Metrics
+from .lag import LagTracker
+from .shard import Shard
+from .package import ApiUserPackage
+from .constants import DEFAULT_QUEUE, DEFAULT_EVENT_WINDOW, DEFAULT_EVENT_BATCH, DEFAULT_WORKERS, DEFAULT_BACKLOG, STATS_INTERVAL, STATUS_INTERVAL
 import json
+import time
+import zlib
+
+_END = None
 
 class EventListener():
     """
@@ -44,7 +61,17 @@ class EventListener():
                  client: Client,
                  userManager: ApiUserManager,
                  queue: Optional[str] = None,
-                 filter: Optional[str] = None):
+                 filter: Optional[str] = None,
+                 event_window: Optional[float] = None,
+                 event_batch: Optional[int] = None,
+                 workers: Optional[int] = None,
+                 backlog: Optional[int] = None,
+                 snapshot: Optional[Snapshot] = None,
+                 retries: Optional[RetryQueue] = None,
+                 record: Optional[str] = None,
+                 metrics: Optional[Metrics] = None,
+                 shard: Optional[Shard] = None,
+                 package: Optional[ApiUserPackage] = None):
         """
         :param client: An Icinga 2 REST API client object.
 
@@ -56,23 +83,105 @@ class EventListener():
 
         :param filter: An optional Host filter string (i. e.
             ``host.zone == "master"``).
+
+        :param event_window: A number of seconds to collect events
+            for before processing them as a batch. The default is
+            0.5 seconds.
+
+        :param event_batch: A maximum number of events to collect
+            into a batch. The default is 100.
+
+        :param workers: A number of writer threads making ApiUser
+            requests. The default is 4.
+
+        :param backlog: A maximum number of events waiting to
+            be processed and of ApiUser requests waiting to be
+            made. When it's reached, the event stream isn't read
+            until the event queue drains to a half of it. The default
+            is 10000.
+
+        :param snapshot: An optional snapshot to record the applied
+            changes and the high-water mark of the processed events
+            to.
+
+        :param retries: An optional queue to put the failed ApiUser
+            operations to and to take the ones to retry from.
+
+        :param record: An optional path to a gzip-compressed JSON
+            lines file to append the raw events received to.
+
+        :param metrics: Optional metrics to count the events, the
+            errors and the reconnects in.
+
+        :param shard: An optional shard to restrict the handled
+            Hosts to. The whole event stream is still received and
+            parsed: the events of the other Hosts are dropped right
+            after that.
+
+        :param package: The configuration package of the ``package``
+            bulk mode, if it's used. The ApiUsers defined by the
+            package can't be deleted with the object API, so they are
+            removed by deploying the package without them.
         """
 
         self.client = client
         self.queue = queue or DEFAULT_QUEUE
         self.filter = filter
-        self.stream: Optional[Generator] = None
+        self.event_window = DEFAULT_EVENT_WINDOW \
+            if event_window is None else event_window
+        self.event_batch = max(1, event_batch or DEFAULT_EVENT_BATCH)
+        self.workers = max(1, workers or DEFAULT_WORKERS)
+        self.backlog = max(1, backlog or DEFAULT_BACKLOG)
+        self.snapshot = snapshot
+        self.retries = retries
+        self.record = record
+        self.replay: Optional[Replay] = None
+        self.metrics = metrics
+        self.shard = shard
+        self.package = package
+        self.lag = LagTracker()
+        self.watermark: Optional[float] = None
+
+        try:
+            self.predicate = compile_filter(self.filter)
+            self.local_filter = True
+        except FilterError as ex:
+            logger.info("[EventListener] The Host filter will be evaluated by Icinga 2: %s." % str(ex))
+            self.predicate = None
+            self.local_filter = False
+        self.stream: Optional[Iterator[str]] = None
         self.lock = Lock()
         self.userManager = userManager
 
-    def connect(self) -> None:
+    def connect(self, host_names: Optional[HostIndex] = None,
+                replay: Optional[Replay] = None) -> None:
         """
         Opens the request to the event stream.
+
+        :param host_names: An optional index of known host names to
+            use (and update) instead of requesting the initial host
+            list. Otherwise a new index is made: if the listener is
+            connected before forking, the index is shared with the
+            processes forked after that.
+
+        :param replay: An optional replay of recorded events to read
+            instead of the Icinga 2 event stream. The completed
+            ApiUser requests are reported to it.
         """
 
-        logger.debug("[EventListener] Requesting inistal host list...")
-        hosts = self.client.objects.list("Host", filters = self.filter)
-        self.host_names = set([h["name"] for h in hosts])
+        try:
+            if host_names is not None:
+                self.host_names = host_names
+            else:
+                logger.debug("[EventListener] Requesting inistal host list...")
+                names = ObjectStream(self.client).names("Host", filters = self.filter)
+                if self.shard:
+                    names = (n for n in names if n in self.shard)
+                self.host_names = HostIndex(names)
+        except Exception as ex:
+            if self.metrics:
+                self.metrics.error(ex)
+            raise
 
         def subscribe() -> Generator:
             return self.client.events.subscribe(
@@ -85,46 +194,445 @@ class EventListener():
             if self.stream:
                 raise RuntimeError("Already run!")
             logger.debug("[EventListener] Requesting host create and delete events...")
-            self.stream = subscribe()
+            self.replay = replay
+            try:
+                self.stream = subscribe() if replay is None else iter(replay)
+            except Exception as ex:
+                if self.metrics:
+                    self.metrics.error(ex)
+                raise
+            if self.record:
+                self.stream = record(self.stream, self.record)
+
+        if self.metrics:
+            self.metrics.connected()
+
+    def mark(self, key: str, value: Optional[float]) -> None:
+        """
+        Stores the given time value in the snapshot, if any.
+        """
+
+        if not self.snapshot or value is None:
+            return
+
+        try:
+            self.snapshot.set(key, str(value))
+        except Exception as ex:
+            logger.warning("[EventListener] Unable to update the snapshot: %s." % str(ex))
 
     def run(self) -> None:
         """
         Runs the user synchronization proc for each created host.
+        The pipeline consists of three stages: a reader thread that
+        parses the event stream into a bounded queue, a dispatcher
+        (this thread) that coalesces the events per host over
+        ``event_window`` seconds or up to ``event_batch`` hosts and
+        resolves the net changes, and a pool of writer threads that
+        make the ApiUser requests. Requests for the same host are
+        made by the same writer in order.
         """
 
         with self.lock:
             if not self.stream:
                 raise RuntimeError("Not connected!")
+
+            self.events: Queue = Queue(maxsize = self.backlog)
+            self.writers = [
+                ThreadPoolExecutor(max_workers = 1,
+                                   thread_name_prefix = "EventWriter") \
+                for i in range(self.workers)
+            ]
+            self.slots = Semaphore(self.backlog)
+            self.pending = 0
+            self.pending_lock = Lock()
+            self.received = 0
+            self.coalesced = 0
+            self.suppressed = 0
+            self.submitted: Set[str] = set()
+
+            reader = Thread(target = self.read, args = (self.events,),
+                            name = "EventReader", daemon = True)
+            reader.start()
+
+            batch: Dict[str, Tuple[str, str]] = {}
+            deadline = 0.0
+            reported = published = time.monotonic()
             try:
-                for str_e in self.stream:
-                    e = json.loads(str_e)
-                    if e["object_type"] != "Host":
+                while True:
+                    if time.monotonic() - reported >= STATS_INTERVAL:
+                        reported = time.monotonic()
+                        if self.events.qsize() or self.pending:
+                            logger.info("[EventListener] Queue depth: %d events, %d ApiUser requests pending." % (self.events.qsize(), self.pending))
+                        logger.debug("[EventListener] %d Host events received, %d coalesced, %d flaps suppressed." % (self.received, self.coalesced, self.suppressed))
+                        self.retry()
+
+                    if time.monotonic() - published >= STATUS_INTERVAL:
+                        published = time.monotonic()
+                        self.publish()
+
+                    try:
+                        e = self.events.get(
+                            timeout = max(0.0, deadline - time.monotonic()) \
+                                if batch else STATUS_INTERVAL
+                        )
+                    except Empty:
+                        if batch:
+                            self.process(batch)
+                            batch = {}
                         continue
-                    if e["type"] == "ObjectCreated":
-                        try:
-                            hosts = self.client.objects.list(
-                                "Host",
-                                filters = (f"host.name == \"%s\"" % e["object_name"]) + ((f" && (%s)" % self.filter) if self.filter else "")
-                            )
-                            if hosts:
-                                self.host_names.add(hosts[0]["name"])
-                                self.userManager.add_api_user(hosts[0]["name"])
-                        except Exception as ex:
-                            logger.error(f"[EventListener] Error while trying to add ApiUser for host \"%s\": %s." % (e["object_name"], str(ex)))
-                    elif e["type"] == "ObjectDeleted":
-                        try:
-                            if e["object_name"] in self.host_names:
-                                self.host_names.remove(e["object_name"])
-                                self.userManager.del_api_user(
-                                    e["object_name"]
-                                )
-                        except Exception as ex:
-                            logger.error(f"[EventListener] Error while trying to delete ApiUser for host \"%s\": %s." % (e["object_name"], str(ex)))
-            except Exception as ex:
-                logger.error(f"[EventListener] Error while processing the stream: %s." % str(ex))
+
+                    if e is _END:
+                        break
+                    if e["object_type"] != "Host" or \
+                       e["type"] not in ("ObjectCreated", "ObjectDeleted"):
+                        continue
+
+                    self.received += 1
+                    if self.metrics:
+                        self.metrics.inc("events_received_total")
+                    if not batch:
+                        deadline = time.monotonic() + self.event_window
+                    name = e["object_name"]
+                    if e.get("timestamp"):
+                        self.lag.event(name, float(e["timestamp"]))
+                    if name in batch:
+                        self.coalesced += 1
+                        batch[name] = (batch[name][0], e["type"])
+                    else:
+                        batch[name] = (e["type"], e["type"])
+                    if len(batch) >= self.event_batch or \
+                       time.monotonic() >= deadline:
+                        self.process(batch)
+                        batch = {}
             finally:
+                if batch:
+                    self.process(batch)
+                for writer in self.writers:
+                    writer.shutdown(wait = True)
+                reader.join()
+                self.publish()
+                logger.info("[EventListener] Connection closed: %d Host events received, %d coalesced, %d flaps suppressed." % (self.received, self.coalesced, self.suppressed))
+
+    def read(self, events: Queue) -> None:
+        """
+        Reads the event stream putting the parsed events into the
+        given queue. Puts ``None`` at the end of the stream. When the
+        queue is full, the stream reading is paused (back-pressure)
+        until the queue drains to a half of ``backlog``, so it
+        isn't toggled on every event. The events of the Hosts of the
+        other shards are dropped.
+
+        :param events: The event queue.
+        """
+
+        low = self.backlog // 2
+        try:
+            for str_e in self.stream:
+                e = json.loads(str_e)
+                if self.shard and e.get("object_type") == "Host" and \
+                   e.get("object_name", "") not in self.shard:
+                    continue
+                if events.full():
+                    logger.warning("[EventListener] The event queue is full (%d events, %d ApiUser requests pending): pausing the event stream." % (events.qsize(), self.pending))
+                    with events.not_full:
+                        events.not_full.wait_for(
+                            lambda: len(events.queue) <= low
+                        )
+                    logger.info("[EventListener] The event queue is down to %d events: resuming the event stream." % events.qsize())
+                events.put(e)
+        except Exception as ex:
+            logger.error(f"[EventListener] Error while processing the stream: %s." % str(ex))
+            if self.metrics:
+                self.metrics.error(ex)
+        finally:
+            try:
                 self.stream.close()
-                logger.info("[EventListener] Connection closed.")
+            finally:
+                events.put(_END)
+
+    def process(self, batch: Dict[str, Tuple[str, str]]) -> None:
+        """
+        Processes a batch of coalesced Host events. Only the net
+        change of each host is applied: the last event defines
+        whether the host should have an ApiUser, and nothing is done
+        if it's already so. Opposing events within the batch (i. e.
+        a host deleted and created again) cancel out.
+
+        :param batch: A dictionary of the first and the last event
+            types for each host name.
+        """
+
+        created = [n for n, (first, last) in batch.items() \
+                   if last == "ObjectCreated"]
+        deleted = [n for n, (first, last) in batch.items() \
+                   if last == "ObjectDeleted"]
+        flapped = set([n for n, (first, last) in batch.items() \
+                       if first != last])
+
+        self.submitted = set()
+        if created:
+            self.add_hosts(created, flapped)
+        if deleted:
+            self.del_hosts(deleted, flapped)
+        if self.metrics:
+            self.metrics.inc("events_processed_total", len(batch))
+        self.lag.drop([n for n in batch if n not in self.submitted])
+
+    def publish(self) -> None:
+        """
+        Stores the high-water mark of the processed events in the
+        snapshot, if it has changed, and publishes it along with the
+        rolling lag percentiles and the queue depth in the metrics,
+        if any. Called every second.
+        """
+
+        watermark = self.lag.watermark()
+        if watermark != self.watermark:
+            self.mark("watermark", watermark)
+            self.watermark = watermark
+
+        if not self.metrics:
+            return
+
+        p50, p99, count = self.lag.percentiles()
+        self.metrics.set("sync_lag_seconds", p50, "0.5")
+        self.metrics.set("sync_lag_seconds", p99, "0.99")
+        self.metrics.set("sync_lag_writes", count)
+        if watermark is not None:
+            self.metrics.set("event_watermark_timestamp", watermark)
+        self.metrics.set("queue_depth", self.events.qsize(), "events")
+        self.metrics.set("queue_depth", self.pending, "requests")
+
+    def add_hosts(self, names: List[str],
+                  flapped: Optional[Set[str]] = None) -> None:
+        """
+        Schedules ApiUser creation for the given created hosts that
+        match the filter. The known hosts that were re-created and
+        don't match the filter anymore lose their ApiUsers.
+
+        :param names: The names of the created hosts.
+
+        :param flapped: The names of the hosts with opposing events
+            in the batch, if any.
+        """
+
+        flapped = flapped or set()
+        try:
+            hosts = set(self.resolve_hosts(names))
+        except Exception as ex:
+            for name in names:
+                logger.error(f"[EventListener] Error while trying to add ApiUser for host \"%s\": %s." % (name, str(ex)))
+            if self.metrics:
+                self.metrics.error(ex)
+            return
+
+        if self.metrics:
+            self.metrics.inc("events_filtered_total",
+                             len([n for n in names if n not in hosts]))
+
+        stale: List[str] = []
+        for name in names:
+            if name in hosts and name not in self.host_names:
+                self.host_names.add(name)
+                self.submit(ADD, [name])
+            elif name not in hosts and name in self.host_names:
+                stale.append(name)
+            elif name in flapped:
+                self.suppressed += 1
+
+        if stale:
+            self.del_hosts(stale)
+
+    def resolve_hosts(self, names: List[str]) -> List[str]:
+        """
+        Returns the names of the given created hosts that match the
+        filter. If the filter is compiled locally and refers to the
+        host name only, no request is made at all. Otherwise the
+        hosts are requested with a single query: either for the
+        attributes the compiled filter refers to, to evaluate it
+        locally, or with the filter itself if it can't be compiled
+        or evaluated.
+
+        :param names: The names of the created hosts.
+        """
+
+        if self.local_filter:
+            predicate = self.predicate
+            try:
+                if predicate is None:
+                    return names
+                if predicate.attrs <= set(["name"]):
+                    return [n for n in names if predicate({ "name": n })]
+
+                logger.debug("[EventListener] Requesting attributes of %d created hosts..." % len(names))
+                return [
+                    h["name"] for h in ObjectStream(self.client).list(
+                        "Host", attrs = sorted(predicate.attrs | set(["name"])),
+                        filters = "host.name in names",
+                        filter_vars = { "names": names }
+                    ) if predicate(h.get("attrs", {}))
+                ]
+            except FilterError as ex:
+                logger.debug("[EventListener] Can't evaluate the Host filter locally: %s." % str(ex))
+
+        logger.debug("[EventListener] Resolving %d created hosts..." % len(names))
+        return list(ObjectStream(self.client).names(
+            "Host",
+            filters = "host.name in names" + ((f" && (%s)" % self.filter) if self.filter else ""),
+            filter_vars = { "names": names }
+        ))
+
+    def del_hosts(self, names: List[str],
+                  flapped: Optional[Set[str]] = None) -> None:
+        """
+        Schedules ApiUser removal for the given deleted hosts that
+        were known to match the filter. In the ``package`` bulk mode
+        the users defined by the package are removed from it.
+
+        :param names: The names of the deleted hosts.
+
+        :param flapped: The names of the hosts with opposing events
+            in the batch, if any.
+        """
+
+        flapped = flapped or set()
+        lanes: Dict[int, List[str]] = {}
+        for name in names:
+            if name in self.host_names:
+                self.host_names.remove(name)
+                lanes.setdefault(self.lane(name), []).append(name)
+            elif name in flapped:
+                self.suppressed += 1
+
+        for lane_names in lanes.values():
+            self.submit(DELETE, lane_names)
+
+    def retry(self) -> None:
+        """
+        Schedules the failed ApiUser operations that are due for a
+        retry. The operations that don't match the known hosts (or
+        the shard) anymore are discarded. Deletions are batched per writer.
+        """
+
+        if not self.retries:
+            return
+
+        try:
+            due = self.retries.due(self.userManager.batch_size)
+        except Exception as ex:
+            logger.warning("[EventListener] Unable to read the retry queue: %s." % str(ex))
+            return
+
+        obsolete: List[str] = []
+        adds: List[str] = []
+        lanes: Dict[int, List[str]] = {}
+        for op, name in due:
+            if self.shard and name not in self.shard:
+                obsolete.append(name)
+            elif op == ADD and name in self.host_names:
+                adds.append(name)
+            elif op == DELETE and name not in self.host_names:
+                lanes.setdefault(self.lane(name), []).append(name)
+            else:
+                obsolete.append(name)
+
+        if obsolete:
+            try:
+                self.retries.discard(obsolete)
+            except Exception as ex:
+                logger.warning("[EventListener] Unable to update the retry queue: %s." % str(ex))
+
+        if len(due) > len(obsolete):
+            logger.info("[EventListener] Retrying %d failed ApiUser operations..." % (len(due) - len(obsolete)))
+
+        for name in adds:
+            self.submit(ADD, [name])
+        for lane_names in lanes.values():
+            self.submit(DELETE, lane_names)
+
+    def lane(self, name: str) -> int:
+        """
+        Returns the index of the writer that handles the requests
+        for the given host.
+        """
+
+        return zlib.crc32(name.encode("utf-8")) % len(self.writers)
+
+    def submit(self, op: str, names: List[str]) -> None:
+        """
+        Schedules an ApiUser operation for the given hosts on the
+        writer of the first host. Blocks while there are
+        ``backlog`` requests pending.
+
+        :param op: The operation: ``ADD`` or ``DELETE``.
+
+        :param names: The names of the hosts. All of them should
+            be handled by the same writer.
+        """
+
+        self.slots.acquire()
+        with self.pending_lock:
+            self.pending += 1
+        self.submitted.update(names)
+        self.writers[self.lane(names[0])].submit(self.write, op, names)
+
+    def write(self, op: str, names: List[str]) -> None:
+        """
+        Makes the ApiUser requests for the given operation and
+        hosts logging the errors. In the ``package`` bulk mode the
+        users defined by the package are removed from it, only the
+        rest are deleted with the object API.
+        """
+
+        try:
+            if op == ADD:
+                errors: Dict[str, Exception] = {}
+                for name in names:
+                    try:
+                        self.userManager.add_api_user(name)
+                    except Exception as ex:
+                        errors[name] = ex
+            else:
+                rest = names
+                errors = {}
+                if self.package:
+                    removed, errors = self.package.remove(names)
+                    done = set(removed)
+                    rest = [n for n in names \
+                            if n not in errors and n not in done]
+                if rest:
+                    errors.update(self.userManager.del_api_users(rest))
+        except Exception as ex:
+            errors = dict([(name, ex) for name in names])
+        finally:
+            with self.pending_lock:
+                self.pending -= 1
+            self.slots.release()
+
+        for name, ex in errors.items():
+            logger.error(f"[EventListener] Error while trying to %s ApiUser for host \"%s\": %s." % (op, name, str(ex)))
+            if self.metrics:
+                self.metrics.error(ex)
+
+        self.lag.done([n for n in names if n not in errors])
+        self.lag.drop(errors)
+
+        if self.replay:
+            self.replay.done(names)
+
+        if self.snapshot:
+            try:
+                self.snapshot.record(op, [n for n in names if n not in errors])
+            except Exception as ex:
+                logger.warning("[EventListener] Unable to update the snapshot: %s." % str(ex))
+
+        if self.retries:
+            try:
+                self.retries.discard([n for n in names if n not in errors])
+                for name, ex in errors.items():
+                    self.retries.push(op, name, str(ex))
+            except Exception as ex:
+                logger.warning("[EventListener] Unable to update the retry queue: %s." % str(ex))
 
 # client.objects.list('Host',
 #                     filters='host.zone == zone',
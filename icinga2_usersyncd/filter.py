@@ -0,0 +1,280 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines a compiler
+for a common subset of the Icinga 2 filter language that turns a
+Host filter string into a Python predicate.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from functools import lru_cache
+import re
+
+Attrs = Dict[str, Any]
+Expr = Callable[[Attrs], Any]
+
+class FilterError(ValueError):
+    """
+    Raised when a filter string uses a construct outside of the
+    supported subset of the Icinga 2 filter language.
+    """
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+      (?P<string>"(?:[^"\\]|\\.)*")
+    | (?P<number>\d+(?:\.\d+)?)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op>==|!=|<=|>=|&&|\|\||!in\b|[!<>()\[\],.])
+    )""", re.VERBOSE)
+
+_ESCAPES = { "n": "\n", "t": "\t", "r": "\r" }
+
+def _tokenize(text: str) -> List[Tuple[str, Any]]:
+    tokens: List[Tuple[str, Any]] = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if not m or m.end() == pos:
+            raise FilterError("Unsupported filter syntax at '%s'" % text[pos:].strip())
+        pos = m.end()
+        if m.group("string") is not None:
+            tokens.append(("value", re.sub(
+                r"\\(.)", lambda e: _ESCAPES.get(e.group(1), e.group(1)),
+                m.group("string")[1:-1]
+            )))
+        elif m.group("number") is not None:
+            tokens.append(("value", float(m.group("number"))))
+        elif m.group("name") in ("true", "false", "null"):
+            tokens.append(("value", { "true": True, "false": False,
+                                      "null": None }[m.group("name")]))
+        elif m.group("name") == "in":
+            tokens.append(("op", "in"))
+        elif m.group("name") is not None:
+            tokens.append(("name", m.group("name")))
+        else:
+            tokens.append(("op", m.group("op")))
+    return tokens
+
+def _lookup(value: Any, path: List[str]) -> Any:
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+@lru_cache(maxsize = 256)
+def _glob(pattern: str) -> "re.Pattern[str]":
+    # Icinga's match() only knows the * and ? wildcards: unlike
+    # fnmatch, [...] are literal characters.
+    return re.compile(re.escape(pattern).replace(r"\*", ".*")
+                      .replace(r"\?", "."), re.DOTALL)
+
+def _match(pattern: Any, value: Any) -> bool:
+    return isinstance(value, str) and \
+        _glob(str(pattern)).fullmatch(value) is not None
+
+def _compare(op: str, a: Any, b: Any) -> bool:
+    if a is None or b is None or type(a) != type(b) and \
+       not (isinstance(a, (int, float)) and isinstance(b, (int, float))):
+        raise FilterError("Can't compare %r and %r" % (a, b))
+    if op == "<":
+        return a < b
+    elif op == ">":
+        return a > b
+    elif op == "<=":
+        return a <= b
+    else:
+        return a >= b
+
+def _member(a: Any, b: Any) -> bool:
+    if b is None:
+        return False
+    if not isinstance(b, list):
+        raise FilterError("Can't check membership in %r" % b)
+    return a in b
+
+class _Parser():
+    """
+    A recursive descent parser producing Python closures.
+    """
+
+    def __init__(self, text: str, var: str):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+        self.var = var
+        self.attrs: Set[str] = set()
+
+    def peek(self) -> Optional[Tuple[str, Any]]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def accept(self, *ops: str) -> Optional[str]:
+        t = self.peek()
+        if t and t[0] == "op" and t[1] in ops:
+            self.pos += 1
+            return t[1]
+        return None
+
+    def expect(self, op: str) -> None:
+        if not self.accept(op):
+            raise FilterError("Expected '%s' in the filter" % op)
+
+    def parse(self) -> Expr:
+        expr = self.disjunction()
+        if self.peek():
+            raise FilterError("Unsupported filter syntax at '%s'" % str(self.peek()[1]))
+        return expr
+
+    def disjunction(self) -> Expr:
+        left = self.conjunction()
+        while self.accept("||"):
+            right = self.conjunction()
+            left = (lambda l, r: lambda a: bool(l(a)) or bool(r(a)))(left, right)
+        return left
+
+    def conjunction(self) -> Expr:
+        left = self.comparison()
+        while self.accept("&&"):
+            right = self.comparison()
+            left = (lambda l, r: lambda a: bool(l(a)) and bool(r(a)))(left, right)
+        return left
+
+    def comparison(self) -> Expr:
+        left = self.unary()
+        op = self.accept("==", "!=", "in", "!in", "<", ">", "<=", ">=")
+        if not op:
+            return left
+        right = self.unary()
+        if op == "==":
+            return lambda a: left(a) == right(a)
+        elif op == "!=":
+            return lambda a: left(a) != right(a)
+        elif op == "in":
+            return lambda a: _member(left(a), right(a))
+        elif op == "!in":
+            return lambda a: not _member(left(a), right(a))
+        else:
+            return lambda a: _compare(op, left(a), right(a))
+
+    def unary(self) -> Expr:
+        if self.accept("!"):
+            operand = self.unary()
+            return lambda a: not operand(a)
+        return self.primary()
+
+    def primary(self) -> Expr:
+        t = self.peek()
+        if t is None:
+            raise FilterError("Unexpected end of the filter")
+        self.pos += 1
+
+        if t[0] == "value":
+            value = t[1]
+            return lambda a: value
+        elif t == ("op", "("):
+            expr = self.disjunction()
+            self.expect(")")
+            return expr
+        elif t == ("op", "["):
+            items: List[Expr] = []
+            if not self.accept("]"):
+                items.append(self.disjunction())
+                while self.accept(","):
+                    items.append(self.disjunction())
+                self.expect("]")
+            return lambda a: [item(a) for item in items]
+        elif t == ("name", "match"):
+            self.expect("(")
+            pattern = self.disjunction()
+            self.expect(",")
+            value = self.disjunction()
+            self.expect(")")
+            return lambda a: _match(pattern(a), value(a))
+        elif t == ("name", self.var):
+            path: List[str] = []
+            while self.accept("."):
+                n = self.peek()
+                if not n or n[0] != "name":
+                    raise FilterError("Expected an attribute name in the filter")
+                self.pos += 1
+                path.append(n[1])
+            if not path:
+                raise FilterError("Expected an attribute of '%s' in the filter" % self.var)
+            self.attrs.add(path[0])
+            return lambda a: _lookup(a, path)
+        else:
+            raise FilterError("Unsupported filter syntax at '%s'" % str(t[1]))
+
+class CompiledFilter():
+    """
+    A Python predicate compiled from an Icinga 2 filter string.
+    Supports literals, arrays, attribute paths, ``==``, ``!=``,
+    ``in``, ``!in``, ``<``, ``>``, ``<=``, ``>=``, ``!``, ``&&``,
+    ``||`` and ``match()``.
+    """
+
+    def __init__(self, text: str, var: str = "host"):
+        """
+        :param text: The filter string, i. e.
+            ``host.zone == "master"``.
+
+        :param var: The name of the object variable used in the
+            filter. The default is ``host``.
+
+        :raises FilterError: If the filter can't be compiled.
+        """
+
+        parser = _Parser(text, var)
+        self.text = text
+        self.expr = parser.parse()
+        self.attrs = parser.attrs
+
+    def __call__(self, attrs: Attrs) -> bool:
+        """
+        Evaluates the filter against the given object attributes.
+
+        :param attrs: The object attributes, i. e.
+            ``{"name": "web1", "zone": "master"}``.
+
+        :raises FilterError: If the filter can't be evaluated
+            for the given attributes.
+        """
+
+        return bool(self.expr(attrs))
+
+def compile_filter(text: Optional[str], var: str = "host") \
+    -> Optional[CompiledFilter]:
+    """
+    Compiles the given filter string. Returns ``None`` if the
+    filter is empty.
+
+    :param text: The filter string.
+
+    :param var: The name of the object variable used in the
+        filter. The default is ``host``.
+
+    :raises FilterError: If the filter can't be compiled.
+    """
+
+    if not text or not text.strip():
+        return None
+    return CompiledFilter(text, var)
@@ -0,0 +1,338 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the compact
+index of the known host names shared by the EventListener and the
+Comparator.
+"""
+
+from typing import Iterable, Optional
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import islice
+from .registry import fingerprint
+from .constants import HOSTINDEX_CAPACITY, HOSTINDEX_OVERLAY, HOSTINDEX_JOURNAL, SORT_CHUNK
+import multiprocessing
+import mmap
+
+# The layout of the shared map in 64-bit words: the header, the
+# sorted overlay of the added and of the removed fingerprints, the
+# journal of ``(fingerprint, present)`` pairs and the sorted base.
+N_BASE, N_ADDED, N_REMOVED, N_JOURNAL = range(4)
+ADDED = 4
+REMOVED = ADDED + HOSTINDEX_OVERLAY
+JOURNAL = REMOVED + HOSTINDEX_OVERLAY
+BASE = JOURNAL + 2 * HOSTINDEX_JOURNAL
+
+NOT_TRACKING = 0xFFFFFFFFFFFFFFFF
+OVERFLOWN = 0xFFFFFFFFFFFFFFFE
+
+def sorted_fingerprints(fps: Iterable[int]) -> array:
+    """
+    Returns the given fingerprints sorted and without duplicates as
+    a compact array. The fingerprints are sorted in chunks that are
+    merged afterwards, so no more than a chunk of them is held as
+    Python integers at a time.
+    """
+
+    it = iter(fps)
+    runs = []
+    while True:
+        chunk = sorted(islice(it, SORT_CHUNK))
+        if not chunk:
+            break
+        runs.append(array("Q", chunk))
+
+    result = array("Q")
+    last = None
+    for fp in merge(*runs):
+        if fp != last:
+            result.append(fp)
+            last = fp
+    return result
+
+def in_sorted(fps: array, fp: int) -> bool:
+    """
+    Tells whether the fingerprint is in the given sorted array.
+    """
+
+    i = bisect_left(fps, fp)
+    return i < len(fps) and fps[i] == fp
+
+class HostIndex():
+    """
+    A compact set of host names shared between the processes: keeps
+    only the 64-bit fingerprints of the names (8 bytes per host
+    instead of a ``str`` object and a set slot) in an anonymous
+    shared memory map. An index created before forking is shared by
+    all the processes: the hosts added by the EventListener are seen
+    by the Comparator and the listing the Comparator replaces the
+    index with is seen by the EventListener. The map is reserved for
+    ``capacity`` hosts, but only the pages in use are allocated.
+
+    The bulk of the fingerprints is kept sorted and searched with
+    bisection. The changes are kept in small sorted overlays that
+    are merged into the base in place once one of them is full.
+    While a listing is in progress, the changes can be recorded in
+    a journal (see ``track()``) to be replayed on top of the listed
+    hosts by ``replace()``.
+    """
+
+    def __init__(self, names: Iterable[str] = (),
+                 capacity: Optional[int] = None):
+        """
+        :param names: The initial host names.
+
+        :param capacity: The maximum number of hosts. The default
+            is 16M.
+        """
+
+        self.capacity = capacity or HOSTINDEX_CAPACITY
+        self.lock = multiprocessing.Lock()
+        self.map = mmap.mmap(-1, (BASE + self.capacity) * 8)
+        self.words = memoryview(self.map).cast("Q")
+        self.words[N_JOURNAL] = NOT_TRACKING
+        self.replace(sorted_fingerprints(fingerprint(n) for n in names))
+
+    def find(self, region: int, count: int, fp: int) -> int:
+        """
+        Returns the position of the fingerprint in the given sorted
+        region of the map or -1 if it isn't there.
+        """
+
+        i = bisect_left(self.words, fp, region, region + count)
+        return i if i < region + count and self.words[i] == fp else -1
+
+    def insert(self, region: int, counter: int, fp: int) -> None:
+        """
+        Inserts the fingerprint into the given sorted region keeping
+        the number of its entries in the given header word.
+        """
+
+        n = self.words[counter]
+        i = bisect_left(self.words, fp, region, region + n)
+        self.map.move((i + 1) * 8, i * 8, (region + n - i) * 8)
+        self.words[i] = fp
+        self.words[counter] = n + 1
+
+    def delete(self, region: int, counter: int, fp: int) -> bool:
+        """
+        Deletes the fingerprint from the given sorted region. Returns
+        False if it isn't there.
+        """
+
+        n = self.words[counter]
+        i = self.find(region, n, fp)
+        if i < 0:
+            return False
+        self.map.move(i * 8, (i + 1) * 8, (region + n - i - 1) * 8)
+        self.words[counter] = n - 1
+        return True
+
+    def contains(self, fp: int) -> bool:
+        """
+        Tells whether the fingerprint is in the index. Should be
+        called with the lock held.
+        """
+
+        w = self.words
+        if self.find(ADDED, w[N_ADDED], fp) >= 0:
+            return True
+        return self.find(REMOVED, w[N_REMOVED], fp) < 0 and \
+            self.find(BASE, w[N_BASE], fp) >= 0
+
+    def __contains__(self, name: object) -> bool:
+        if not isinstance(name, str):
+            return False
+        fp = fingerprint(name)
+        with self.lock:
+            return self.contains(fp)
+
+    def __len__(self) -> int:
+        with self.lock:
+            w = self.words
+            return w[N_BASE] + w[N_ADDED] - w[N_REMOVED]
+
+    def add(self, name: str) -> None:
+        """
+        Adds the host name. Raises ``IndexError`` if the index
+        is full.
+        """
+
+        fp = fingerprint(name)
+        with self.lock:
+            self.record(fp, True)
+            self.add_fp(fp)
+
+    def discard(self, name: str) -> None:
+        """
+        Removes the host name if it's present.
+        """
+
+        fp = fingerprint(name)
+        with self.lock:
+            self.record(fp, False)
+            self.discard_fp(fp)
+
+    def remove(self, name: str) -> None:
+        """
+        Removes the host name. Raises ``KeyError`` if it isn't
+        present.
+        """
+
+        if name not in self:
+            raise KeyError(name)
+        self.discard(name)
+
+    def add_fp(self, fp: int) -> None:
+        """
+        Adds the fingerprint. Should be called with the lock held.
+        """
+
+        w = self.words
+        if self.delete(REMOVED, N_REMOVED, fp) or \
+           self.find(BASE, w[N_BASE], fp) >= 0 or \
+           self.find(ADDED, w[N_ADDED], fp) >= 0:
+            return
+        if w[N_BASE] + w[N_ADDED] >= self.capacity:
+            raise IndexError("The host index is full: %d hosts" % self.capacity)
+        self.insert(ADDED, N_ADDED, fp)
+        if w[N_ADDED] >= HOSTINDEX_OVERLAY:
+            self.compact()
+
+    def discard_fp(self, fp: int) -> None:
+        """
+        Removes the fingerprint if it's present. Should be called
+        with the lock held.
+        """
+
+        w = self.words
+        if self.delete(ADDED, N_ADDED, fp) or \
+           self.find(BASE, w[N_BASE], fp) < 0 or \
+           self.find(REMOVED, w[N_REMOVED], fp) >= 0:
+            return
+        self.insert(REMOVED, N_REMOVED, fp)
+        if w[N_REMOVED] >= HOSTINDEX_OVERLAY:
+            self.compact()
+
+    def record(self, fp: int, present: bool) -> None:
+        """
+        Appends the change to the journal if it's being recorded.
+        Should be called with the lock held.
+        """
+
+        w = self.words
+        n = w[N_JOURNAL]
+        if n == NOT_TRACKING or n == OVERFLOWN:
+            return
+        if n >= HOSTINDEX_JOURNAL:
+            w[N_JOURNAL] = OVERFLOWN
+            return
+        w[JOURNAL + 2 * n] = fp
+        w[JOURNAL + 2 * n + 1] = int(present)
+        w[N_JOURNAL] = n + 1
+
+    def track(self) -> None:
+        """
+        Starts recording the changes into the journal, i. e. before
+        listing the hosts to be passed to ``replace()``.
+        """
+
+        with self.lock:
+            self.words[N_JOURNAL] = 0
+
+    def untrack(self) -> None:
+        """
+        Stops recording the changes, i. e. if the listing has failed.
+        """
+
+        with self.lock:
+            self.words[N_JOURNAL] = NOT_TRACKING
+
+    def replace(self, fps: array) -> bool:
+        """
+        Replaces the whole set with the given fingerprints. The
+        changes recorded since ``track()``, if any, are applied on
+        top of them: the fingerprints are a snapshot taken at the
+        listing time, the changes made after that are newer. If more
+        changes were made than the journal can hold, the index is
+        left as is and False is returned.
+
+        :param fps: The sorted fingerprints without duplicates (see
+            ``sorted_fingerprints()``).
+        """
+
+        if len(fps) > self.capacity:
+            raise IndexError("The host index is full: %d hosts" % self.capacity)
+
+        w = self.words
+        with self.lock:
+            n = w[N_JOURNAL]
+            w[N_JOURNAL] = NOT_TRACKING
+            if n == OVERFLOWN:
+                return False
+
+            w[BASE:BASE + len(fps)] = fps
+            w[N_BASE] = len(fps)
+            w[N_ADDED] = 0
+            w[N_REMOVED] = 0
+            if n != NOT_TRACKING:
+                for i in range(JOURNAL, JOURNAL + 2 * n, 2):
+                    if w[i + 1]:
+                        self.add_fp(w[i])
+                    else:
+                        self.discard_fp(w[i])
+        return True
+
+    def compact(self) -> None:
+        """
+        Merges the overlays into the base in place: the removed
+        fingerprints are squeezed out and the added ones are
+        inserted moving the base parts between them. Should be
+        called with the lock held.
+        """
+
+        w = self.words
+        n = w[N_BASE]
+        end = BASE + n
+
+        pos = [bisect_left(w, fp, BASE, end) \
+               for fp in w[REMOVED:REMOVED + w[N_REMOVED]]]
+        for k, p in enumerate(pos):
+            stop = pos[k + 1] if k + 1 < len(pos) else end
+            self.map.move((p - k) * 8, (p + 1) * 8, (stop - p - 1) * 8)
+        n -= len(pos)
+        end = BASE + n
+
+        added = w[ADDED:ADDED + w[N_ADDED]].tolist()
+        pos = [bisect_left(w, fp, BASE, end) for fp in added]
+        for k in reversed(range(len(added))):
+            p = pos[k]
+            self.map.move((p + k + 1) * 8, p * 8, (end - p) * 8)
+            w[p + k] = added[k]
+            end = p
+        n += len(added)
+
+        w[N_BASE] = n
+        w[N_ADDED] = 0
+        w[N_REMOVED] = 0
@@ -0,0 +1,117 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the tracking
+of the lag from a Host event to the completed ApiUser write.
+"""
+
+from typing import Optional, Iterable, Dict, Tuple
+from collections import deque
+from threading import Lock
+from .constants import LAG_WINDOW, LAG_SAMPLES
+import time
+
+class LagTracker():
+    """
+    Tracks the time from the ``timestamp`` of a Host event to the
+    completion of the ApiUser write made for it. The lags of the
+    writes completed within the last ``window`` seconds are kept to
+    compute the rolling percentiles. The high-water mark is the
+    timestamp all Host events up to which are fully processed: the
+    earliest event still waiting for a write or, if there's none,
+    the latest event seen.
+    """
+
+    def __init__(self, window: float = LAG_WINDOW,
+                 samples: int = LAG_SAMPLES):
+        """
+        :param window: A number of seconds to compute the rolling
+            percentiles over.
+
+        :param samples: A maximum number of lags to keep.
+        """
+
+        self.window = window
+        self.waiting: Dict[str, float] = {}
+        self.lags: deque = deque(maxlen = samples)
+        self.latest: Optional[float] = None
+        self.lock = Lock()
+
+    def event(self, name: str, stamp: float) -> None:
+        """
+        Registers a Host event. If there's one for the host already
+        waiting for a write, the earlier timestamp is kept.
+        """
+
+        with self.lock:
+            self.waiting.setdefault(name, stamp)
+            self.latest = max(self.latest or stamp, stamp)
+
+    def done(self, names: Iterable[str]) -> None:
+        """
+        Registers the completed ApiUser writes for the given hosts.
+        """
+
+        now = time.time()
+        with self.lock:
+            for name in names:
+                stamp = self.waiting.pop(name, None)
+                if stamp is not None:
+                    self.lags.append((now, max(0.0, now - stamp)))
+
+    def drop(self, names: Iterable[str]) -> None:
+        """
+        Forgets the events of the given hosts without measuring the
+        lag: no write is needed or it has failed (and is left to
+        the retry queue).
+        """
+
+        with self.lock:
+            for name in names:
+                self.waiting.pop(name, None)
+
+    def watermark(self) -> Optional[float]:
+        """
+        Returns the high-water mark or None if no events were seen.
+        """
+
+        with self.lock:
+            if self.waiting:
+                return min(self.waiting.values())
+            return self.latest
+
+    def percentiles(self) -> Tuple[float, float, int]:
+        """
+        Returns the median and the 99th percentile of the lags
+        measured within the window, and the number of them.
+        """
+
+        with self.lock:
+            since = time.time() - self.window
+            while self.lags and self.lags[0][0] < since:
+                self.lags.popleft()
+            lags = sorted(lag for t, lag in self.lags)
+
+        if not lags:
+            return 0.0, 0.0, 0
+        pick = lambda p: lags[min(len(lags) - 1, int(len(lags) * p))]
+        return pick(0.50), pick(0.99), len(lags)
@@ -0,0 +1,238 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines a streaming
+object listing that parses the Icinga 2 API response incrementally.
+"""
+
+from typing import Optional, Generator, Iterable, Sequence, Dict, Any, List
+from icinga2apic.objects import Objects # type: ignore
+from .logging import logger
+from .pool import PooledBase
+from functools import partial
+import codecs
+import json
+import re
+import time
+
+CHUNK_SIZE = 64 * 1024
+
+_WS = re.compile(r"[\s,]*")
+_RESULTS = re.compile(r"\"results\"\s*:\s*\[")
+
+def iter_results(chunks: Iterable[bytes]) -> Generator[Dict[str, Any], None, None]:
+    """
+    Incrementally parses an Icinga 2 API response body of the form
+    ``{"results": [...]}`` and yields the elements of the
+    ``results`` array one by one. Only the current element and the
+    current chunk are held in memory.
+
+    :param chunks: The response body as a sequence of byte chunks.
+    """
+
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+    eof = False
+
+    def more() -> bool:
+        nonlocal buf, pos, eof
+        for chunk in chunks:
+            if chunk:
+                buf = buf[pos:] + text.decode(chunk)
+                pos = 0
+                return True
+        eof = True
+        buf = buf[pos:] + text.decode(b"", final = True)
+        pos = 0
+        return False
+
+    while True:
+        m = _RESULTS.search(buf)
+        if m:
+            pos = m.end()
+            break
+        if not more():
+            raise ValueError("No results in the response")
+
+    while True:
+        pos = _WS.match(buf, pos).end()
+        if pos >= len(buf):
+            if eof or not more():
+                raise ValueError("Unexpected end of the response")
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof or not more():
+                raise
+            continue
+        pos = end
+        yield obj
+
+class ObjectStream(PooledBase):
+    """
+    Lists Icinga 2 objects streaming the response and yielding
+    objects as they are parsed instead of materializing the whole
+    result list. Note, that only the transfer is streamed: it's up
+    to the caller what of the objects is kept.
+    """
+
+    base_url_path = "v1/objects"
+
+    def __init__(self, manager, timeout: Optional[float] = None):
+        """
+        :param manager: An Icinga 2 REST API client object.
+
+        :param timeout: An optional number of seconds a single
+            listing may take, including the time to connect and
+            to read the whole response.
+        """
+
+        super().__init__(manager)
+        self.timeout = timeout
+
+    def _create_session(self, method = "POST"):
+        session = super()._create_session(method)
+        if self.timeout:
+            session.post = partial(session.post, timeout = self.timeout)
+        return session
+
+    def list(self,
+             object_type: str,
+             attrs: Optional[Sequence[str]] = None,
+             filters: Optional[str] = None,
+             filter_vars: Optional[Dict[str, Any]] = None) \
+             -> Generator[Dict[str, Any], None, None]:
+        """
+        Yields objects of the given type one by one. No joins are
+        requested.
+
+        :param object_type: The Icinga 2 object type, i. e.
+            ``Host``.
+
+        :param attrs: The object attributes to request. The
+            default is ``["name"]``.
+
+        :param filters: An optional object filter string.
+
+        :param filter_vars: Optional filter variables.
+        """
+
+        payload: Dict[str, Any] = { "attrs": list(attrs or ["name"]) }
+        if filters:
+            payload["filter"] = filters
+        if filter_vars:
+            payload["filter_vars"] = filter_vars
+
+        url_path = "%s/%s" % (self.base_url_path,
+                              Objects._convert_object_type(object_type))
+        deadline = (time.monotonic() + self.timeout) if self.timeout else None
+        response = self._request("GET", url_path, payload, stream = True)
+
+        def chunks() -> Generator[bytes, None, None]:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if deadline and time.monotonic() > deadline:
+                    raise TimeoutError("Listing of %s objects took more than %s s" % (object_type, self.timeout))
+                yield chunk
+
+        try:
+            yield from iter_results(chunks())
+        finally:
+            response.close()
+
+    def names(self,
+              object_type: str,
+              filters: Optional[str] = None,
+              filter_vars: Optional[Dict[str, Any]] = None) \
+              -> Generator[str, None, None]:
+        """
+        Yields the names of the objects of the given type. Only the
+        ``name`` attribute is requested.
+
+        :param object_type: The Icinga 2 object type, i. e.
+            ``Host``.
+
+        :param filters: An optional object filter string.
+
+        :param filter_vars: Optional filter variables.
+        """
+
+        for obj in self.list(object_type, filters = filters,
+                             filter_vars = filter_vars):
+            yield obj["name"]
+
+def partition_filters(stream: ObjectStream,
+                      partitions: Sequence[str],
+                      filter: Optional[str] = None) -> List[str]:
+    """
+    Expands a Host listing partition specification into a list of
+    Host filter strings, each one combined with the given filter.
+    The specification is either:
+
+    * ``zone`` to make a partition per zone plus one for the Hosts
+      in none of the zones;
+
+    * ``prefix:N`` to split the host name space into N ranges;
+
+    * a list of arbitrary Host filter strings, one per partition.
+
+    :param stream: An ObjectStream to list zones with.
+
+    :param partitions: The partition specification.
+
+    :param filter: An optional Host filter string (i. e.
+        ``host.zone == "master"``).
+    """
+
+    def quote(value: str) -> str:
+        return json.dumps(value, ensure_ascii = False)
+
+    shards: List[str]
+    if list(partitions) == ["zone"]:
+        zones = sorted(stream.names("Zone"))
+        shards = [("host.zone == %s" % quote(z)) for z in zones] + \
+            ["!(host.zone in [%s])" % ", ".join([quote(z) for z in zones])]
+    elif len(partitions) == 1 and partitions[0].startswith("prefix:"):
+        n = max(1, int(partitions[0][len("prefix:"):]))
+        alphabet = "0123456789abcdefghijklmnopqrstuvwxyz"
+        bounds = [alphabet[(i * len(alphabet)) // n] for i in range(1, n)]
+        bounds = sorted(set(bounds))
+        shards = []
+        for i in range(len(bounds) + 1):
+            cond = []
+            if i > 0:
+                cond.append("host.name >= %s" % quote(bounds[i - 1]))
+            if i < len(bounds):
+                cond.append("host.name < %s" % quote(bounds[i]))
+            shards.append(" && ".join(cond) or "true")
+    else:
+        shards = [p for p in partitions if p]
+
+    if filter:
+        return [("(%s) && (%s)" % (filter, shard)) for shard in shards]
+    else:
+        return shards
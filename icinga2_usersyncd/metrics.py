@@ -0,0 +1,287 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the metrics
+shared by all processes and the HTTP endpoint exposing them in the
+Prometheus text format.
+"""
+
+from typing import Optional, Iterator, List, Dict, Tuple, Sequence
+from multiprocessing.sharedctypes import RawArray
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from icinga2apic.exceptions import Icinga2ApiRequestException # type: ignore
+from requests.exceptions import ConnectionError, Timeout
+from .logging import logger
+from .ratelimit import is_overload
+from .constants import METRICS_PREFIX, DEFAULT_METRICS_ADDRESS
+import multiprocessing
+import time
+
+API_CALLS = [ "list", "create", "delete", "events", "package", "other" ]
+ERROR_TYPES = [ "timeout", "connection", "overload", "api", "other" ]
+COMPARISON_SETS = [ "hosts", "apiusers", "added", "deleted", "failed", "deferred" ]
+
+API_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 ]
+RUN_BUCKETS = [ 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600 ]
+
+# Name, type, help, label name and values, histogram buckets:
+METRICS: List[Tuple[str, str, str, Optional[str], Sequence[str], Sequence[float]]] = [
+    ("events_received_total", "counter",
+     "Host create and delete events read from the event stream.",
+     None, [], []),
+    ("events_processed_total", "counter",
+     "Host events processed after coalescing.",
+     None, [], []),
+    ("events_filtered_total", "counter",
+     "Created Hosts skipped as not matching the Host filter.",
+     None, [], []),
+    ("apiusers_created_total", "counter",
+     "ApiUsers created.",
+     None, [], []),
+    ("apiusers_deleted_total", "counter",
+     "ApiUsers deleted.",
+     None, [], []),
+    ("errors_total", "counter",
+     "Errors of the event stream and the ApiUser operations by type.",
+     "type", ERROR_TYPES, []),
+    ("reconnects_total", "counter",
+     "Reconnections of the event stream.",
+     None, [], []),
+    ("api_request_seconds", "histogram",
+     "Icinga 2 API request latency up to the response headers.",
+     "call", API_CALLS, API_BUCKETS),
+    ("comparison_seconds", "histogram",
+     "Comparison run duration.",
+     None, [], RUN_BUCKETS),
+    ("comparison_objects", "gauge",
+     "Object set sizes of the last comparison.",
+     "set", COMPARISON_SETS, []),
+    ("comparison_last_timestamp", "gauge",
+     "Time the last comparison has finished at.",
+     None, [], []),
+    ("comparison_last_seconds", "gauge",
+     "Duration of the last comparison.",
+     None, [], []),
+    ("comparison_last_success", "gauge",
+     "Whether the last comparison has succeeded.",
+     None, [], []),
+    ("sync_lag_seconds", "gauge",
+     "Lag from a Host event to the completed ApiUser write over the last 5 minutes.",
+     "quantile", [ "0.5", "0.99" ], []),
+    ("sync_lag_writes", "gauge",
+     "ApiUser writes the lag quantiles are computed over.",
+     None, [], []),
+    ("event_watermark_timestamp", "gauge",
+     "Timestamp of the Host events all events up to which are processed.",
+     None, [], []),
+    ("queue_depth", "gauge",
+     "Host events and ApiUser requests waiting in the EventListener.",
+     "queue", [ "events", "requests" ], []),
+]
+
+def error_type(ex: BaseException) -> str:
+    """
+    Returns the type of the given error to count it under.
+    """
+
+    if isinstance(ex, Timeout):
+        return "timeout"
+    if isinstance(ex, ConnectionError):
+        return "connection"
+    if isinstance(ex, Icinga2ApiRequestException):
+        return "overload" if is_overload(ex) else "api"
+    return "other"
+
+def api_call(method: str, url: str) -> str:
+    """
+    Returns the kind of the Icinga 2 API call for the given method
+    override and URL.
+    """
+
+    if "/v1/events" in url:
+        return "events"
+    if "/v1/config/" in url:
+        return "package"
+    if "/v1/objects/" in url:
+        return { "GET": "list", "PUT": "create", "DELETE": "delete" }.get(method.upper(), "other")
+    return "other"
+
+class Metrics():
+    """
+    A fixed set of counters, gauges and histograms (see ``METRICS``)
+    kept in a single array in shared memory: the metrics created
+    before forking are updated by all processes, so any of them
+    renders the aggregated view.
+    """
+
+    def __init__(self):
+        self.lock = multiprocessing.Lock()
+        self.slots: Dict[Tuple[str, Optional[str]], int] = {}
+        size = 1 # the connected flag
+        for name, kind, _, _, labels, buckets in METRICS:
+            for label in (labels or [None]):
+                self.slots[(name, label)] = size
+                # Buckets (the last is +Inf) and the sum:
+                size += len(buckets) + 2 if kind == "histogram" else 1
+        self.values = RawArray("d", size)
+        self.bounds = dict((m[0], m[5]) for m in METRICS)
+
+    def slot(self, name: str, label: Optional[str]) -> int:
+        return self.slots[(name, label)]
+
+    def inc(self, name: str, value: float = 1, label: Optional[str] = None) -> None:
+        """
+        Increments the counter.
+        """
+
+        slot = self.slot(name, label)
+        with self.lock:
+            self.values[slot] += value
+
+    def set(self, name: str, value: float, label: Optional[str] = None) -> None:
+        """
+        Sets the gauge.
+        """
+
+        self.values[self.slot(name, label)] = value
+
+    def get(self, name: str, label: Optional[str] = None) -> float:
+        """
+        Returns the value of the counter or the gauge.
+        """
+
+        return self.values[self.slot(name, label)]
+
+    def observe(self, name: str, value: float, label: Optional[str] = None) -> None:
+        """
+        Adds an observation to the histogram.
+        """
+
+        buckets = self.bounds[name]
+        slot = self.slot(name, label)
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        with self.lock:
+            self.values[slot + i] += 1
+            self.values[slot + len(buckets) + 1] += value
+
+    @contextmanager
+    def timer(self, name: str, label: Optional[str] = None) -> Iterator[None]:
+        """
+        Observes the duration of the enclosed block in the histogram.
+        """
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, label)
+
+    def error(self, ex: BaseException) -> None:
+        """
+        Counts the given error by its type.
+        """
+
+        self.inc("errors_total", label = error_type(ex))
+
+    def connected(self) -> None:
+        """
+        Registers a connection of the event stream. All connections
+        but the first one are counted as reconnects.
+        """
+
+        with self.lock:
+            if self.values[0]:
+                self.values[self.slot("reconnects_total", None)] += 1
+            self.values[0] = 1
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+
+        with self.lock:
+            values = self.values[:]
+
+        lines: List[str] = []
+        for name, kind, help, label_name, labels, buckets in METRICS:
+            full = METRICS_PREFIX + name
+            lines.append("# HELP %s %s" % (full, help))
+            lines.append("# TYPE %s %s" % (full, kind))
+            for label in (labels or [None]):
+                slot = self.slot(name, label)
+                tags = ['%s="%s"' % (label_name, label)] if label else []
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (full, fmt_tags(tags), fmt(values[slot])))
+                    continue
+                count = 0.0
+                for i, bound in enumerate(list(buckets) + [float("inf")]):
+                    count += values[slot + i]
+                    le = 'le="%s"' % ("+Inf" if bound == float("inf") else fmt(bound))
+                    lines.append("%s_bucket%s %s" % (full, fmt_tags(tags + [le]), fmt(count)))
+                lines.append("%s_sum%s %s" % (full, fmt_tags(tags), fmt(values[slot + len(buckets) + 1])))
+                lines.append("%s_count%s %s" % (full, fmt_tags(tags), fmt(count)))
+        return "\n".join(lines) + "\n"
+
+def fmt(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+def fmt_tags(tags: List[str]) -> str:
+    return ("{%s}" % ",".join(tags)) if tags else ""
+
+def serve_metrics(metrics: Metrics, port: int,
+                  address: Optional[str] = None) -> ThreadingHTTPServer:
+    """
+    Starts serving the metrics on ``http://ADDRESS:PORT/metrics`` in
+    a background thread. Returns the server.
+
+    :param metrics: The metrics to serve.
+
+    :param port: The port to listen on.
+
+    :param address: The address to listen on. The default is
+        127.0.0.1: the endpoint is local.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            data = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args) -> None:
+            logger.debug("[Metrics] %s - %s" % (self.address_string(), format % args))
+
+    server = ThreadingHTTPServer((address or DEFAULT_METRICS_ADDRESS, port), Handler)
+    server.daemon_threads = True
+    Thread(target = server.serve_forever, name = "Metrics", daemon = True).start()
+    logger.info("[Metrics] Serving metrics on http://%s:%d/metrics." % server.server_address[:2])
+    return server
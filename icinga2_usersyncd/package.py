@@ -0,0 +1,313 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines a bulk
+provisioning backend that deploys ApiUser objects as an Icinga 2
+configuration package.
+"""
+
+from typing import Iterable, Dict, Any, List, Set, Optional, Tuple, ContextManager
+from .logging import logger
+from .pool import PooledBase
+from .apiuser import ApiUserManager
+from .listing import ObjectStream
+from .shard import Shard
+from .constants import DEFAULT_PACKAGE, STAGE_TIMEOUT, STAGE_POLL
+from contextlib import nullcontext
+from threading import Lock
+import json
+import time
+
+class StageError(RuntimeError):
+    """
+    Raised when an uploaded configuration package stage fails the
+    validation or isn't activated in time.
+    """
+
+def package_name(shard: Optional[Shard] = None) -> str:
+    """
+    Returns the name of the configuration package to deploy the
+    ApiUsers of the given shard (or of all Hosts) to.
+    """
+
+    return shard.suffix(DEFAULT_PACKAGE) if shard else DEFAULT_PACKAGE
+
+class ConfigPackages(PooledBase):
+    """
+    Icinga 2 configuration package API (``/v1/config``), which
+    isn't covered by the ``icinga2apic`` client.
+    """
+
+    base_url_path = "v1/config"
+
+    def list(self) -> List[Dict[str, Any]]:
+        """
+        Returns the list of configuration packages.
+        """
+
+        return self._request("GET", self.base_url_path + "/packages")["results"]
+
+    def create(self, package: str) -> Dict[str, Any]:
+        """
+        Creates an empty configuration package.
+
+        :param package: The package name.
+        """
+
+        return self._request("POST", self.base_url_path + "/packages/" + package)
+
+    def upload(self, package: str, files: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Uploads a new stage to the configuration package. Icinga 2
+        validates the stage and activates it making a reload.
+
+        :param package: The package name.
+
+        :param files: A dictionary of file paths relative to the
+            stage root and their contents.
+        """
+
+        return self._request("POST", self.base_url_path + "/stages/" + package,
+                             { "files": files })
+
+    def file(self, package: str, stage: str, path: str) -> str:
+        """
+        Returns the contents of a file of the given stage, i. e.
+        ``status`` or ``startup.log`` written by the validation.
+
+        :param package: The package name.
+
+        :param stage: The stage name.
+
+        :param path: The file path relative to the stage root.
+        """
+
+        return self._request("GET", "/".join([self.base_url_path, "files",
+                                              package, stage, path]),
+                             stream = True).text
+
+class ApiUserPackage():
+    """
+    Deploys a set of ApiUser objects as a single Icinga 2
+    configuration package stage, i. e. with a single request
+    and a single configuration reload on the Icinga 2 side.
+
+    Note that each stage replaces the whole package, so the
+    complete set of package-managed users should be deployed
+    every time. Objects defined by a package can't be deleted
+    with the object API: they are removed by deploying the
+    package without them (see ``remove()``).
+    """
+
+    def __init__(self, userManager: ApiUserManager,
+                 package: str = DEFAULT_PACKAGE,
+                 lock: Optional[Any] = None):
+        """
+        :param userManager: An ApiUserManager instance to take
+            the client, the user name prefix and templates from.
+
+        :param package: The configuration package name. The
+            default is "icinga2-usersyncd".
+
+        :param lock: An optional lock (i. e. a
+            ``multiprocessing.Lock`` created before forking) to
+            serialize the deployments made by the Comparator and the
+            EventListener, so a stage based on the package contents
+            doesn't undo a concurrent one.
+        """
+
+        self.userManager = userManager
+        self.package = package
+        self.packages = ConfigPackages(userManager.client)
+        self.lock = lock
+        self.pending: Set[str] = set()
+        self.outcomes: Dict[str, Optional[Exception]] = {}
+        self.pending_lock = Lock()
+
+    def locked(self) -> ContextManager:
+        return self.lock if self.lock is not None else nullcontext()
+
+    def render(self, hostnames: Iterable[str]) -> str:
+        """
+        Renders ApiUser object definitions for the given hosts.
+
+        :param hostnames: The names of the hosts to render the
+            ApiUser objects for.
+        """
+
+        def quote(value: str) -> str:
+            return json.dumps(value, ensure_ascii = False)
+
+        imports = "".join([
+            "  import %s\n" % quote(t) for t in self.userManager.templates
+        ])
+
+        return "".join([
+            "object ApiUser %s {\n%s  client_cn = %s\n}\n\n" % \
+            (quote(self.userManager.prefix + h), imports, quote(h)) \
+            for h in sorted(hostnames)
+        ])
+
+    def deploy(self, hostnames: Iterable[str]) -> str:
+        """
+        Deploys ApiUser objects for the given hosts as a new stage
+        of the configuration package, creating the package if it
+        doesn't exist.
+
+        :param hostnames: The names of the hosts to deploy the
+            ApiUser objects for.
+
+        :return: The name of the activated stage. Raises
+            ``StageError`` if the stage fails the validation.
+        """
+
+        with self.locked():
+            return self._deploy(hostnames)
+
+    def remove(self, hostnames: Iterable[str]) \
+        -> Tuple[List[str], Dict[str, Exception]]:
+        """
+        Removes the ApiUser objects of the given hosts from the
+        configuration package: lists the users currently defined by
+        the package and deploys it without the given ones, if any
+        of them are there. The removals requested by several threads
+        while a deployment is in progress are made with the next
+        single deployment.
+
+        Note, that each deployment lists all the users of the
+        package and uploads all the remaining ones, and Icinga 2
+        reloads its configuration to activate the stage: a removal
+        costs O(N) in the package size, whatever the number of the
+        removed users.
+
+        :param hostnames: The names of the deleted hosts.
+
+        :return: The names of the hosts which ApiUsers were removed
+            from the package and the errors for the ones which
+            ApiUsers couldn't be removed (i. e. the stage failed the
+            validation). The users of the other hosts aren't
+            package-managed and should be deleted with the object
+            API, where a missing user isn't an error.
+        """
+
+        names = set(hostnames)
+        with self.pending_lock:
+            self.pending.update(names)
+
+        with self.locked():
+            with self.pending_lock:
+                batch, self.pending = self.pending, set()
+            if batch:
+                self._remove(batch)
+
+        with self.pending_lock:
+            outcomes = dict((n, self.outcomes.pop(n)) \
+                            for n in names if n in self.outcomes)
+
+        removed = sorted(n for n, ex in outcomes.items() if ex is None)
+        errors = dict((n, ex) for n, ex in outcomes.items() if ex is not None)
+        return removed, errors
+
+    def _remove(self, batch: Set[str]) -> None:
+        """
+        Removes the users of the given hosts requested by all the
+        threads and stores the outcome for each package-managed one
+        (or for all of them, if the package can't be listed) to be
+        picked by the requesting thread. Should be called with the
+        lock held.
+        """
+
+        prefix = self.userManager.prefix
+        removed = batch
+        outcome: Optional[Exception] = None
+        try:
+            current = set(n[len(prefix):] for n in ObjectStream(
+                self.userManager.client
+            ).names("ApiUser",
+                    filters = "obj.package == package && match(prefix + \"*\", obj.name)",
+                    filter_vars = { "package": self.package,
+                                    "prefix": prefix }))
+            removed = batch & current
+            if removed:
+                self._deploy(current.difference(removed))
+                logger.info(f"[ApiUser] Removed %d API users from config package '%s'." % (len(removed), self.package))
+                self.userManager.count("apiusers_deleted_total", len(removed))
+        except Exception as ex:
+            outcome = ex
+
+        with self.pending_lock:
+            self.outcomes.update(dict.fromkeys(removed, outcome))
+
+    def _deploy(self, hostnames: Iterable[str]) -> str:
+        if not [p for p in self.packages.list() \
+                if p.get("name") == self.package]:
+            logger.debug(f"[ApiUser] Creating config package '%s'..." % self.package)
+            self.packages.create(self.package)
+
+        config = self.render(hostnames)
+        logger.debug(f"[ApiUser] Uploading config package '%s' (%d bytes)..." % (self.package, len(config)))
+        with self.userManager.request():
+            resp = self.packages.upload(self.package, {
+                "conf.d/apiusers.conf": config
+            })
+
+        stage = resp["results"][0].get("stage", "")
+        logger.debug(f"[ApiUser] Config package '%s' stage '%s' uploaded. Waiting for the validation..." % (self.package, stage))
+        self.wait(stage)
+        logger.info(f"[ApiUser] Config package '%s' stage '%s' activated." % (self.package, stage))
+        return stage
+
+    def wait(self, stage: str, timeout: float = STAGE_TIMEOUT) -> None:
+        """
+        Waits for the uploaded stage to become the active one. Raises
+        ``StageError`` with the tail of the startup log if the stage
+        fails the validation (Icinga 2 keeps the previous active
+        stage then) or isn't activated within the timeout.
+
+        :param stage: The name of the uploaded stage.
+
+        :param timeout: A number of seconds to wait for.
+        """
+
+        deadline = time.monotonic() + timeout
+        while True:
+            active = [p.get("active-stage") for p in self.packages.list() \
+                      if p.get("name") == self.package]
+            if active and active[0] == stage:
+                return
+
+            try:
+                status = self.packages.file(self.package, stage, "status").strip()
+            except Exception:
+                status = ""
+
+            if status and status != "0":
+                try:
+                    log = self.packages.file(self.package, stage, "startup.log")
+                except Exception as ex:
+                    log = str(ex)
+                errors = [l for l in log.splitlines() if "critical" in l]
+                raise StageError("Config package '%s' stage '%s' failed the validation: %s" % (self.package, stage, " ".join(errors[-3:] or log.splitlines()[-3:]).rstrip(".")))
+
+            if time.monotonic() >= deadline:
+                raise StageError("Config package '%s' stage '%s' wasn't activated in %.0f s" % (self.package, stage, timeout))
+            time.sleep(STAGE_POLL)
@@ -0,0 +1,189 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines a pool of
+persistent HTTPS connections shared by all Icinga 2 API requests.
+"""
+
+from typing import Optional, Tuple, Dict, Any
+from icinga2apic.base import Base # type: ignore
+from icinga2apic.client import Client # type: ignore
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from .logging import logger
+from .metrics import Metrics, api_call
+from .constants import DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_TIMEOUT
+import requests
+import os
+
+Timeout = Tuple[Optional[float], Optional[float]]
+
+class PooledSession():
+    """
+    A lightweight view of the shared session with the per-request
+    method override header and timeout. Closing it doesn't close
+    the pooled connections. The request latency is observed in the
+    metrics, if any.
+    """
+
+    def __init__(self, session: requests.Session,
+                 headers: Dict[str, str], timeout: Timeout,
+                 metrics: Optional[Metrics] = None):
+        self.session = session
+        self.headers = headers
+        self.timeout = timeout
+        self.metrics = metrics
+
+    def post(self, **kwargs: Any) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        if not self.metrics:
+            return self.session.post(headers = self.headers, **kwargs)
+
+        call = api_call(self.headers["X-HTTP-Method-Override"],
+                        kwargs.get("url", ""))
+        with self.metrics.timer("api_request_seconds", call):
+            return self.session.post(headers = self.headers, **kwargs)
+
+    def close(self) -> None:
+        pass
+
+class ConnectionPool():
+    """
+    A pool of persistent (keep-alive) HTTPS connections to the
+    Icinga 2 API. Connections and their TLS sessions are reused
+    across requests, so only a new connection costs a handshake.
+    Each process gets its own set of connections: the pool is
+    safe to create before forking.
+    """
+
+    def __init__(self,
+                 size: Optional[int] = None,
+                 keepalive: bool = True,
+                 connect_timeout: Optional[float] = None,
+                 timeout: Optional[float] = None,
+                 metrics: Optional[Metrics] = None):
+        """
+        :param size: A maximum number of connections kept open.
+            The default is 10.
+
+        :param keepalive: Keep connections open between requests.
+            The default is True.
+
+        :param connect_timeout: A number of seconds to wait for a
+            connection to be established. The default is 10.
+
+        :param timeout: A number of seconds to wait for a response
+            (except the event stream). The default is 60.
+
+        :param metrics: Optional metrics to observe the request
+            latencies in.
+        """
+
+        self.size = max(1, size or DEFAULT_POOL_SIZE)
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout or DEFAULT_CONNECT_TIMEOUT
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.metrics = metrics
+        self.lock = Lock()
+        self.pid: Optional[int] = None
+        self.shared: Optional[requests.Session] = None
+
+    def session(self, manager: Client) -> requests.Session:
+        """
+        Returns the shared session of the current process, creating
+        it on the first call.
+
+        :param manager: The Icinga 2 API client to take the
+            credentials from.
+        """
+
+        with self.lock:
+            if self.shared is None or self.pid != os.getpid():
+                logger.debug("[Pool] Setting up a pool of %d connections..." % self.size)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections = 1,
+                                      pool_maxsize = self.size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                if manager.certificate and manager.key:
+                    session.cert = (manager.certificate, manager.key)
+                elif manager.certificate:
+                    session.cert = manager.certificate
+                elif manager.username and manager.password:
+                    session.auth = (manager.username, manager.password)
+                session.headers.update({
+                    "User-Agent": "Python-icinga2apic/%s" % manager.version,
+                    "Accept": "application/json"
+                })
+                if not self.keepalive:
+                    session.headers["Connection"] = "close"
+                self.shared = session
+                self.pid = os.getpid()
+            return self.shared
+
+    def create_session(self, manager: Client, method: str = "POST",
+                       stream: bool = False) -> PooledSession:
+        """
+        Returns a session view to make a single request with.
+
+        :param manager: The Icinga 2 API client.
+
+        :param method: The HTTP method to pass in the
+            ``X-HTTP-Method-Override`` header.
+
+        :param stream: Whether the request is a long-living event
+            stream that shouldn't time out on reading.
+        """
+
+        return PooledSession(
+            self.session(manager),
+            { "X-HTTP-Method-Override": method.upper() },
+            (self.connect_timeout, None if stream else self.timeout),
+            self.metrics
+        )
+
+    def attach(self, client: Client) -> None:
+        """
+        Routes all requests of the given client through the pool.
+
+        :param client: The Icinga 2 API client.
+        """
+
+        client.pool = self
+        for base in (client.objects, client.actions, client.status):
+            base._create_session = \
+                lambda method = "POST": self.create_session(client, method)
+        client.events._create_session = \
+            lambda method = "POST": self.create_session(client, method,
+                                                        stream = True)
+
+class PooledBase(Base):
+    """
+    A base for the API classes defined in this package: uses the
+    connection pool attached to the client if any.
+    """
+
+    def _create_session(self, method = "POST"):
+        pool = getattr(self.manager, "pool", None)
+        if pool is None:
+            return super()._create_session(method)
+        return pool.create_session(self.manager, method)
@@ -0,0 +1,229 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the
+on-demand profiling of the running daemon processes.
+"""
+
+from typing import Optional, List, Dict, Tuple
+from threading import Thread, Event, get_ident, enumerate as threads
+from multiprocessing import Process, current_process, parent_process
+from multiprocessing.util import register_after_fork, Finalize
+from .logging import logger
+from .constants import PROFILE_INTERVAL, PROFILE_KEEP, HEAP_TOP
+import tracemalloc
+import signal
+import time
+import glob
+import sys
+import os
+
+class Profiler():
+    """
+    Profiles the daemon process on signals. ``SIGUSR1`` toggles
+    a sampling profiler: when it's stopped, the number of samples
+    of each stack of each thread is written in the "folded" format
+    accepted by ``flamegraph.pl`` and speedscope. ``SIGUSR2`` writes
+    the top allocation sites traced by ``tracemalloc`` and their
+    growth since the previous snapshot. Unless the tracing was
+    started at the startup (``PYTHONTRACEMALLOC``), the first
+    ``SIGUSR2`` only starts it.
+
+    The signals received by the main process are forwarded to the
+    ``children`` processes. The dumps are written to the given
+    directory under the names of the processes; only the last
+    ``keep`` dumps of each kind are kept per process.
+    """
+
+    def __init__(self, path: str, interval: float = PROFILE_INTERVAL,
+                 keep: int = PROFILE_KEEP, top: int = HEAP_TOP):
+        """
+        :param path: A directory to write the dumps to.
+
+        :param interval: A number of seconds between the samples.
+
+        :param keep: A number of dumps of each kind to keep.
+
+        :param top: A number of allocation sites to dump.
+        """
+
+        self.path = path
+        self.interval = interval
+        self.keep = keep
+        self.top = top
+        self.children: List[Process] = []
+        self.sampling: Optional[Event] = None
+        self.sampler: Optional[Thread] = None
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        register_after_fork(self, Profiler.after_fork)
+
+    def install(self) -> None:
+        """
+        Sets the signal handlers. Should be called from the main
+        thread of the main process.
+        """
+
+        signal.signal(signal.SIGUSR1, self.on_profile)
+        signal.signal(signal.SIGUSR2, self.on_heap)
+
+    def after_fork(self) -> None:
+        """
+        Restarts the sampling in a forked child if it was active in
+        the parent, so the workers restarted on a reconnection follow
+        the profiling state of the main process. The samples are
+        written out when the child exits.
+        """
+
+        self.children = []
+        self.snapshot = None
+        if self.sampling:
+            self.start()
+        Finalize(self, self.stop, exitpriority = 0)
+
+    def forward(self, signum: int) -> None:
+        if parent_process() is not None:
+            return
+        for p in self.children:
+            if p.is_alive() and p.pid:
+                try:
+                    os.kill(p.pid, signum)
+                except OSError as ex:
+                    logger.warning("[Profiler] Unable to forward the signal to %s: %s." % (p.name, str(ex)))
+
+    def on_profile(self, signum: int, frame) -> None:
+        self.forward(signum)
+        if self.sampling:
+            self.sampling.set()
+            self.sampling = None
+        else:
+            self.start()
+
+    def stop(self) -> None:
+        """
+        Stops the sampling, if any, and waits for the samples to be
+        written out.
+        """
+
+        if self.sampling:
+            self.sampling.set()
+            self.sampling = None
+            if self.sampler:
+                self.sampler.join()
+
+    def on_heap(self, signum: int, frame) -> None:
+        self.forward(signum)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            logger.info("[Profiler] Started tracing the memory allocations in %s. Send SIGUSR2 again to take a snapshot." % current_process().name)
+            return
+        Thread(target = self.dump_heap, name = "HeapSnapshot",
+               daemon = True).start()
+
+    def start(self) -> None:
+        self.sampling = Event()
+        self.sampler = Thread(target = self.sample, args = (self.sampling,),
+                              name = "Profiler", daemon = True)
+        self.sampler.start()
+
+    def sample(self, stop: Event) -> None:
+        """
+        Samples the stacks of all other threads until the given event
+        is set, then writes them out.
+        """
+
+        logger.info("[Profiler] Started profiling %s." % current_process().name)
+        me = get_ident()
+        stacks: Dict[Tuple[str, ...], int] = {}
+        count = 0
+        started = time.monotonic()
+        while not stop.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threads())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack: List[str] = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name,
+                                                 code.co_filename,
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = tuple(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            count += 1
+
+        lines = ["%s %d\n" % (";".join(k), n) for k, n in stacks.items()]
+        path = self.dump("profile", "folded", lines)
+        if path:
+            logger.info("[Profiler] Stopped profiling %s: %d samples over %.1f s written to %s." % (current_process().name, count, time.monotonic() - started, path))
+
+    def dump_heap(self) -> None:
+        """
+        Writes the top allocation sites and the top growth since the
+        previous snapshot.
+        """
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["# %s: %d KiB traced, %d KiB peak\n" % \
+                 (current_process().name, current // 1024, peak // 1024),
+                 "# Top %d allocation sites:\n" % self.top]
+        lines += ["%s\n" % s for s in snapshot.statistics("lineno")[:self.top]]
+        if self.snapshot:
+            lines.append("# Top %d differences since the previous snapshot:\n" % self.top)
+            lines += ["%s\n" % s for s in \
+                      snapshot.compare_to(self.snapshot, "lineno")[:self.top]]
+        self.snapshot = snapshot
+
+        path = self.dump("heap", "txt", lines)
+        if path:
+            logger.info("[Profiler] Heap snapshot of %s written to %s." % (current_process().name, path))
+
+    def dump(self, kind: str, ext: str, lines: List[str]) -> Optional[str]:
+        """
+        Writes a dump of the given kind and removes the oldest ones
+        of the same kind and process beyond ``keep``.
+
+        :return: The path to the written file or ``None`` on error.
+        """
+
+        prefix = "%s-%s-" % (kind, current_process().name)
+        now = time.time()
+        path = os.path.join(self.path, "%s%s.%03d-%d.%s" % (
+            prefix, time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+            int(now * 1000) % 1000, os.getpid(), ext
+        ))
+        try:
+            os.makedirs(self.path, mode = 0o700, exist_ok = True)
+            with open(path, "w", encoding = "utf-8") as f:
+                f.writelines(lines)
+            dumps = sorted(glob.glob(os.path.join(self.path, prefix + "*." + ext)),
+                           key = os.path.getmtime)
+            for old in dumps[:-self.keep] if self.keep else []:
+                os.remove(old)
+        except OSError as ex:
+            logger.error("[Profiler] Unable to write the %s dump: %s." % (kind, str(ex)))
+            return None
+        return path
@@ -0,0 +1,265 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the rate
+limiting of the Icinga 2 API requests.
+"""
+
+from typing import Optional, Iterator, Tuple, Dict, Any
+from threading import Lock
+from contextlib import contextmanager
+from multiprocessing.sharedctypes import RawValue
+from icinga2apic.exceptions import Icinga2ApiRequestException # type: ignore
+from requests.exceptions import ConnectionError, Timeout
+from .logging import logger
+from .constants import DEFAULT_WRITE_CONCURRENCY, DEFAULT_WRITE_LATENCY
+import multiprocessing
+import time
+import re
+
+POLL_INTERVAL = 0.01
+
+def refill(tokens: float, updated: float, rate: float, burst: float,
+           n: float = 1) -> Tuple[float, float, float]:
+    """
+    Refills a token bucket of ``rate`` tokens per second holding up
+    to ``burst`` tokens that had ``tokens`` at the ``updated`` time.
+    Returns the new number of tokens, the time of the update and the
+    number of seconds to wait for ``n`` tokens (zero if they are
+    available). Should be called with the bucket lock held.
+    """
+
+    now = time.monotonic()
+    tokens = min(burst, tokens + (now - updated) * rate)
+    return tokens, now, max(0.0, (min(n, burst) - tokens) / rate)
+
+class TokenBucket():
+    """
+    A thread-safe token bucket: allows ``rate`` requests per second
+    on average with bursts of up to ``burst`` requests.
+    """
+
+    def __init__(self, rate: Optional[float] = None,
+                 burst: Optional[float] = None):
+        """
+        :param rate: A number of requests per second. Zero or None
+            means no limit.
+
+        :param burst: A maximum number of requests to allow at once.
+            The default is the rate (but at least 1).
+        """
+
+        self.rate = rate or 0.0
+        self.burst = burst or max(1.0, self.rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self, n: float = 1) -> float:
+        """
+        Takes ``n`` tokens waiting for them to be available. Returns
+        the number of seconds waited.
+        """
+
+        if not self.rate:
+            return 0.0
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                self.tokens, self.updated, wait = refill(
+                    self.tokens, self.updated, self.rate, self.burst, n
+                )
+                if not wait:
+                    self.tokens -= n
+                    return waited
+            time.sleep(wait)
+            waited += wait
+
+EXISTS_ERROR = re.compile(r"Object '(.+)' already exists\.")
+
+def exists_result(result: Dict[str, Any], name: Optional[str] = None) -> bool:
+    """
+    Tells whether the given per-object result of a request reports
+    the object (with the given name, if any) as already existing:
+    Icinga 2 responds with code 500 and the only error
+    ``Object '<name>' already exists.`` in that case.
+    """
+
+    errors = result.get("errors") or []
+    if int(result.get("code", 0)) != 500 or len(errors) != 1:
+        return False
+    match = EXISTS_ERROR.fullmatch(str(errors[0]))
+    return bool(match) and (name is None or match.group(1) == name)
+
+def already_exists(ex: Exception, name: Optional[str] = None) -> bool:
+    """
+    Tells whether the request has failed only because the object
+    (with the given name, if any) already exists, i. e. each of the
+    per-object results reports so.
+    """
+
+    if not isinstance(ex, Icinga2ApiRequestException):
+        return False
+
+    response = ex.response if isinstance(ex.response, dict) else {}
+    results = response.get("results") or []
+    return bool(results) and not response.get("error") and \
+        all(exists_result(r, name) for r in results)
+
+def is_overload(ex: Exception) -> bool:
+    """
+    Tells whether the given request error is a sign of the Icinga 2
+    API being overloaded: a connection error, a timeout or a 5xx
+    response except for the per-object results about the object
+    that already exists (Icinga 2 responds with 500 in that case).
+    """
+
+    if isinstance(ex, (ConnectionError, Timeout)):
+        return True
+
+    if not isinstance(ex, Icinga2ApiRequestException):
+        return False
+
+    response = ex.response if isinstance(ex.response, dict) else {}
+    codes = [int(r.get("code", 0)) for r in response.get("results") or [] \
+             if not exists_result(r)]
+    if response.get("error"):
+        codes.append(int(response["error"]))
+
+    return any(code >= 500 for code in codes)
+
+class AdaptiveLimiter():
+    """
+    Limits the ApiUser write requests with a token bucket of
+    ``rate`` requests per second and an adaptive concurrency limit:
+    the limit is halved (at most once per observed latency) when a
+    request fails with an overload error or the average latency
+    rises above ``latency`` seconds, and is increased by one per
+    round of successful requests up to ``concurrency`` otherwise.
+    The state is kept in shared memory, so a limiter created before
+    forking is shared by the Comparator and the EventListener
+    processes.
+    """
+
+    def __init__(self,
+                 rate: Optional[float] = None,
+                 concurrency: Optional[int] = None,
+                 latency: Optional[float] = None):
+        """
+        :param rate: A maximum number of requests per second. Zero
+            or None means no limit.
+
+        :param concurrency: A maximum number of requests in flight.
+            The default is 8.
+
+        :param latency: The target average request latency in
+            seconds. The default is 1 second.
+        """
+
+        self.rate = rate or 0.0
+        self.burst = max(1.0, self.rate)
+        self.max_concurrency = max(1, concurrency or DEFAULT_WRITE_CONCURRENCY)
+        self.target = latency or DEFAULT_WRITE_LATENCY
+
+        self.lock = multiprocessing.Lock()
+        self.limit = RawValue("d", self.max_concurrency)
+        self.in_flight = RawValue("i", 0)
+        self.tokens = RawValue("d", self.burst)
+        self.updated = RawValue("d", time.monotonic())
+        self.latency = RawValue("d", 0.0)
+        self.decreased = RawValue("d", 0.0)
+
+    def acquire(self) -> None:
+        """
+        Waits for a token and a free concurrency slot and takes them.
+        """
+
+        while True:
+            with self.lock:
+                wait = 0.0
+                if self.rate:
+                    self.tokens.value, self.updated.value, wait = refill(
+                        self.tokens.value, self.updated.value,
+                        self.rate, self.burst
+                    )
+                if not wait and self.in_flight.value < int(self.limit.value):
+                    self.in_flight.value += 1
+                    if self.rate:
+                        self.tokens.value -= 1
+                    return
+            time.sleep(max(POLL_INTERVAL, wait))
+
+    def release(self, latency: float, overload: bool = False) -> None:
+        """
+        Frees the concurrency slot and adapts the limit.
+
+        :param latency: The number of seconds the request took.
+
+        :param overload: Whether the request failed because of an
+            overload.
+        """
+
+        with self.lock:
+            self.in_flight.value -= 1
+            avg = self.latency.value
+            avg = latency if not avg else 0.8 * avg + 0.2 * latency
+            self.latency.value = avg
+            old = int(self.limit.value)
+            now = time.monotonic()
+            if overload or avg > self.target:
+                if now - self.decreased.value >= avg:
+                    self.limit.value = max(1.0, self.limit.value / 2)
+                    self.decreased.value = now
+            elif self.limit.value < self.max_concurrency:
+                self.limit.value = min(float(self.max_concurrency),
+                                       self.limit.value + 1 / self.limit.value)
+            new = int(self.limit.value)
+
+        if new < old:
+            logger.warning("[RateLimit] Backing off: %s (%s)." % (self.describe(), "overload error" if overload else "high latency"))
+        elif new > old:
+            logger.info("[RateLimit] Recovering: %s." % self.describe())
+
+    def describe(self) -> str:
+        """
+        Returns a description of the current limits.
+        """
+
+        return "%d of %d concurrent requests, %s, average latency %.2f s" % (int(self.limit.value), self.max_concurrency, ("%s requests/s" % self.rate) if self.rate else "no rate limit", self.latency.value)
+
+    @contextmanager
+    def request(self) -> Iterator[None]:
+        """
+        A context to make a single limited request in.
+        """
+
+        self.acquire()
+        started = time.monotonic()
+        overload = False
+        try:
+            yield
+        except Exception as ex:
+            overload = is_overload(ex)
+            raise
+        finally:
+            self.release(time.monotonic() - started, overload)
@@ -0,0 +1,113 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the registry
+of the in-flight ApiUser operations shared by all workers.
+"""
+
+from multiprocessing.sharedctypes import RawArray
+from .diff import ADD, DELETE
+from .constants import REGISTRY_SLOTS, REGISTRY_PROBES
+import multiprocessing
+import hashlib
+
+OPS = { ADD: 1, DELETE: 2 }
+
+def fingerprint(name: str) -> int:
+    """
+    Returns a non-zero 64-bit fingerprint of the given name.
+    """
+
+    fp = int.from_bytes(
+        hashlib.blake2b(name.encode("utf-8"), digest_size = 8).digest(),
+        "little"
+    )
+    return fp or 1
+
+class OpRegistry():
+    """
+    A registry of the ApiUser operations in flight, so the same
+    change of a host requested by the EventListener and the
+    Comparator at the same time results in a single write. An
+    operation is registered by its kind and the host name and is
+    forgotten as soon as it is finished, so a later repeat of it
+    (i. e. a host re-added after it was deleted) is made again.
+    The entries are kept in a fixed-size open addressing table of
+    the host name fingerprints in shared memory: a registry created
+    before forking is shared by all processes. When the table is
+    full, the operations aren't deduplicated.
+    """
+
+    def __init__(self, slots: int = REGISTRY_SLOTS):
+        """
+        :param slots: The size of the table.
+        """
+
+        self.size = slots
+        self.lock = multiprocessing.Lock()
+        self.fps = RawArray("Q", slots)
+        self.ops = RawArray("b", slots)
+
+    def find(self, op: int, fp: int):
+        """
+        Returns the slot of the given operation (or -1) and the
+        first free slot in its probe window (or -1).
+        """
+
+        found = free = -1
+        for i in range(REGISTRY_PROBES):
+            slot = (fp + op + i) % self.size
+            if self.fps[slot] == fp and self.ops[slot] == op:
+                found = slot
+                break
+            if free < 0 and not self.fps[slot]:
+                free = slot
+        return found, free
+
+    def claim(self, op: str, name: str) -> bool:
+        """
+        Registers the operation as in flight. Returns False if the
+        same operation for the host is already in flight, so it
+        shouldn't be made again.
+        """
+
+        fp = fingerprint(name)
+        with self.lock:
+            slot, free = self.find(OPS[op], fp)
+            if slot >= 0:
+                return False
+            if free >= 0:
+                self.fps[free] = fp
+                self.ops[free] = OPS[op]
+        return True
+
+    def finish(self, op: str, name: str) -> None:
+        """
+        Forgets the finished operation whatever its outcome.
+        """
+
+        fp = fingerprint(name)
+        with self.lock:
+            slot, free = self.find(OPS[op], fp)
+            if slot >= 0:
+                self.fps[slot] = 0
+                self.ops[slot] = 0
@@ -0,0 +1,187 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the
+recording of the raw event stream to a compressed JSON lines file
+and the replay of such a file into the EventListener pipeline.
+"""
+
+from typing import Optional, Iterable, Iterator, List, Dict, Any
+from threading import Lock
+from .logging import logger
+from .constants import RECORD_FLUSH, DEFAULT_REPLAY_SPEED
+import gzip
+import json
+import time
+import zlib
+
+def record(stream: Iterable[str], path: str) -> Iterator[str]:
+    """
+    Passes the raw events of the given stream through, appending
+    them to the gzip-compressed JSON lines file. The file is opened
+    on the first read, so the stream can be handed to a forked
+    process, and is flushed every second.
+
+    :param stream: The event stream.
+
+    :param path: The path to the file to append to.
+    """
+
+    try:
+        with gzip.open(path, "at", encoding = "utf-8") as f:
+            logger.info("[Record] Recording the event stream to %s." % path)
+            flushed = time.monotonic()
+            for str_e in stream:
+                f.write(str_e.strip() + "\n")
+                if time.monotonic() - flushed >= RECORD_FLUSH:
+                    f.flush()
+                    flushed = time.monotonic()
+                yield str_e
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """
+    Returns the 50, 95 and 99 percentiles and the maximum of the
+    given values.
+    """
+
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return {
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": values[-1],
+    }
+
+class Replay():
+    """
+    A stream of the events read from a recorded file. The events are
+    fed at the recorded pace multiplied by the ``speed``, so the
+    bursts are reproduced, or as fast as they are consumed if the
+    speed is zero. The time each Host event is fed at is kept to
+    measure the latency of the ApiUser request made for it.
+    """
+
+    def __init__(self, path: str, speed: Optional[float] = None):
+        """
+        :param path: The path to the recorded file.
+
+        :param speed: The replay speed: 1 is the original pace,
+            2 is twice as fast, 0 is the maximum speed. The default
+            is 1.
+        """
+
+        self.path = path
+        self.speed = DEFAULT_REPLAY_SPEED if speed is None else speed
+        self.events = 0
+        self.span = 0.0
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.fed: Dict[str, float] = {}
+        self.latencies: List[float] = []
+        self.lock = Lock()
+
+    def __iter__(self) -> Iterator[str]:
+        first: Optional[float] = None
+        skipped = 0
+        with gzip.open(self.path, "rt", encoding = "utf-8") as f:
+            self.started = time.monotonic()
+            for str_e in self.lines(f):
+                if not str_e.strip():
+                    continue
+                try:
+                    e = json.loads(str_e)
+                except ValueError:
+                    skipped += 1
+                    continue
+                stamp = e.get("timestamp")
+                if stamp is not None:
+                    if first is None:
+                        first = float(stamp)
+                    self.span = float(stamp) - first
+                    if self.speed > 0:
+                        delay = self.started + self.span / self.speed - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                with self.lock:
+                    self.events += 1
+                    if e.get("object_name"):
+                        self.fed.setdefault(e["object_name"], time.monotonic())
+                yield str_e
+        if skipped:
+            logger.warning("[Replay] %d malformed lines skipped in %s." % (skipped, self.path))
+        logger.info("[Replay] %d events replayed from %s." % (self.events, self.path))
+
+    def lines(self, f: Iterable[str]) -> Iterator[str]:
+        """
+        Reads the lines of the recorded file. The file of a daemon
+        that has been killed while recording ends without the gzip
+        end-of-stream marker: it's read up to the last complete
+        block.
+        """
+
+        try:
+            yield from f
+        except (EOFError, zlib.error, gzip.BadGzipFile, UnicodeDecodeError) as ex:
+            logger.warning("[Replay] The recording %s is truncated: %s." % (self.path, str(ex).rstrip(".")))
+
+    def done(self, names: Iterable[str]) -> None:
+        """
+        Registers the ApiUser requests made for the given hosts.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            for name in names:
+                fed = self.fed.pop(name, None)
+                if fed is not None:
+                    self.latencies.append(now - fed)
+            self.finished = now
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Returns the replay statistics: the number of events and the
+        recorded time span, the end-to-end processing rate, and the
+        latency percentiles from feeding an event to the completion
+        of the ApiUser request made for it.
+        """
+
+        with self.lock:
+            elapsed = (self.finished or time.monotonic()) - (self.started or 0.0) \
+                if self.started is not None else 0.0
+            return {
+                "file": self.path,
+                "speed": self.speed,
+                "events": self.events,
+                "recorded_span_s": self.span,
+                "elapsed_s": elapsed,
+                "events_per_s": self.events / elapsed if elapsed > 0 else 0.0,
+                "requests": len(self.latencies),
+                "unanswered": len(self.fed),
+                "latency_s": percentiles(self.latencies),
+            }
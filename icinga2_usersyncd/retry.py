@@ -0,0 +1,210 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the durable
+queue of the failed ApiUser operations to retry.
+"""
+
+from typing import Optional, Iterable, List, Tuple, NamedTuple
+from contextlib import closing
+from .logging import logger
+from .snapshot import connect_readonly
+from .constants import DEFAULT_RETRY_ATTEMPTS, DEFAULT_RETRY_DELAY, RETRY_MAX_DELAY, RETRY_LEASE
+import sqlite3
+import random
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ops (
+    name TEXT PRIMARY KEY,
+    op TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    error TEXT,
+    dead INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ops_due ON ops (dead, next_at);
+"""
+
+class RetryEntry(NamedTuple):
+    """
+    A queued operation.
+    """
+
+    name: str
+    op: str
+    attempts: int
+    next_at: float
+    error: Optional[str]
+    dead: bool
+
+class RetryQueue():
+    """
+    A durable queue of failed ApiUser operations kept in an SQLite
+    database. There's at most one operation per host: a newer one
+    replaces the older. Each failed attempt doubles the delay before
+    the next one, and after ``attempts`` failures the operation is
+    dead-lettered: it's kept for inspection, but not retried.
+    """
+
+    def __init__(self, path: str,
+                 attempts: Optional[int] = None,
+                 delay: Optional[float] = None,
+                 timeout: float = 30,
+                 readonly: bool = False):
+        """
+        :param path: A path to the database file.
+
+        :param attempts: A maximum number of retries before the
+            operation is dead-lettered. The default is 10.
+
+        :param delay: A number of seconds before the first retry.
+            The default is 5.
+
+        :param timeout: A number of seconds to wait for the database
+            to be unlocked by another process.
+
+        :param readonly: Open the existing queue for reading only,
+            i. e. to list the entries.
+        """
+
+        self.path = path
+        self.attempts = attempts or DEFAULT_RETRY_ATTEMPTS
+        self.delay = delay or DEFAULT_RETRY_DELAY
+        self.timeout = timeout
+        self.readonly = readonly
+        if readonly:
+            self.connect().close()
+            return
+
+        with closing(self.connect()) as db, db:
+            db.execute("PRAGMA journal_mode = WAL")
+            db.executescript(SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens a new connection to the database.
+        """
+
+        if self.readonly:
+            return connect_readonly(self.path, self.timeout)
+        return sqlite3.connect(self.path, timeout = self.timeout)
+
+    def backoff(self, attempts: int) -> float:
+        """
+        Returns the number of seconds to wait before the retry that
+        follows the given number of failed attempts.
+        """
+
+        delay = min(RETRY_MAX_DELAY, self.delay * 2 ** max(0, attempts - 1))
+        return delay * random.uniform(0.9, 1.1)
+
+    def push(self, op: str, name: str, error: str) -> None:
+        """
+        Queues a failed operation. A failure of the already queued
+        operation counts as another attempt, other operation for the
+        same host replaces the queued one.
+
+        :param op: The operation: ``ADD`` or ``DELETE``.
+
+        :param name: The host name.
+
+        :param error: The error message.
+        """
+
+        now = time.time()
+        with closing(self.connect()) as db, db:
+            row = db.execute("SELECT op, attempts FROM ops WHERE name = ?",
+                             (name,)).fetchone()
+            attempts = (row[1] + 1) if row and row[0] == op else 1
+            dead = attempts > self.attempts
+            db.execute("INSERT OR REPLACE INTO ops (name, op, attempts, next_at, error, dead) VALUES (?, ?, ?, ?, ?, ?)",
+                       (name, op, attempts, now + self.backoff(attempts), error, int(dead)))
+
+        if dead:
+            logger.error("[Retry] Giving up trying to %s ApiUser for host \"%s\" after %d attempts: %s." % (op, name, attempts, error))
+
+    def discard(self, names: Iterable[str]) -> None:
+        """
+        Removes the operations for the given hosts, i. e. after they
+        have succeeded or have become obsolete.
+        """
+
+        rows = [(n,) for n in names]
+        if not rows:
+            return
+
+        with closing(self.connect()) as db, db:
+            db.executemany("DELETE FROM ops WHERE name = ?", rows)
+
+    def due(self, limit: int) -> List[Tuple[str, str]]:
+        """
+        Claims up to ``limit`` operations due for a retry and returns
+        them as ``(operation, hostname)`` pairs. The claimed ones
+        aren't returned again for a while, so an operation lost
+        in flight (i. e. on a crash) is eventually retried.
+        """
+
+        now = time.time()
+        with closing(self.connect()) as db, db:
+            rows = db.execute("SELECT op, name FROM ops WHERE dead = 0 AND next_at <= ? ORDER BY next_at LIMIT ?",
+                              (now, limit)).fetchall()
+            db.executemany("UPDATE ops SET next_at = ? WHERE name = ?",
+                           [(now + RETRY_LEASE, name) for op, name in rows])
+
+        return [(op, name) for op, name in rows]
+
+    def entries(self) -> List[RetryEntry]:
+        """
+        Returns all queued operations: pending and dead-lettered.
+        """
+
+        with closing(self.connect()) as db:
+            return [
+                RetryEntry(name, op, attempts, next_at, error, bool(dead))
+                for name, op, attempts, next_at, error, dead in db.execute(
+                    "SELECT name, op, attempts, next_at, error, dead FROM ops ORDER BY dead, next_at"
+                )
+            ]
+
+def open_retry_queue(path: Optional[str],
+                     attempts: Optional[int] = None,
+                     delay: Optional[float] = None,
+                     readonly: bool = False) -> Optional[RetryQueue]:
+    """
+    Opens the retry queue at the given path. Returns None if the path
+    isn't set or the queue can't be opened, so the failed operations
+    are only logged. A read-only queue that doesn't exist isn't an
+    error.
+    """
+
+    if not path:
+        return None
+
+    try:
+        return RetryQueue(path, attempts = attempts, delay = delay,
+                          readonly = readonly)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logger.warning("[Retry] Unable to open %s: %s. Running without a retry queue." % (path, str(ex)))
+        return None
@@ -0,0 +1,88 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the
+partitioning of the Hosts between several daemon instances.
+"""
+
+from typing import Iterable, List
+from .registry import fingerprint
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Maps the given 64-bit key to one of the ``buckets`` with the
+    jump consistent hash (Lamping and Veach): when the number of
+    buckets grows from N to N + 1, only 1/(N + 1) of the keys move,
+    all of them to the new bucket.
+    """
+
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+class Shard():
+    """
+    The subset of Hosts handled by one of ``count`` daemon
+    instances: the ones whose names hash to ``index``. The events
+    and the comparison results of the other Hosts are ignored.
+
+    The shard is applied on the client side: the Icinga 2 filter
+    language can't hash the names, so every instance still receives
+    the whole event stream and lists all the Hosts and ApiUsers.
+    """
+
+    def __init__(self, index: int, count: int):
+        """
+        :param index: The zero-based index of the shard.
+
+        :param count: The total number of shards.
+        """
+
+        if count < 1 or not 0 <= index < count:
+            raise ValueError("Invalid shard %d of %d" % (index, count))
+        self.index = index
+        self.count = count
+
+    def __contains__(self, name: str) -> bool:
+        return jump_hash(fingerprint(name), self.count) == self.index
+
+    def __str__(self) -> str:
+        return "%d/%d" % (self.index, self.count)
+
+    def filter(self, names: Iterable[str]) -> List[str]:
+        """
+        Returns the given host names that belong to the shard
+        keeping their order.
+        """
+
+        return [n for n in names if n in self]
+
+    def suffix(self, name: str) -> str:
+        """
+        Returns the given name (of an event queue, a configuration
+        package or a state directory) specific to the shard.
+        """
+
+        return "%s-shard%d" % (name, self.index)
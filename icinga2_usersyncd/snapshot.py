@@ -0,0 +1,211 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the on-disk
+snapshot of the known Hosts used for warm restarts.
+"""
+
+from typing import Optional, Iterable
+from array import array
+from contextlib import closing
+from threading import Lock
+from .logging import logger
+from .diff import ADD, DELETE
+from .registry import fingerprint
+from urllib.request import pathname2url
+import sqlite3
+import time
+import os
+
+SCHEMA_VERSION = 2
+SCHEMA = """
+DROP TABLE IF EXISTS hosts;
+DROP TABLE IF EXISTS users;
+CREATE TABLE IF NOT EXISTS fingerprints (fp INTEGER PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+def connect_readonly(path: str, timeout: float) -> sqlite3.Connection:
+    """
+    Opens a read-only connection to the given database, i. e. to
+    inspect the state of the daemon. Unlike a usual read-only
+    connection, creates no files: if there's no write-ahead log, the
+    database is fully written out, so it's opened as immutable.
+    Raises ``FileNotFoundError`` if the database doesn't exist.
+    """
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+
+    mode = "mode=ro" if os.path.exists(path + "-wal") else "immutable=1"
+    return sqlite3.connect("file:%s?%s" % (pathname2url(path), mode),
+                           uri = True, timeout = timeout)
+
+def to_signed(fp: int) -> int:
+    """
+    Converts the 64-bit fingerprint to the signed SQLite integer.
+    """
+
+    return fp - (1 << 64) if fp >= (1 << 63) else fp
+
+class Snapshot():
+    """
+    A snapshot of the known (filtered) Hosts kept in an SQLite
+    database as the fingerprints of their names, the same ones the
+    HostIndex is made of. The Comparator replaces it with the
+    verified listing, the EventListener records each successful
+    change. A connection
+    is opened for each operation, so a single snapshot may be
+    used from several threads and processes.
+    """
+
+    def __init__(self, path: str, scope: str = "", timeout: float = 30,
+                 readonly: bool = False):
+        """
+        :param path: A path to the database file.
+
+        :param scope: A string identifying the settings the snapshot
+            depends on (i. e. the Host filter and the ApiUser prefix).
+            A snapshot saved with a different scope (or with an older
+            schema) is discarded.
+
+        :param timeout: A number of seconds to wait for the database
+            to be unlocked by another process.
+
+        :param readonly: Open the existing snapshot for reading only,
+            i. e. to inspect it. The scope isn't checked then.
+        """
+
+        self.path = path
+        self.timeout = timeout
+        self.readonly = readonly
+        self.lock = Lock()
+        if readonly:
+            self.connect().close()
+            return
+
+        with closing(self.connect()) as db, db:
+            db.execute("PRAGMA journal_mode = WAL")
+            db.executescript(SCHEMA)
+
+        scope = "%d\n%s" % (SCHEMA_VERSION, scope)
+        if self.get("scope") != scope:
+            logger.info("[Snapshot] The settings have changed: discarding the snapshot %s." % path)
+            with closing(self.connect()) as db, db:
+                db.execute("DELETE FROM fingerprints")
+                db.execute("DELETE FROM meta")
+            self.set("scope", scope)
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens a new connection to the database.
+        """
+
+        if self.readonly:
+            return connect_readonly(self.path, self.timeout)
+        return sqlite3.connect(self.path, timeout = self.timeout)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the stored value for the given key or None.
+        """
+
+        with closing(self.connect()) as db:
+            row = db.execute("SELECT value FROM meta WHERE key = ?",
+                             (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Stores the value for the given key.
+        """
+
+        with self.lock, closing(self.connect()) as db, db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                       (key, value))
+
+    def hosts(self) -> Optional[array]:
+        """
+        Returns the sorted fingerprints of the known Host names (see
+        ``HostIndex.replace()``) or None if the snapshot was never
+        saved.
+        """
+
+        if self.get("saved") is None:
+            return None
+
+        fps = array("Q")
+        with closing(self.connect()) as db:
+            # The negative values are the upper half of the unsigned
+            # range.
+            for where in ("fp >= 0", "fp < 0"):
+                for r in db.execute("SELECT fp FROM fingerprints WHERE %s ORDER BY fp" % where):
+                    fps.append(r[0] & 0xFFFFFFFFFFFFFFFF)
+        return fps
+
+    def replace(self, fps: Iterable[int]) -> None:
+        """
+        Replaces the snapshot with the given Host fingerprints.
+        """
+
+        with self.lock, closing(self.connect()) as db, db:
+            db.execute("DELETE FROM fingerprints")
+            db.executemany("INSERT OR IGNORE INTO fingerprints (fp) VALUES (?)",
+                           ((to_signed(fp),) for fp in fps))
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('saved', ?)",
+                       (str(time.time()),))
+
+    def record(self, op: str, names: Iterable[str]) -> None:
+        """
+        Records an applied change: the hosts are either added
+        (``ADD``) or deleted (``DELETE``).
+        """
+
+        rows = [(to_signed(fingerprint(n)),) for n in names]
+        if not rows:
+            return
+
+        with self.lock, closing(self.connect()) as db, db:
+            if op == ADD:
+                db.executemany("INSERT OR IGNORE INTO fingerprints (fp) VALUES (?)", rows)
+            elif op == DELETE:
+                db.executemany("DELETE FROM fingerprints WHERE fp = ?", rows)
+
+def open_snapshot(path: Optional[str], scope: str = "",
+                  readonly: bool = False) -> Optional[Snapshot]:
+    """
+    Opens the snapshot at the given path. Returns None if the path
+    isn't set or the snapshot can't be opened, so the daemon falls
+    back to the full listings. A read-only snapshot that doesn't
+    exist isn't an error.
+    """
+
+    if not path:
+        return None
+
+    try:
+        return Snapshot(path, scope = scope, readonly = readonly)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logger.warning("[Snapshot] Unable to open %s: %s. Running without a snapshot." % (path, str(ex)))
+        return None
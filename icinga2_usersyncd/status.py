@@ -0,0 +1,112 @@
+# This file is a part of the icinga2_usersyncd Python package.
+#
+# Copyright (C) 2024  Paul Wolneykien <manowar@altlinux.org>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""
+icinga2-usersyncd is a daemon to synchronize ApiUser entries with
+Host agents on an Icinga 2 instance. This module defines the status
+report served by the running daemon over a local UNIX socket.
+"""
+
+from typing import Optional, Dict, Any
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+from threading import Thread
+from .logging import logger
+from .metrics import Metrics
+from .constants import STATUS_TIMEOUT
+import socket
+import json
+import time
+import os
+
+def status_report(metrics: Metrics) -> Dict[str, Any]:
+    """
+    Returns the status figures published in the given metrics: the
+    rolling sync lag percentiles, the high-water mark of the
+    processed Host events, the queue depth and the last comparison
+    result.
+    """
+
+    watermark = metrics.get("event_watermark_timestamp")
+    finished = metrics.get("comparison_last_timestamp")
+    return {
+        "time": time.time(),
+        "lag": {
+            "p50": metrics.get("sync_lag_seconds", "0.5"),
+            "p99": metrics.get("sync_lag_seconds", "0.99"),
+            "writes": int(metrics.get("sync_lag_writes")),
+        },
+        "watermark": watermark or None,
+        "queue": {
+            "events": int(metrics.get("queue_depth", "events")),
+            "requests": int(metrics.get("queue_depth", "requests")),
+        },
+        "comparison": {
+            "finished": finished,
+            "seconds": metrics.get("comparison_last_seconds"),
+            "success": bool(metrics.get("comparison_last_success")),
+            "hosts": int(metrics.get("comparison_objects", "hosts")),
+            "apiusers": int(metrics.get("comparison_objects", "apiusers")),
+            "added": int(metrics.get("comparison_objects", "added")),
+            "deleted": int(metrics.get("comparison_objects", "deleted")),
+            "failed": int(metrics.get("comparison_objects", "failed")),
+            "deferred": int(metrics.get("comparison_objects", "deferred")),
+        } if finished else None,
+    }
+
+def serve_status(metrics: Metrics, path: str) -> ThreadingUnixStreamServer:
+    """
+    Starts serving the status report as JSON to each client
+    connected to the UNIX socket at the given path in a background
+    thread. A stale socket file is replaced. Returns the server.
+
+    :param metrics: The metrics the figures are published in.
+
+    :param path: The socket path.
+    """
+
+    class Handler(StreamRequestHandler):
+        def handle(self) -> None:
+            self.wfile.write(json.dumps(status_report(metrics)).encode("utf-8"))
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    os.chmod(path, 0o600)
+    Thread(target = server.serve_forever, name = "Status", daemon = True).start()
+    logger.debug("[Status] Serving the status on %s." % path)
+    return server
+
+def query_status(path: str, timeout: float = STATUS_TIMEOUT) -> Dict[str, Any]:
+    """
+    Returns the status report of the daemon listening on the UNIX
+    socket at the given path.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        data = b""
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
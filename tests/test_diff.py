@@ -0,0 +1,102 @@
+"""
+Tests of the merge-join diff of the sorted Host and ApiUser streams
+(see ``icinga2_usersyncd.diff``).
+"""
+
+import random
+import unittest
+from array import array
+
+from icinga2_usersyncd.diff import ADD, DELETE, merge_diff, strip_prefix
+from icinga2_usersyncd.registry import fingerprint
+
+class StripPrefixTest(unittest.TestCase):
+
+    def test_strip(self):
+        self.assertEqual(strip_prefix("host-web1", "host-"), "web1")
+
+    def test_whole_prefix(self):
+        # Unlike str.lstrip("host-"):
+        self.assertEqual(strip_prefix("host-hub", "host-"), "hub")
+        self.assertEqual(strip_prefix("hoster", "host-"), "hoster")
+
+    def test_once(self):
+        self.assertEqual(strip_prefix("host-host-web1", "host-"), "host-web1")
+
+    def test_no_prefix(self):
+        self.assertEqual(strip_prefix("admin", "host-"), "admin")
+        self.assertEqual(strip_prefix("web1-host-", "host-"), "web1-host-")
+        self.assertEqual(strip_prefix("host-", "host-"), "")
+
+    def test_empty_prefix(self):
+        self.assertEqual(strip_prefix("host-web1", ""), "host-web1")
+
+class MergeDiffTest(unittest.TestCase):
+
+    def test_diff(self):
+        self.assertEqual(list(merge_diff(["a", "b", "d"], ["b", "c", "e"])),
+                         [(ADD, "a"), (DELETE, "c"), (ADD, "d"),
+                          (DELETE, "e")])
+
+    def test_empty(self):
+        self.assertEqual(list(merge_diff([], [])), [])
+        self.assertEqual(list(merge_diff(["a", "b"], [])),
+                         [(ADD, "a"), (ADD, "b")])
+        self.assertEqual(list(merge_diff([], ["a", "b"])),
+                         [(DELETE, "a"), (DELETE, "b")])
+
+    def test_equal(self):
+        names = ["a", "b", "c"]
+        self.assertEqual(list(merge_diff(names, names)), [])
+
+    def test_empty_name(self):
+        self.assertEqual(list(merge_diff(["", "a"], ["a"])), [(ADD, "")])
+
+    def test_duplicates(self):
+        self.assertEqual(list(merge_diff(["a", "a", "b", "b"],
+                                         ["b", "c", "c"])),
+                         [(ADD, "a"), (DELETE, "c")])
+
+    def test_unsorted(self):
+        with self.assertRaises(ValueError):
+            list(merge_diff(["b", "a"], []))
+        with self.assertRaises(ValueError):
+            list(merge_diff(["a"], ["a", "c", "b"]))
+
+    def test_lazy(self):
+        def hosts():
+            yield "a"
+            yield "b"
+            raise AssertionError("read past the first change")
+
+        changes = merge_diff(hosts(), iter(["b", "c"]))
+        self.assertEqual(next(changes), (ADD, "a"))
+
+    def test_fingerprints(self):
+        hosts = array("Q", sorted(set(fingerprint("h%d" % i)
+                                      for i in range(100))))
+        users = array("Q", sorted(set(fingerprint("h%d" % i)
+                                      for i in range(50, 150))))
+        changes = list(merge_diff(hosts, users))
+        self.assertEqual(set(fp for op, fp in changes if op == ADD),
+                         set(hosts) - set(users))
+        self.assertEqual(set(fp for op, fp in changes if op == DELETE),
+                         set(users) - set(hosts))
+        self.assertEqual([fp for op, fp in changes],
+                         sorted(fp for op, fp in changes))
+
+    def test_random(self):
+        rnd = random.Random(42)
+        for n in range(50):
+            hosts = sorted(rnd.choice("abcdefghij") * rnd.randint(1, 3)
+                           for i in range(rnd.randint(0, 20)))
+            users = sorted(rnd.choice("abcdefghij") * rnd.randint(1, 3)
+                           for i in range(rnd.randint(0, 20)))
+            changes = list(merge_diff(hosts, users))
+            expected = sorted([(ADD, h) for h in set(hosts) - set(users)] +
+                              [(DELETE, u) for u in set(users) - set(hosts)],
+                              key = lambda c: c[1])
+            self.assertEqual(changes, expected)
+
+if __name__ == "__main__":
+    unittest.main()
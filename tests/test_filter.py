@@ -0,0 +1,274 @@
+"""
+Tests of the compiler of the Icinga 2 Host filters (see
+``icinga2_usersyncd.filter``) and of the agreement between the local
+evaluation of a filter and the filter sent to the Icinga 2 API.
+"""
+
+import os
+import sys
+import unittest
+from multiprocessing import Process, Queue
+
+from icinga2_usersyncd.filter import compile_filter, FilterError
+
+HOST = {
+    "name": "web1.example.org",
+    "zone": "master",
+    "address": "10.0.0.1",
+    "vars": {
+        "os": "Linux",
+        "cores": 4,
+        "roles": ["web", "db"],
+        "agent": True,
+        "notes": None,
+        "path": "C:\\agent",
+        "env": { "tier": "prod" },
+    },
+}
+
+def check(text: str, attrs = HOST) -> bool:
+    predicate = compile_filter(text)
+    assert predicate is not None
+    return predicate(attrs)
+
+class PrecedenceTest(unittest.TestCase):
+
+    def test_and_binds_tighter_than_or(self):
+        self.assertTrue(check("true || false && false"))
+        self.assertFalse(check("(true || false) && false"))
+        self.assertTrue(check("false && false || true"))
+
+    def test_not_binds_tighter_than_comparison(self):
+        # (!host.vars.agent) == false
+        self.assertTrue(check("!host.vars.agent == false"))
+        self.assertFalse(check("!(host.vars.agent == true)"))
+        self.assertTrue(check("!!host.vars.agent"))
+
+    def test_comparison_binds_tighter_than_logic(self):
+        self.assertTrue(check('host.zone == "master" && host.vars.os == "Linux"'))
+        self.assertTrue(check('host.zone == "x" || host.vars.os == "Linux"'))
+        self.assertFalse(check('host.zone == "x" || host.vars.os == "x" && true'))
+
+    def test_parentheses(self):
+        self.assertTrue(check('(host.zone == "x" || host.zone == "master") && host.vars.agent'))
+        self.assertFalse(check('host.zone == "x" || (host.zone == "master" && !host.vars.agent)'))
+
+class MembershipTest(unittest.TestCase):
+
+    def test_in_literal_array(self):
+        self.assertTrue(check('host.zone in ["master", "satellite"]'))
+        self.assertFalse(check('host.zone in ["satellite"]'))
+        self.assertFalse(check('host.zone in []'))
+
+    def test_in_attribute(self):
+        self.assertTrue(check('"web" in host.vars.roles'))
+        self.assertFalse(check('"mail" in host.vars.roles'))
+
+    def test_not_in(self):
+        self.assertTrue(check('"mail" !in host.vars.roles'))
+        self.assertFalse(check('"db" !in host.vars.roles'))
+        self.assertTrue(check('host.zone !in ["satellite"]'))
+
+    def test_in_null(self):
+        self.assertFalse(check('"web" in host.vars.missing'))
+        self.assertTrue(check('"web" !in host.vars.missing'))
+
+    def test_in_not_array(self):
+        with self.assertRaises(FilterError):
+            check('"web" in host.vars.os')
+
+class MatchTest(unittest.TestCase):
+
+    def test_star(self):
+        self.assertTrue(check('match("web*", host.name)'))
+        self.assertTrue(check('match("*.example.org", host.name)'))
+        self.assertTrue(check('match("*", host.name)'))
+        self.assertFalse(check('match("db*", host.name)'))
+
+    def test_question_mark(self):
+        self.assertTrue(check('match("web?.example.org", host.name)'))
+        self.assertFalse(check('match("we?.example.org", host.name)'))
+
+    def test_whole_value(self):
+        self.assertFalse(check('match("web", host.name)'))
+        self.assertFalse(check('match("example", host.name)'))
+
+    def test_brackets_are_literal(self):
+        self.assertFalse(check('match("[wd]eb1*", host.name)'))
+        self.assertTrue(check('match("[wd]*", host.name)',
+                              { "name": "[wd]eb1" }))
+
+    def test_regex_characters_are_literal(self):
+        self.assertFalse(check('match("web1.example.org", host.name)',
+                               { "name": "web1Xexample.org" }))
+        self.assertTrue(check('match("a+b", host.name)', { "name": "a+b" }))
+
+    def test_not_string(self):
+        self.assertFalse(check('match("*", host.vars.cores)'))
+        self.assertFalse(check('match("*", host.vars.missing)'))
+
+class AttributeTest(unittest.TestCase):
+
+    def test_paths(self):
+        self.assertTrue(check('host.vars.env.tier == "prod"'))
+        self.assertTrue(check('host.vars.os != "Windows"'))
+
+    def test_missing_is_null(self):
+        self.assertTrue(check("host.vars.missing == null"))
+        self.assertTrue(check("host.vars.env.missing.deeper == null"))
+        self.assertTrue(check("host.zone.deeper == null"))
+        self.assertTrue(check("host.vars.notes == null"))
+
+    def test_referred_attributes(self):
+        predicate = compile_filter(
+            'host.vars.os == "Linux" && match("w*", host.name) || host.zone == "x"'
+        )
+        assert predicate is not None
+        self.assertEqual(predicate.attrs, set(["vars", "name", "zone"]))
+
+    def test_other_variable(self):
+        predicate = compile_filter('service.name == "ping"', var = "service")
+        assert predicate is not None
+        self.assertTrue(predicate({ "name": "ping" }))
+        with self.assertRaises(FilterError):
+            compile_filter('host.name == "ping"', var = "service")
+
+class LiteralTest(unittest.TestCase):
+
+    def test_strings(self):
+        self.assertTrue(check('host.vars.path == "C:\\\\agent"'))
+        self.assertTrue(check('"a\\"b" == "a\\"b"'))
+        self.assertTrue(check('"a\\tb" != "a\\\\tb"'))
+
+    def test_numbers(self):
+        self.assertTrue(check("host.vars.cores == 4"))
+        self.assertTrue(check("host.vars.cores == 4.0"))
+        self.assertTrue(check("host.vars.cores > 3.5"))
+        self.assertTrue(check("host.vars.cores <= 4"))
+        self.assertFalse(check("host.vars.cores < 4"))
+        self.assertFalse(check('host.vars.cores == "4"'))
+
+    def test_constants(self):
+        self.assertTrue(check("host.vars.agent == true"))
+        self.assertTrue(check("host.vars.agent != false"))
+        self.assertTrue(check("null == null"))
+
+    def test_arrays(self):
+        self.assertTrue(check('host.vars.roles == ["web", "db"]'))
+        self.assertFalse(check('host.vars.roles == ["db", "web"]'))
+        self.assertTrue(check('[1, [2]] == [1, [2]]'))
+
+    def test_empty(self):
+        self.assertIsNone(compile_filter(None))
+        self.assertIsNone(compile_filter(""))
+        self.assertIsNone(compile_filter("   "))
+
+class FilterErrorTest(unittest.TestCase):
+
+    def test_unsupported_syntax(self):
+        for text in ('host.name =~ "web"',
+                     'regex("^web", host.name)',
+                     'host.vars.cores + 1 == 5',
+                     'len(host.vars.roles) == 2',
+                     'host.name == "web" ;',
+                     "host.name == 'web'",
+                     'name == "web"',
+                     'host == "web"',
+                     'host. == "web"'):
+            with self.assertRaises(FilterError, msg = text):
+                compile_filter(text)
+
+    def test_incomplete(self):
+        for text in ('host.name ==',
+                     '(host.name == "web"',
+                     'host.name in ["web"',
+                     'match("web*" host.name)',
+                     'match("web*", host.name',
+                     '!',
+                     '"unterminated'):
+            with self.assertRaises(FilterError, msg = text):
+                compile_filter(text)
+
+    def test_incompatible_comparison(self):
+        for text in ('host.vars.cores > "3"',
+                     'host.vars.missing < 1',
+                     'host.name >= 1'):
+            predicate = compile_filter(text)
+            assert predicate is not None
+            with self.assertRaises(FilterError, msg = text):
+                predicate(HOST)
+
+    def test_is_value_error(self):
+        self.assertTrue(issubclass(FilterError, ValueError))
+
+class RemoteAgreementTest(unittest.TestCase):
+    """
+    Resolves the created Hosts with ``EventListener.resolve_hosts()``
+    both ways, i. e. requesting the attributes and evaluating the
+    compiled filter locally, and sending the filter to the API, and
+    checks the results are the same. The API is the fake server of
+    the benchmarks (see ``benchmarks/fakeapi.py``).
+    """
+
+    HOSTS = ["web1", "web2", "web10", "db1", "db2", "mail"]
+    ZONES = ["master", "satellite", "dmz"]
+    FILTERS = [
+        'host.zone == "master"',
+        'host.zone != "master"',
+        'host.zone in ["master", "dmz"] || host.name == "db2"',
+        'host.zone !in ["dmz"] && match("web*", host.name)',
+        'match("web?", host.name) || match("*1", host.name) && host.zone == "dmz"',
+        '!(host.zone == "satellite") && host.name != "mail"',
+        'host.vars.missing == null && host.zone == "satellite"',
+        'host.name == "none"',
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                        "..", "benchmarks"))
+        import requests
+        import fakeapi
+        from icinga2apic.client import Client
+
+        ready: Queue = Queue()
+        cls.server = Process(target = fakeapi.serve, args = (0, ready),
+                             name = "FakeApi", daemon = True)
+        cls.server.start()
+        url = "http://127.0.0.1:%d" % ready.get(timeout = 10)
+        requests.post("%s/bench/reset" % url, json = {
+            "hosts": cls.HOSTS,
+            "zones": cls.ZONES,
+        }).raise_for_status()
+        cls.client = Client(url = url, username = "test",
+                            password = "test")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.join()
+
+    def resolve(self, text: str, local: bool):
+        from icinga2_usersyncd.event_listener import EventListener
+        from icinga2_usersyncd.apiuser import ApiUserManager
+
+        listener = EventListener(self.client, ApiUserManager(self.client),
+                                 filter = text)
+        self.assertTrue(listener.local_filter)
+        listener.local_filter = local
+        return sorted(listener.resolve_hosts(self.HOSTS + ["unknown"]))
+
+    def test_agreement(self):
+        for text in self.FILTERS:
+            with self.subTest(filter = text):
+                self.assertEqual(self.resolve(text, True),
+                                 self.resolve(text, False))
+
+    def test_expected(self):
+        self.assertEqual(self.resolve(self.FILTERS[2], True),
+                         ["db1", "db2", "mail", "web1", "web10"])
+        self.assertEqual(self.resolve(self.FILTERS[3], False),
+                         ["web1", "web2"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+"""
+Tests of the shared index of the known host names (see
+``icinga2_usersyncd.hostindex``): the overlays and their compaction,
+the journal replay and the sharing between the processes.
+"""
+
+import random
+import unittest
+from array import array
+from multiprocessing import Process
+from unittest import mock
+
+from icinga2_usersyncd import hostindex
+from icinga2_usersyncd.hostindex import HostIndex, sorted_fingerprints, in_sorted, BASE, N_BASE, N_ADDED, N_REMOVED
+from icinga2_usersyncd.constants import HOSTINDEX_OVERLAY
+from icinga2_usersyncd.registry import fingerprint
+
+def names(*numbers: int):
+    return ["host%d.example.org" % i for i in numbers]
+
+def fps(names):
+    return sorted_fingerprints(fingerprint(n) for n in names)
+
+class SortedFingerprintsTest(unittest.TestCase):
+
+    def test_sorted_unique(self):
+        values = [5, 3, 9, 3, 1, 5, 1 << 63, 2]
+        self.assertEqual(sorted_fingerprints(values).tolist(),
+                         [1, 2, 3, 5, 9, 1 << 63])
+
+    def test_chunks(self):
+        rnd = random.Random(1)
+        values = [rnd.randrange(1, 1000) for i in range(5000)]
+        with mock.patch.object(hostindex, "SORT_CHUNK", 7):
+            result = sorted_fingerprints(values)
+        self.assertEqual(result.tolist(), sorted(set(values)))
+        self.assertEqual(result.typecode, "Q")
+
+    def test_in_sorted(self):
+        values = array("Q", [2, 4, 8])
+        self.assertTrue(in_sorted(values, 4))
+        self.assertFalse(in_sorted(values, 1))
+        self.assertFalse(in_sorted(values, 5))
+        self.assertFalse(in_sorted(values, 9))
+        self.assertFalse(in_sorted(array("Q"), 1))
+
+class HostIndexTest(unittest.TestCase):
+
+    def assertConsistent(self, index: HostIndex, expected):
+        self.assertEqual(len(index), len(expected))
+        for name in expected:
+            self.assertIn(name, index)
+        w = index.words
+        base = w[BASE:BASE + w[N_BASE]].tolist()
+        self.assertEqual(base, sorted(set(base)))
+
+    def test_set(self):
+        index = HostIndex(names(1, 2, 3))
+        self.assertIn("host1.example.org", index)
+        self.assertNotIn("host4.example.org", index)
+        self.assertNotIn(None, index)
+
+        index.add("host4.example.org")
+        index.add("host4.example.org")
+        index.discard("host1.example.org")
+        index.discard("host5.example.org")
+        self.assertConsistent(index, names(2, 3, 4))
+        self.assertNotIn("host1.example.org", index)
+
+        index.remove("host4.example.org")
+        with self.assertRaises(KeyError):
+            index.remove("host4.example.org")
+        self.assertEqual(len(index), 2)
+
+    def test_readd(self):
+        index = HostIndex(names(1))
+        index.discard("host1.example.org")
+        self.assertNotIn("host1.example.org", index)
+        index.add("host1.example.org")
+        self.assertIn("host1.example.org", index)
+        self.assertEqual(index.words[N_REMOVED], 0)
+        self.assertEqual(index.words[N_ADDED], 0)
+
+    def test_compaction(self):
+        rnd = random.Random(2)
+        initial = set(names(*range(0, 40000, 2)))
+        index = HostIndex(initial, capacity = 50000)
+        model = set(initial)
+        # Fill either overlay first, then mix the changes:
+        changes = [(True, n) for n in names(*range(1, 2 * HOSTINDEX_OVERLAY + 20, 2))] + \
+            [(False, n) for n in names(*range(0, 2 * HOSTINDEX_OVERLAY + 20, 2))] + \
+            [(rnd.random() < 0.5, names(rnd.randrange(40000))[0])
+             for i in range(4 * HOSTINDEX_OVERLAY)]
+        with mock.patch.object(index, "compact", wraps = index.compact) as compact:
+            for present, name in changes:
+                if present:
+                    index.add(name)
+                    model.add(name)
+                else:
+                    index.discard(name)
+                    model.discard(name)
+                self.assertLess(index.words[N_ADDED], HOSTINDEX_OVERLAY)
+                self.assertLess(index.words[N_REMOVED], HOSTINDEX_OVERLAY)
+        self.assertGreaterEqual(compact.call_count, 2)
+        self.assertConsistent(index, model)
+
+        with index.lock:
+            index.compact()
+        self.assertEqual(index.words[N_ADDED], 0)
+        self.assertEqual(index.words[N_REMOVED], 0)
+        self.assertConsistent(index, model)
+        for name in names(*range(40000)):
+            self.assertEqual(name in index, name in model)
+
+    def test_compaction_edges(self):
+        index = HostIndex(names(*range(100)))
+        first, last = index.words[BASE], index.words[BASE + 99]
+        with index.lock:
+            index.discard_fp(first)
+            index.discard_fp(last)
+            index.add_fp(1)
+            index.add_fp((1 << 64) - 1)
+            index.compact()
+        base = index.words[BASE:BASE + index.words[N_BASE]].tolist()
+        self.assertEqual(len(base), 100)
+        self.assertEqual(base[0], 1)
+        self.assertEqual(base[-1], (1 << 64) - 1)
+        self.assertEqual(base, sorted(base))
+        self.assertNotIn(first, base)
+        self.assertNotIn(last, base)
+
+    def test_capacity(self):
+        index = HostIndex(names(1, 2), capacity = 3)
+        index.add("host3.example.org")
+        with self.assertRaises(IndexError):
+            index.add("host4.example.org")
+        with self.assertRaises(IndexError):
+            index.replace(fps(names(1, 2, 3, 4)))
+
+    def test_replace(self):
+        index = HostIndex(names(1, 2))
+        self.assertTrue(index.replace(fps(names(3, 4, 5))))
+        self.assertConsistent(index, names(3, 4, 5))
+        self.assertNotIn("host1.example.org", index)
+
+    def test_journal_replay(self):
+        index = HostIndex(names(1, 2, 3))
+        index.track()
+        # The listing is taken here, the changes below are newer:
+        listing = fps(names(1, 2, 3, 4))
+        index.add("host5.example.org")
+        index.discard("host4.example.org")
+        index.discard("host1.example.org")
+        index.add("host1.example.org")
+        index.discard("host2.example.org")
+        self.assertTrue(index.replace(listing))
+        self.assertConsistent(index, names(1, 3, 5))
+        self.assertNotIn("host4.example.org", index)
+        self.assertNotIn("host2.example.org", index)
+
+        # The journal isn't recorded after the replacement:
+        index.add("host6.example.org")
+        self.assertTrue(index.replace(fps(names(1))))
+        self.assertConsistent(index, names(1))
+
+    def test_untrack(self):
+        index = HostIndex(names(1))
+        index.track()
+        index.add("host2.example.org")
+        index.untrack()
+        self.assertTrue(index.replace(fps(names(3))))
+        self.assertConsistent(index, names(3))
+
+    def test_journal_overflow(self):
+        index = HostIndex(names(1))
+        with mock.patch.object(hostindex, "HOSTINDEX_JOURNAL", 4):
+            index.track()
+            for name in names(*range(2, 8)):
+                index.add(name)
+            self.assertFalse(index.replace(fps(names(9))))
+        # The index is left as is and not tracking anymore:
+        self.assertConsistent(index, names(*range(1, 8)))
+        self.assertTrue(index.replace(fps(names(9))))
+        self.assertConsistent(index, names(9))
+
+    def test_shared(self):
+        index = HostIndex(names(1, 2))
+
+        def child():
+            index.add("host3.example.org")
+            index.discard("host1.example.org")
+            index.add("host4.example.org")
+
+        p = Process(target = child)
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertConsistent(index, names(2, 3, 4))
+        self.assertNotIn("host1.example.org", index)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Tests of the incremental parsing of the Icinga 2 API responses (see
+``icinga2_usersyncd.listing.iter_results``) at the chunk boundaries.
+"""
+
+import json
+import unittest
+from typing import List
+
+from icinga2_usersyncd.listing import iter_results
+
+RESULTS = [
+    { "name": "web1.example.org", "type": "Host",
+      "attrs": { "zone": "master", "vars": { "roles": ["web", "db"] } } },
+    { "name": "quote\"back\\slash/solidus", "type": "Host",
+      "attrs": { "notes": "tab\there\nnewline ] } , [ {" } },
+    { "name": "хост-é日本\U0001f600",
+      "type": "Host", "attrs": { "nested": [[], [{}], [1.5, -2, None]] } },
+    { "name": "last", "type": "Host", "attrs": { "ok": True } },
+]
+
+def chunked(data: bytes, size: int) -> List[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def split(data: bytes, at: int) -> List[bytes]:
+    return [data[:at], data[at:]]
+
+class IterResultsTest(unittest.TestCase):
+
+    def bodies(self):
+        # Plain UTF-8, escaped non-ASCII (\uXXXX, surrogate pairs)
+        # and pretty-printed:
+        yield json.dumps({ "results": RESULTS },
+                         ensure_ascii = False).encode("utf-8")
+        yield json.dumps({ "results": RESULTS }).encode("utf-8")
+        yield json.dumps({ "status": "ok", "results": RESULTS },
+                         ensure_ascii = False, indent = 4).encode("utf-8")
+
+    def test_single_chunk(self):
+        for body in self.bodies():
+            self.assertEqual(list(iter_results([body])), RESULTS)
+
+    def test_every_split(self):
+        for body in self.bodies():
+            for at in range(len(body) + 1):
+                with self.subTest(at = at):
+                    self.assertEqual(list(iter_results(split(body, at))),
+                                     RESULTS)
+
+    def test_small_chunks(self):
+        for body in self.bodies():
+            for size in (1, 2, 3, 5, 7, 64):
+                with self.subTest(size = size):
+                    self.assertEqual(list(iter_results(chunked(body, size))),
+                                     RESULTS)
+
+    def test_multibyte_split(self):
+        body = json.dumps({ "results": RESULTS },
+                          ensure_ascii = False).encode("utf-8")
+        start = body.index("\U0001f600".encode("utf-8"))
+        for at in range(start, start + 5):
+            with self.subTest(at = at):
+                self.assertEqual(list(iter_results(split(body, at))), RESULTS)
+
+    def test_empty_chunks(self):
+        body = json.dumps({ "results": RESULTS }).encode("utf-8")
+        chunks: List[bytes] = []
+        for chunk in chunked(body, 10):
+            chunks += [b"", chunk, b""]
+        self.assertEqual(list(iter_results(chunks)), RESULTS)
+
+    def test_empty_results(self):
+        for body in (b'{"results":[]}', b'{ "results" : [ ] }',
+                     b'{\n  "results": [\n  ]\n}'):
+            for at in range(len(body) + 1):
+                self.assertEqual(list(iter_results(split(body, at))), [])
+
+    def test_streams(self):
+        def chunks():
+            yield b'{"results":[{"name":"a"},'
+            yield b'{"name":"b"}'
+            raise AssertionError("read past the second object")
+
+        results = iter_results(chunks())
+        self.assertEqual(next(results), { "name": "a" })
+
+    def test_no_results(self):
+        for body in (b'{"error":404,"status":"No objects found."}', b""):
+            with self.assertRaises(ValueError):
+                list(iter_results(chunked(body, 3)))
+
+    def test_truncated(self):
+        body = json.dumps({ "results": RESULTS }).encode("utf-8")
+        for at in (body.index(b"[") + 1, len(body) // 2, len(body) - 2):
+            with self.subTest(at = at):
+                with self.assertRaises(ValueError):
+                    list(iter_results(chunked(body[:at], 16)))
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(iter_results([b'{"results":[{"name":"a"} {"name": }]}']))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Tests of the durable queue of the failed ApiUser operations (see
+``icinga2_usersyncd.retry``): the backoff, the lease of the claimed
+operations and the dead-lettering.
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from icinga2_usersyncd import retry
+from icinga2_usersyncd.retry import RetryQueue, open_retry_queue
+from icinga2_usersyncd.constants import RETRY_LEASE, RETRY_MAX_DELAY
+from icinga2_usersyncd.diff import ADD, DELETE
+
+class Clock():
+    """
+    A replacement of the ``time`` module with a manual clock.
+    """
+
+    def __init__(self, now: float = 1000000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+class RetryQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "retry.db")
+        self.clock = Clock()
+        patcher = mock.patch.object(retry, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.dir.cleanup)
+
+    def queue(self, **kwargs) -> RetryQueue:
+        kwargs.setdefault("delay", 10)
+        return RetryQueue(self.path, **kwargs)
+
+    def test_backoff(self):
+        queue = self.queue(delay = 5)
+        for attempts, delay in ((1, 5), (2, 10), (3, 20), (5, 80)):
+            for i in range(20):
+                self.assertTrue(delay * 0.9 <= queue.backoff(attempts) <= delay * 1.1)
+        self.assertLessEqual(queue.backoff(100), RETRY_MAX_DELAY * 1.1)
+        self.assertGreaterEqual(queue.backoff(100), RETRY_MAX_DELAY * 0.9)
+
+    def test_due_after_delay(self):
+        queue = self.queue()
+        queue.push(ADD, "web1", "Failed")
+        self.assertEqual(queue.due(10), [])
+        self.clock.advance(8.9)
+        self.assertEqual(queue.due(10), [])
+        self.clock.advance(2.2)
+        self.assertEqual(queue.due(10), [(ADD, "web1")])
+
+    def test_lease_expiry(self):
+        queue = self.queue()
+        queue.push(DELETE, "web1", "Failed")
+        self.clock.advance(11.1)
+        self.assertEqual(queue.due(10), [(DELETE, "web1")])
+
+        # Claimed: not returned again until the lease expires.
+        self.assertEqual(queue.due(10), [])
+        self.clock.advance(RETRY_LEASE - 1)
+        self.assertEqual(queue.due(10), [])
+        self.clock.advance(2)
+        self.assertEqual(queue.due(10), [(DELETE, "web1")])
+
+        # A finished operation is gone for good.
+        queue.discard(["web1"])
+        self.clock.advance(RETRY_LEASE + 1)
+        self.assertEqual(queue.due(10), [])
+        self.assertEqual(queue.entries(), [])
+
+    def test_failed_retry(self):
+        queue = self.queue()
+        queue.push(ADD, "web1", "Failed")
+        self.clock.advance(11.1)
+        self.assertEqual(queue.due(10), [(ADD, "web1")])
+
+        # The retry fails before the lease expires: the backoff
+        # replaces the lease.
+        queue.push(ADD, "web1", "Failed again")
+        entry = queue.entries()[0]
+        self.assertEqual(entry.attempts, 2)
+        self.assertEqual(entry.error, "Failed again")
+        self.assertTrue(18 <= entry.next_at - self.clock.now <= 22)
+
+    def test_limit_and_order(self):
+        queue = self.queue()
+        with mock.patch.object(retry.random, "uniform", return_value = 1.0):
+            for name in ("web3", "web1", "web2"):
+                queue.push(ADD, name, "Failed")
+                self.clock.advance(1)
+        self.clock.advance(20)
+        self.assertEqual(queue.due(2), [(ADD, "web3"), (ADD, "web1")])
+        self.assertEqual(queue.due(2), [(ADD, "web2")])
+
+    def test_other_operation_replaces(self):
+        queue = self.queue()
+        queue.push(ADD, "web1", "Failed")
+        queue.push(ADD, "web1", "Failed")
+        self.assertEqual(queue.entries()[0].attempts, 2)
+        queue.push(DELETE, "web1", "Failed")
+        entries = queue.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual((entries[0].op, entries[0].attempts), (DELETE, 1))
+
+    def test_dead_letter(self):
+        queue = self.queue(attempts = 2)
+        for i in range(3):
+            queue.push(ADD, "web1", "Failed %d" % i)
+        queue.push(ADD, "web2", "Failed")
+        self.clock.advance(RETRY_MAX_DELAY * 2)
+        self.assertEqual(queue.due(10), [(ADD, "web2")])
+
+        entries = dict((e.name, e) for e in queue.entries())
+        self.assertTrue(entries["web1"].dead)
+        self.assertEqual(entries["web1"].attempts, 3)
+        self.assertEqual(entries["web1"].error, "Failed 2")
+        self.assertFalse(entries["web2"].dead)
+
+        # A new operation for the host starts over.
+        queue.push(DELETE, "web1", "Failed")
+        self.assertFalse(dict((e.name, e) for e in queue.entries())["web1"].dead)
+
+    def test_durable(self):
+        self.queue().push(ADD, "web1", "Failed")
+        self.clock.advance(11.1)
+        self.assertEqual(self.queue().due(10), [(ADD, "web1")])
+        self.assertEqual(self.queue().due(10), [])
+
+    def test_readonly(self):
+        self.assertIsNone(open_retry_queue(self.path, readonly = True))
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+        self.queue().push(ADD, "web1", "Failed")
+        queue = open_retry_queue(self.path, readonly = True)
+        assert queue is not None
+        self.assertEqual([e.name for e in queue.entries()], ["web1"])
+        with self.assertRaises(sqlite3.OperationalError):
+            queue.push(ADD, "web2", "Failed")
+
+    def test_no_path(self):
+        self.assertIsNone(open_retry_queue(None))
+        self.assertIsNone(open_retry_queue(""))
+
+if __name__ == "__main__":
+    unittest.main()